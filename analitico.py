@@ -0,0 +1,305 @@
+"""Camada analítica em DuckDB sobre um espelho local do histórico.
+
+As coleções de histórico (transformações, consumo e movimento do Plenus) são
+copiadas do banco para tabelas DuckDB, dia a dia: cada dia sincronizado fica
+marcado em _espelho_dias e só é relido do banco quando a marca vence (TTL) ou
+é invalidada por uma gravação/exclusão feita pelo painel.
+
+Sobre o espelho, as consultas por período viram SQL com os filtros empurrados
+para o WHERE, e a auditoria de fluxo é um conjunto de GROUP BY com JOIN nas
+tabelas de agrupamentos e vínculos (enviadas a cada chamada a partir dos
+dicionários da sessão).
+
+Cada linha e cada marca de dia levam a unidade (filial) de origem: as unidades
+dividem as mesmas tabelas, mas sincronizam, invalidam e consultam só o que é seu.
+
+Junto com cada período gravado, agregados_diarios guarda a entrada/saída por dia
+e item (já no formato de item das auditorias). Os gráficos de tendência leem só
+essa tabela, agrupada por dia, semana ou mês, em vez das movimentações.
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:  # painel cai no cálculo em pandas
+    duckdb = None
+
+# Coleção -> campo de data (YYYY-MM-DD) e colunas mínimas usadas pelas consultas
+COLECOES_ESPELHO = {
+    'transf_historico': {
+        'data': 'data_realizacao',
+        'colunas': {'data_realizacao': 'VARCHAR', 'tipo_produto': 'VARCHAR', 'produto': 'VARCHAR',
+                    'essencia': 'VARCHAR', 'volume': 'DOUBLE'},
+    },
+    'consumo_historico': {
+        'data': 'data_consumo',
+        'colunas': {'data_consumo': 'VARCHAR', 'produto': 'VARCHAR', 'essencia': 'VARCHAR', 'volume': 'DOUBLE'},
+    },
+    'plenus_historico': {
+        'data': 'data_movimento',
+        'colunas': {'data_movimento': 'VARCHAR', 'produto': 'VARCHAR', 'categoria': 'VARCHAR',
+                    'entrada': 'DOUBLE', 'saida': 'DOUBLE'},
+    },
+}
+
+SQL_AUDITORIA_FLUXO = """
+WITH sis_mov AS (
+    SELECT CASE WHEN coalesce(essencia, '') <> '' THEN produto || ' - ' || essencia ELSE produto END AS item,
+           CASE WHEN tipo_produto = 'PRODUTO GERADO' THEN volume ELSE 0 END AS ent,
+           CASE WHEN tipo_produto = 'PRODUTO DE ORIGEM' THEN volume ELSE 0 END AS sai
+    FROM transf_historico
+    WHERE filial = $filial AND data_realizacao BETWEEN $ini AND $fim
+      AND tipo_produto IN ('PRODUTO GERADO', 'PRODUTO DE ORIGEM')
+    UNION ALL
+    SELECT CASE WHEN coalesce(essencia, '') <> '' THEN produto || ' - ' || essencia ELSE coalesce(produto, '') END,
+           0, coalesce(volume, 0)
+    FROM consumo_historico
+    WHERE filial = $filial AND data_consumo BETWEEN $ini AND $fim
+),
+sis AS (
+    -- Item sem agrupamento conta com o próprio nome (como no cálculo em pandas)
+    SELECT coalesce(a.nome_grupo, m.item) AS grupo, sum(m.ent) AS ent, sum(m.sai) AS sai
+    FROM sis_mov m
+    LEFT JOIN map_agrupamentos a ON a.origem = 'SISFLORA' AND a.item_original = m.item
+    WHERE coalesce(a.nome_grupo, m.item) IS NOT NULL
+    GROUP BY 1
+),
+ple AS (
+    -- Item sem agrupamento fica de fora; grupo sem vínculo conta com o nome do grupo Plenus
+    SELECT coalesce(v.grupo_sisflora, a.nome_grupo) AS grupo, sum(p.entrada) AS ent, sum(p.saida) AS sai
+    FROM plenus_historico p
+    JOIN map_agrupamentos a ON a.origem = 'PLENUS'
+                           AND a.item_original = p.produto || ' (' || coalesce(p.categoria, '') || ')'
+    LEFT JOIN map_vinculos v ON v.grupo_plenus = a.nome_grupo
+    WHERE p.filial = $filial AND p.data_movimento BETWEEN $ini AND $fim
+    GROUP BY 1
+),
+final AS (
+    SELECT coalesce(s.grupo, p.grupo) AS "Grupo",
+           coalesce(s.ent, 0) AS "Sis_Ent", coalesce(s.sai, 0) AS "Sis_Sai",
+           coalesce(s.ent, 0) - coalesce(s.sai, 0) AS "Sis_Liq",
+           coalesce(p.ent, 0) AS "Ple_Ent", coalesce(p.sai, 0) AS "Ple_Sai",
+           coalesce(p.ent, 0) - coalesce(p.sai, 0) AS "Ple_Liq"
+    FROM sis s FULL OUTER JOIN ple p ON s.grupo = p.grupo
+)
+SELECT *, "Sis_Liq" - "Ple_Liq" AS "Diferenca"
+FROM final
+WHERE greatest(abs("Sis_Ent"), abs("Sis_Sai"), abs("Sis_Liq"), abs("Ple_Ent"), abs("Ple_Sai"), abs("Ple_Liq")) > 0.0001
+ORDER BY "Grupo"
+"""
+
+
+# Entrada/saída por dia e item de cada coleção (mesmos itens e sinais de SQL_AUDITORIA_FLUXO)
+SQL_AGREGAR_DIA = {
+    'transf_historico': """
+        SELECT data_realizacao AS dia,
+               CASE WHEN coalesce(essencia, '') <> '' THEN produto || ' - ' || essencia ELSE produto END AS item,
+               sum(CASE WHEN tipo_produto = 'PRODUTO GERADO' THEN volume ELSE 0 END) AS ent,
+               sum(CASE WHEN tipo_produto = 'PRODUTO DE ORIGEM' THEN volume ELSE 0 END) AS sai
+        FROM transf_historico
+        WHERE filial = ? AND data_realizacao BETWEEN ? AND ? AND tipo_produto IN ('PRODUTO GERADO', 'PRODUTO DE ORIGEM')
+        GROUP BY 1, 2""",
+    'consumo_historico': """
+        SELECT data_consumo AS dia,
+               CASE WHEN coalesce(essencia, '') <> '' THEN produto || ' - ' || essencia ELSE coalesce(produto, '') END AS item,
+               0.0 AS ent, sum(coalesce(volume, 0)) AS sai
+        FROM consumo_historico
+        WHERE filial = ? AND data_consumo BETWEEN ? AND ?
+        GROUP BY 1, 2""",
+    'plenus_historico': """
+        SELECT data_movimento AS dia, produto || ' (' || coalesce(categoria, '') || ')' AS item,
+               sum(entrada) AS ent, sum(saida) AS sai
+        FROM plenus_historico
+        WHERE filial = ? AND data_movimento BETWEEN ? AND ?
+        GROUP BY 1, 2""",
+}
+
+SQL_SERIE_FLUXO = """
+WITH base AS (
+    SELECT colecao, CAST(date_trunc($grao, CAST(dia AS DATE)) AS DATE) AS periodo, item, ent, sai
+    FROM agregados_diarios
+    WHERE filial = $filial AND dia BETWEEN $ini AND $fim
+),
+sis AS (
+    SELECT b.periodo, coalesce(a.nome_grupo, b.item) AS grupo, sum(b.ent) AS ent, sum(b.sai) AS sai
+    FROM base b
+    LEFT JOIN map_agrupamentos a ON a.origem = 'SISFLORA' AND a.item_original = b.item
+    WHERE b.colecao IN ('transf_historico', 'consumo_historico') AND coalesce(a.nome_grupo, b.item) IS NOT NULL
+    GROUP BY 1, 2
+),
+ple AS (
+    SELECT b.periodo, coalesce(v.grupo_sisflora, a.nome_grupo) AS grupo, sum(b.ent) AS ent, sum(b.sai) AS sai
+    FROM base b
+    JOIN map_agrupamentos a ON a.origem = 'PLENUS' AND a.item_original = b.item
+    LEFT JOIN map_vinculos v ON v.grupo_plenus = a.nome_grupo
+    WHERE b.colecao = 'plenus_historico'
+    GROUP BY 1, 2
+)
+SELECT coalesce(s.periodo, p.periodo) AS "Periodo", coalesce(s.grupo, p.grupo) AS "Grupo",
+       coalesce(s.ent, 0) AS "Sis_Ent", coalesce(s.sai, 0) AS "Sis_Sai",
+       coalesce(p.ent, 0) AS "Ple_Ent", coalesce(p.sai, 0) AS "Ple_Sai"
+FROM sis s FULL OUTER JOIN ple p ON s.periodo = p.periodo AND s.grupo = p.grupo
+ORDER BY 1, 2
+"""
+
+
+def _txt_data(d):
+    return d.strftime("%Y-%m-%d") if isinstance(d, (date, datetime)) else str(d)
+
+
+def _ident(nome):
+    return '"' + str(nome).replace('"', '""') + '"'
+
+
+def agrupar_dias_contiguos(dias):
+    """['2024-01-01','2024-01-02','2024-01-05'] -> [('2024-01-01','2024-01-02'), ('2024-01-05','2024-01-05')]."""
+    faixas = []
+    for dia in sorted(dias):
+        d = datetime.strptime(dia, "%Y-%m-%d").date()
+        if faixas and d - faixas[-1][1] == timedelta(days=1): faixas[-1][1] = d
+        else: faixas.append([d, d])
+    return [(_txt_data(a), _txt_data(b)) for a, b in faixas]
+
+
+class EspelhoHistorico:
+    """Espelho DuckDB do histórico. Uma instância por processo, protegida por lock."""
+
+    def __init__(self, caminho=":memory:"):
+        if duckdb is None: raise RuntimeError("duckdb não está instalado")
+        self.caminho = caminho
+        self._con = duckdb.connect(caminho)
+        self._lock = threading.RLock()
+        with self._lock:
+            tabelas = {r[0] for r in self._con.execute("SELECT table_name FROM information_schema.tables").fetchall()}
+            if '_espelho_dias' in tabelas and 'filial' not in self._colunas('_espelho_dias'):
+                # Espelho de antes das unidades: é só cache, recomeça vazio
+                for nome in ['_espelho_dias', *COLECOES_ESPELHO]: self._con.execute(f"DROP TABLE IF EXISTS {_ident(nome)}")
+            self._con.execute("CREATE TABLE IF NOT EXISTS _espelho_dias (colecao VARCHAR, filial VARCHAR, dia VARCHAR, "
+                              "sincronizado_em TIMESTAMP, PRIMARY KEY (colecao, filial, dia))")
+            for colecao, info in COLECOES_ESPELHO.items():
+                cols = ", ".join(f"{_ident(c)} {t}" for c, t in {'firebase_id': 'VARCHAR', 'filial': 'VARCHAR', **info['colunas']}.items())
+                self._con.execute(f"CREATE TABLE IF NOT EXISTS {_ident(colecao)} ({cols})")
+            self._con.execute("CREATE TABLE IF NOT EXISTS agregados_diarios (colecao VARCHAR, filial VARCHAR, dia VARCHAR, "
+                              "item VARCHAR, ent DOUBLE, sai DOUBLE)")
+            if 'agregados_diarios' not in tabelas:
+                # Espelho de antes dos agregados: monta a partir das linhas que já estão nele
+                for colecao in COLECOES_ESPELHO: self._reagregar(self._con, colecao)
+
+    def _colunas(self, colecao):
+        return {r[0]: r[1] for r in self._con.execute(f"DESCRIBE {_ident(colecao)}").fetchall()}
+
+    def _reagregar(self, cur, colecao, filial=None, d_ini=None, d_fim=None):
+        """Refaz agregados_diarios da coleção (toda, ou só a unidade e o período dados)."""
+        if filial is None:
+            filiais = [r[0] for r in cur.execute(f"SELECT DISTINCT filial FROM {_ident(colecao)}").fetchall()]
+            for f in filiais: self._reagregar(cur, colecao, f, '0000-00-00', '9999-99-99')
+            return
+        cur.execute("DELETE FROM agregados_diarios WHERE colecao = ? AND filial = ? AND dia BETWEEN ? AND ?", [colecao, filial, d_ini, d_fim])
+        cur.execute(f"INSERT INTO agregados_diarios SELECT ?, ?, * FROM ({SQL_AGREGAR_DIA[colecao]})", [colecao, filial, filial, d_ini, d_fim])
+
+    def dias_pendentes(self, colecao, dt_ini, dt_fim, ttl_min, filial=""):
+        """Dias do período que nunca foram sincronizados ou cuja marca venceu."""
+        limite = datetime.now() - timedelta(minutes=ttl_min)
+        with self._lock:
+            frescos = {r[0] for r in self._con.execute(
+                "SELECT dia FROM _espelho_dias WHERE colecao = ? AND filial = ? AND dia BETWEEN ? AND ? AND sincronizado_em >= ?",
+                [colecao, filial, _txt_data(dt_ini), _txt_data(dt_fim), limite]).fetchall()}
+        todos = pd.date_range(dt_ini, dt_fim, freq="D").strftime("%Y-%m-%d")
+        return [d for d in todos if d not in frescos]
+
+    def gravar_periodo(self, colecao, df, d_ini, d_fim, filial=""):
+        """Substitui as linhas da unidade em [d_ini, d_fim] pelas de df e marca os dias como sincronizados."""
+        col_data = COLECOES_ESPELHO[colecao]['data']
+        d_ini, d_fim = _txt_data(d_ini), _txt_data(d_fim)
+        tabela = _ident(colecao)
+        with self._lock:
+            cur = self._con.cursor()
+            cur.execute("BEGIN TRANSACTION")
+            try:
+                cur.execute(f"DELETE FROM {tabela} WHERE filial = ? AND {_ident(col_data)} BETWEEN ? AND ?", [filial, d_ini, d_fim])
+                if df is not None and not df.empty:
+                    # Coluna toda nula não tem tipo; o INSERT BY NAME preenche com NULL
+                    df_ins = df.dropna(axis=1, how='all').assign(filial=filial)
+                    existentes = self._colunas(colecao)
+                    cur.register('df_espelho', df_ins)
+                    for nome, tipo, *_ in cur.execute("DESCRIBE SELECT * FROM df_espelho").fetchall():
+                        if nome not in existentes:
+                            cur.execute(f"ALTER TABLE {tabela} ADD COLUMN {_ident(nome)} {tipo}")
+                    cur.execute(f"INSERT INTO {tabela} BY NAME SELECT * FROM df_espelho")
+                    cur.unregister('df_espelho')
+                self._reagregar(cur, colecao, filial, d_ini, d_fim)
+                dias = pd.date_range(d_ini, d_fim, freq="D").strftime("%Y-%m-%d")
+                agora = datetime.now()
+                cur.executemany("INSERT OR REPLACE INTO _espelho_dias VALUES (?, ?, ?, ?)", [[colecao, filial, d, agora] for d in dias])
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def invalidar(self, colecao=None, dt_ini=None, dt_fim=None, filial=None):
+        """Esquece as marcas de sincronização (a próxima leitura volta ao banco)."""
+        sql, params = "DELETE FROM _espelho_dias WHERE 1 = 1", []
+        if colecao: sql, params = sql + " AND colecao = ?", params + [colecao]
+        if filial is not None: sql, params = sql + " AND filial = ?", params + [filial]
+        if dt_ini: sql, params = sql + " AND dia >= ?", params + [_txt_data(dt_ini)]
+        if dt_fim: sql, params = sql + " AND dia <= ?", params + [_txt_data(dt_fim)]
+        with self._lock: self._con.execute(sql, params)
+
+    def consultar(self, colecao, dt_ini, dt_fim, filtros=None, filial=""):
+        """Linhas da unidade no período, com filtros {coluna: [valores]} empurrados para o WHERE."""
+        col_data = COLECOES_ESPELHO[colecao]['data']
+        condicoes = ["filial = ?", f"{_ident(col_data)} BETWEEN ? AND ?"]
+        params = [filial, _txt_data(dt_ini), _txt_data(dt_fim)]
+        with self._lock:
+            existentes = self._colunas(colecao)
+            for col, valores in (filtros or {}).items():
+                if not valores: continue
+                if col not in existentes: continue  # como no filtro em pandas: coluna ausente é ignorada
+                condicoes.append(f"CAST({_ident(col)} AS VARCHAR) IN ({', '.join('?' * len(valores))})")
+                params += [str(v) for v in valores]
+            sql = f"SELECT * FROM {_ident(colecao)} WHERE {' AND '.join(condicoes)}"
+            df = self._con.execute(sql, params).df()
+        return df.dropna(axis=1, how='all') if not df.empty else pd.DataFrame()
+
+    def _executar_com_mapas(self, sql, params, agrup_sis, agrup_ple, vinculos):
+        """Roda sql com os agrupamentos e vínculos da sessão registrados como tabelas."""
+        map_agrup = pd.DataFrame(
+            [("SISFLORA", k, v) for k, v in agrup_sis.items()] + [("PLENUS", k, v) for k, v in agrup_ple.items()],
+            columns=['origem', 'item_original', 'nome_grupo'], dtype=object)
+        map_vinc = pd.DataFrame(list(vinculos.items()), columns=['grupo_plenus', 'grupo_sisflora'], dtype=object)
+        with self._lock:
+            cur = self._con.cursor()
+            cur.register('map_agrupamentos', map_agrup)
+            cur.register('map_vinculos', map_vinc)
+            df = cur.execute(sql, params).df()
+            cur.close()
+        return df
+
+    def auditoria_fluxo(self, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, filial=""):
+        """Mesmo relatório de calcular_auditoria_fluxo, em SQL sobre o espelho (só a unidade dada)."""
+        return self._executar_com_mapas(SQL_AUDITORIA_FLUXO, {'ini': _txt_data(dt_ini), 'fim': _txt_data(dt_fim), 'filial': filial},
+                                        agrup_sis, agrup_ple, vinculos)
+
+    def serie_fluxo(self, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, grao='day', filial=""):
+        """Entrada/saída Sisflora x Plenus por período ('day', 'week', 'month') e grupo, de agregados_diarios."""
+        return self._executar_com_mapas(SQL_SERIE_FLUXO, {'ini': _txt_data(dt_ini), 'fim': _txt_data(dt_fim), 'filial': filial, 'grao': grao},
+                                        agrup_sis, agrup_ple, vinculos)
+
+    def resumo(self):
+        """Linhas e dias sincronizados por coleção e unidade (para o painel de diagnóstico)."""
+        with self._lock:
+            linhas = []
+            for colecao in COLECOES_ESPELHO:
+                marcas = self._con.execute(
+                    "SELECT filial, count(*), max(sincronizado_em) FROM _espelho_dias WHERE colecao = ? GROUP BY filial ORDER BY filial",
+                    [colecao]).fetchall()
+                contagem = dict(self._con.execute(f"SELECT filial, count(*) FROM {_ident(colecao)} GROUP BY filial").fetchall())
+                agregados = dict(self._con.execute("SELECT filial, count(*) FROM agregados_diarios WHERE colecao = ? GROUP BY filial",
+                                                   [colecao]).fetchall())
+                for filial, dias, ultimo in marcas or [(None, 0, None)]:
+                    linhas.append({'Coleção': colecao, 'Filial': filial, 'Linhas': contagem.get(filial, 0),
+                                   'Agregados': agregados.get(filial, 0), 'Dias': dias, 'Última sync': ultimo})
+        return pd.DataFrame(linhas)
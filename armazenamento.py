@@ -0,0 +1,551 @@
+"""Backends de armazenamento com a mesma API do Firestore usada pelo painel.
+
+O painel só usa um subconjunto do client do Firestore: collection/document,
+where/order_by/limit/select/stream, on_snapshot e batch (set/delete/commit). Este módulo
+implementa esse subconjunto em dois backends locais, para desenvolvimento
+offline, testes de carga e benchmarks sem projeto nem custo no Firebase:
+
+- FirestoreMemoria: tudo em dicionários (some ao reiniciar o processo)
+- FirestoreSQLite: um arquivo SQLite, uma tabela por coleção com o documento
+  em JSON; os filtros, a ordenação e o limite viram SQL (json_extract)
+
+Nos backends locais, on_snapshot avisa no mesmo processo: o callback roda na
+thread de quem gravou, logo depois da escrita (ou do commit do lote), e recebe só
+os documentos que mudaram (o Firestore manda o snapshot inteiro da consulta).
+Os documentos trazem update_time (UTC) da última escrita feita neste processo (o que
+outro processo grava no arquivo SQLite também não avisa os ouvintes daqui). No SQLite só
+as MAX_TEMPOS_SQLITE escritas mais recentes são lembradas; as esquecidas valem a hora da
+última esquecida, nunca mais cedo que a escrita real.
+
+O backend é escolhido por configuração no painel (ESTOQUE_BACKEND ou
+[app] backend = "firestore" | "memoria" | "sqlite").
+"""
+import copy
+from collections import OrderedDict
+import json
+import math
+import sqlite3
+import threading
+import traceback
+import uuid
+from datetime import date, datetime, timezone
+from enum import Enum
+
+BACKENDS_LOCAIS = ('memoria', 'sqlite')
+MAX_TEMPOS_SQLITE = 200_000
+
+OPERADORES = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _eh_descendente(direction):
+    # Aceita a constante do Firestore (Query.DESCENDING) ou a string
+    return str(direction).upper().endswith("DESCENDING")
+
+
+def _novo_id():
+    return uuid.uuid4().hex[:20]
+
+
+def _casa_filtros(dados, filtros):
+    # Como no Firestore: documento sem o campo não entra no filtro
+    return all(c in dados and OPERADORES[op](dados[c], v) for c, op, v in filtros)
+
+
+def _agora_utc():
+    return datetime.now(timezone.utc)
+
+
+class DocumentoMemoria:
+    def __init__(self, referencia, dados, update_time=None):
+        self.reference = referencia
+        self.id = referencia.id
+        self.exists = dados is not None
+        self._dados = dados
+        self.update_time = update_time if dados is not None else None
+
+    def to_dict(self):
+        return copy.deepcopy(self._dados) if self._dados is not None else None
+
+    def get(self, campo):
+        return (self._dados or {}).get(campo)
+
+
+# --- BACKEND EM MEMÓRIA ---
+class ReferenciaMemoria:
+    def __init__(self, colecao, doc_id):
+        self._colecao = colecao
+        self.id = doc_id
+
+    def _gravar(self, dados, merge=False):
+        with self._colecao._lock:
+            docs = self._colecao._docs
+            if merge and self.id in docs: docs[self.id].update(copy.deepcopy(dados))
+            else: docs[self.id] = copy.deepcopy(dados)
+            self._colecao._tempos[self.id] = _agora_utc()
+
+    def _alterar(self, dados):
+        with self._colecao._lock:
+            self._colecao._docs[self.id].update(copy.deepcopy(dados))
+            self._colecao._tempos[self.id] = _agora_utc()
+
+    def _apagar(self):
+        with self._colecao._lock:
+            self._colecao._docs.pop(self.id, None)
+            self._colecao._tempos.pop(self.id, None)
+
+    def _avisar(self):
+        if self._colecao._banco is not None: self._colecao._banco._avisar({self._colecao.nome: {self.id}})
+
+    def set(self, dados, merge=False):
+        self._gravar(dados, merge)
+        self._avisar()
+
+    def update(self, dados):
+        self._alterar(dados)
+        self._avisar()
+
+    def delete(self):
+        self._apagar()
+        self._avisar()
+
+    def get(self):
+        with self._colecao._lock:
+            return DocumentoMemoria(self, copy.deepcopy(self._colecao._docs.get(self.id)), self._colecao._tempos.get(self.id))
+
+
+class ConsultaMemoria:
+    def __init__(self, colecao, filtros=(), ordem=(), limite=None, campos=None):
+        self._colecao = colecao
+        self._filtros = list(filtros)
+        self._ordem = list(ordem)
+        self._limite = limite
+        self._campos = campos
+
+    def _copia(self, **mudancas):
+        args = dict(filtros=self._filtros, ordem=self._ordem, limite=self._limite, campos=self._campos)
+        args.update(mudancas)
+        return ConsultaMemoria(self._colecao, **args)
+
+    def where(self, campo, op, valor):
+        if op not in OPERADORES: raise ValueError(f"Operador não suportado: {op}")
+        return self._copia(filtros=self._filtros + [(campo, op, valor)])
+
+    def order_by(self, campo, direction="ASCENDING"):
+        return self._copia(ordem=self._ordem + [(campo, _eh_descendente(direction))])
+
+    def limit(self, n):
+        return self._copia(limite=n)
+
+    def select(self, campos):
+        return self._copia(campos=list(campos))
+
+    def _filtrados(self):
+        with self._colecao._lock:
+            itens = list(self._colecao._docs.items())
+        res = []
+        for doc_id, dados in itens:
+            # Como no Firestore: documento sem o campo não entra no filtro nem na ordenação
+            if _casa_filtros(dados, self._filtros):
+                if all(c in dados for c, _ in self._ordem):
+                    res.append((doc_id, dados))
+        for campo, desc in reversed(self._ordem):
+            res.sort(key=lambda x: x[1][campo], reverse=desc)
+        if self._limite is not None: res = res[:self._limite]
+        return res
+
+    def stream(self):
+        for doc_id, dados in self._filtrados():
+            if self._campos is not None:
+                dados = {k: v for k, v in dados.items() if k in self._campos}
+            yield DocumentoMemoria(ReferenciaMemoria(self._colecao, doc_id), copy.deepcopy(dados), self._colecao._tempos.get(doc_id))
+
+    def get(self):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._colecao._banco._ouvir(self, callback)
+
+
+class ColecaoMemoria(ConsultaMemoria):
+    def __init__(self, nome, banco=None):
+        self.nome = nome
+        self._banco = banco
+        self._docs = {}
+        self._tempos = {}
+        self._lock = threading.RLock()
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return ReferenciaMemoria(self, doc_id or _novo_id())
+
+    def add(self, dados):
+        ref = self.document()
+        ref.set(dados)
+        return None, ref
+
+
+class LoteMemoria:
+    """Batch: acumula as operações e aplica tudo no commit() (os ouvintes são avisados uma vez)."""
+    def __init__(self, banco=None):
+        self._banco = banco
+        self._ops = []
+
+    def set(self, referencia, dados, merge=False):
+        self._ops.append((referencia, lambda: referencia._gravar(dados, merge=merge)))
+
+    def update(self, referencia, dados):
+        self._ops.append((referencia, lambda: referencia._alterar(dados)))
+
+    def delete(self, referencia):
+        self._ops.append((referencia, referencia._apagar))
+
+    def commit(self):
+        alteradas = {}
+        for referencia, op in self._ops:
+            op()
+            alteradas.setdefault(referencia._colecao.nome, set()).add(referencia.id)
+        self._ops = []
+        if self._banco is not None: self._banco._avisar(alteradas)
+
+
+# --- OUVINTES (on_snapshot) DOS BACKENDS LOCAIS ---
+class TipoMudanca(Enum):
+    # Mesmos nomes e valores do ChangeType do Firestore
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class MudancaDocumento:
+    def __init__(self, tipo, documento):
+        self.type = tipo
+        self.document = documento
+
+
+class OuvinteLocal:
+    """Devolvido por on_snapshot (como o Watch do Firestore): unsubscribe() para de avisar."""
+    def __init__(self, banco, consulta, callback):
+        self._banco = banco
+        self.consulta = consulta
+        self.callback = callback
+        self.ids = set()
+
+    def unsubscribe(self):
+        self._banco._parar_ouvinte(self)
+
+
+class ComOuvintes:
+    """Registro de ouvintes de um backend local; as escritas chamam _avisar com os ids alterados."""
+    def _iniciar_ouvintes(self):
+        self._ouvintes = []
+        self._lock_ouvintes = threading.Lock()
+
+    def _ouvir(self, consulta, callback):
+        ouvinte = OuvinteLocal(self, consulta, callback)
+        # Primeiro snapshot (tudo que a consulta devolve, como ADDED) sob o lock: nenhum aviso de
+        # escrita chega antes dele, e o que for gravado durante a leitura vem depois como MODIFIED
+        with self._lock_ouvintes:
+            docs = consulta.get()
+            ouvinte.ids = {d.id for d in docs}
+            self._chamar(ouvinte, docs, [MudancaDocumento(TipoMudanca.ADDED, d) for d in docs])
+            self._ouvintes.append(ouvinte)
+        return ouvinte
+
+    def _parar_ouvinte(self, ouvinte):
+        with self._lock_ouvintes:
+            if ouvinte in self._ouvintes: self._ouvintes.remove(ouvinte)
+
+    def _chamar(self, ouvinte, docs, mudancas):
+        try:
+            ouvinte.callback(docs, mudancas, datetime.now())
+        except Exception:
+            # Erro do callback não pode desfazer nem interromper a escrita de quem gravou
+            traceback.print_exc()
+
+    def _avisar(self, alteradas):
+        with self._lock_ouvintes: ouvintes = list(self._ouvintes)
+        for ouvinte in ouvintes:
+            ids = alteradas.get(ouvinte.consulta._colecao.nome)
+            if not ids: continue
+            mudancas = []
+            for doc_id in sorted(ids):
+                doc = ouvinte.consulta._colecao.document(doc_id).get()
+                casa = doc.exists and _casa_filtros(doc._dados, ouvinte.consulta._filtros)
+                if casa:
+                    mudancas.append(MudancaDocumento(TipoMudanca.MODIFIED if doc_id in ouvinte.ids else TipoMudanca.ADDED, doc))
+                    ouvinte.ids.add(doc_id)
+                elif doc_id in ouvinte.ids:
+                    mudancas.append(MudancaDocumento(TipoMudanca.REMOVED, doc))
+                    ouvinte.ids.discard(doc_id)
+            if mudancas: self._chamar(ouvinte, [m.document for m in mudancas if m.type != TipoMudanca.REMOVED], mudancas)
+
+
+class FirestoreMemoria(ComOuvintes):
+    def __init__(self):
+        self._colecoes = {}
+        self._lock = threading.Lock()
+        self._iniciar_ouvintes()
+
+    def collection(self, nome):
+        with self._lock:
+            if nome not in self._colecoes: self._colecoes[nome] = ColecaoMemoria(nome, self)
+            return self._colecoes[nome]
+
+    def batch(self):
+        return LoteMemoria(self)
+
+    def limpar_colecao(self, nome):
+        col = self.collection(nome)
+        with col._lock: col._docs.clear()
+
+    def total_documentos(self):
+        return {nome: len(c._docs) for nome, c in self._colecoes.items()}
+
+
+# --- BACKEND SQLITE ---
+def _valor_json(valor):
+    """Normaliza valores para JSON (datas em ISO, NaN/NaT/inf como null, numpy como Python)."""
+    if isinstance(valor, dict): return {k: _valor_json(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)): return [_valor_json(v) for v in valor]
+    if valor is None or isinstance(valor, (str, bool, int)): return valor
+    if type(valor).__name__ == 'NAType': return None  # pd.NA
+    if valor != valor: return None  # NaN, pd.NaT
+    if isinstance(valor, float): return valor if math.isfinite(valor) else None
+    if isinstance(valor, (datetime, date)): return valor.isoformat()
+    if hasattr(valor, 'item'):
+        try: return _valor_json(valor.item())
+        except (TypeError, ValueError): pass
+    return str(valor)
+
+
+def _caminho_json(campo):
+    return '$."' + campo.replace('"', '\\"') + '"'
+
+
+def _nome_tabela(colecao):
+    return '"' + colecao.replace('"', '""') + '"'
+
+
+class ReferenciaSQLite:
+    def __init__(self, colecao, doc_id):
+        self._colecao = colecao
+        self.id = doc_id
+
+    def set(self, dados, merge=False):
+        self._colecao._banco._executar_lote([('set', self._colecao.nome, self.id, dados, merge)])
+
+    def update(self, dados):
+        self._colecao._banco._executar_lote([('set', self._colecao.nome, self.id, dados, True)])
+
+    def delete(self):
+        self._colecao._banco._executar_lote([('delete', self._colecao.nome, self.id, None, False)])
+
+    def get(self):
+        banco = self._colecao._banco
+        with banco._lock:
+            banco._garantir_tabela(self._colecao.nome)
+            linha = banco._conexao.execute(
+                f"SELECT dados FROM {_nome_tabela(self._colecao.nome)} WHERE id = ?", (self.id,)).fetchone()
+        return DocumentoMemoria(self, json.loads(linha[0]) if linha else None, banco._tempo_doc(self._colecao.nome, self.id))
+
+
+class ConsultaSQLite:
+    def __init__(self, colecao, filtros=(), ordem=(), limite=None, campos=None):
+        self._colecao = colecao
+        self._filtros = list(filtros)
+        self._ordem = list(ordem)
+        self._limite = limite
+        self._campos = campos
+
+    def _copia(self, **mudancas):
+        args = dict(filtros=self._filtros, ordem=self._ordem, limite=self._limite, campos=self._campos)
+        args.update(mudancas)
+        return ConsultaSQLite(self._colecao, **args)
+
+    def where(self, campo, op, valor):
+        if op not in OPERADORES: raise ValueError(f"Operador não suportado: {op}")
+        return self._copia(filtros=self._filtros + [(campo, op, valor)])
+
+    def order_by(self, campo, direction="ASCENDING"):
+        return self._copia(ordem=self._ordem + [(campo, _eh_descendente(direction))])
+
+    def limit(self, n):
+        return self._copia(limite=n)
+
+    def select(self, campos):
+        return self._copia(campos=list(campos))
+
+    def _montar_sql(self):
+        condicoes, params = [], []
+        for campo, op, valor in self._filtros:
+            caminho = _caminho_json(campo)
+            expr = "json_extract(dados, ?)"
+            if op in ('in', 'not-in'):
+                valores = [_valor_json(v) for v in valor]
+                if not valores:
+                    # IN () nunca casa; NOT IN () casa tudo que tem o campo
+                    condicoes.append("0" if op == 'in' else "json_type(dados, ?) IS NOT NULL")
+                    if op == 'not-in': params.append(caminho)
+                    continue
+                marcadores = ", ".join("?" * len(valores))
+                condicoes.append(f"{expr} {'IN' if op == 'in' else 'NOT IN'} ({marcadores})")
+                params += [caminho] + valores
+            elif op == 'array_contains':
+                condicoes.append("EXISTS (SELECT 1 FROM json_each(dados, ?) WHERE json_each.value = ?)")
+                params += [caminho, _valor_json(valor)]
+            elif valor is None and op in ('==', '!='):
+                condicoes.append(f"json_type(dados, ?) {'=' if op == '==' else '!='} 'null'")
+                params.append(caminho)
+            else:
+                condicoes.append(f"{expr} {'<>' if op == '!=' else op} ?")
+                params += [caminho, _valor_json(valor)]
+        for campo, _ in self._ordem:
+            # Como no Firestore: documento sem o campo fica fora da ordenação
+            condicoes.append("json_type(dados, ?) IS NOT NULL")
+            params.append(_caminho_json(campo))
+
+        sql = f"SELECT id, dados FROM {_nome_tabela(self._colecao.nome)}"
+        if condicoes: sql += " WHERE " + " AND ".join(condicoes)
+        if self._ordem:
+            sql += " ORDER BY " + ", ".join(f"json_extract(dados, ?) {'DESC' if desc else 'ASC'}" for _, desc in self._ordem)
+            params += [_caminho_json(campo) for campo, _ in self._ordem]
+        if self._limite is not None:
+            sql += " LIMIT ?"
+            params.append(int(self._limite))
+        return sql, params
+
+    def stream(self):
+        banco = self._colecao._banco
+        sql, params = self._montar_sql()
+        with banco._lock:
+            banco._garantir_tabela(self._colecao.nome)
+            linhas = banco._conexao.execute(sql, params).fetchall()
+        for doc_id, texto in linhas:
+            dados = json.loads(texto)
+            if self._campos is not None:
+                dados = {k: v for k, v in dados.items() if k in self._campos}
+            yield DocumentoMemoria(ReferenciaSQLite(self._colecao, doc_id), dados, banco._tempo_doc(self._colecao.nome, doc_id))
+
+    def get(self):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._colecao._banco._ouvir(self, callback)
+
+
+class ColecaoSQLite(ConsultaSQLite):
+    def __init__(self, banco, nome):
+        self._banco = banco
+        self.nome = nome
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return ReferenciaSQLite(self, doc_id or _novo_id())
+
+    def add(self, dados):
+        ref = self.document()
+        ref.set(dados)
+        return None, ref
+
+
+class LoteSQLite:
+    """Batch: todas as operações vão numa única transação no commit()."""
+    def __init__(self, banco):
+        self._banco = banco
+        self._ops = []
+
+    def set(self, referencia, dados, merge=False):
+        self._ops.append(('set', referencia._colecao.nome, referencia.id, dados, merge))
+
+    def update(self, referencia, dados):
+        self._ops.append(('set', referencia._colecao.nome, referencia.id, dados, True))
+
+    def delete(self, referencia):
+        self._ops.append(('delete', referencia._colecao.nome, referencia.id, None, False))
+
+    def commit(self):
+        self._banco._executar_lote(self._ops)
+        self._ops = []
+
+
+class FirestoreSQLite(ComOuvintes):
+    def __init__(self, caminho="estoque_local.sqlite"):
+        self.caminho = caminho
+        # Uma conexão compartilhada entre as sessões (threads) do Streamlit, serializada pelo lock
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self._conexao.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.RLock()
+        self._tabelas = set()
+        # Hora da última escrita de cada documento gravado por este processo (update_time)
+        self._tempos = OrderedDict()
+        self._piso_tempos = datetime.min.replace(tzinfo=timezone.utc)
+        self._iniciar_ouvintes()
+
+    def _tempo_doc(self, nome, doc_id):
+        return self._tempos.get((nome, doc_id), self._piso_tempos)
+
+    def _marcar_tempo(self, nome, doc_id):
+        self._tempos[(nome, doc_id)] = _agora_utc()
+        self._tempos.move_to_end((nome, doc_id))
+        while len(self._tempos) > MAX_TEMPOS_SQLITE:
+            _, self._piso_tempos = self._tempos.popitem(last=False)
+
+    def _garantir_tabela(self, nome):
+        if nome in self._tabelas: return
+        self._conexao.execute(f"CREATE TABLE IF NOT EXISTS {_nome_tabela(nome)} (id TEXT PRIMARY KEY, dados TEXT NOT NULL)")
+        self._conexao.commit()
+        self._tabelas.add(nome)
+
+    def _executar_lote(self, ops):
+        with self._lock:
+            for nome in {op[1] for op in ops}: self._garantir_tabela(nome)
+            with self._conexao:
+                for tipo, nome, doc_id, dados, merge in ops:
+                    tabela = _nome_tabela(nome)
+                    if tipo == 'delete':
+                        self._conexao.execute(f"DELETE FROM {tabela} WHERE id = ?", (doc_id,))
+                        self._tempos.pop((nome, doc_id), None)
+                        continue
+                    novo = _valor_json(dict(dados))
+                    if merge:
+                        linha = self._conexao.execute(f"SELECT dados FROM {tabela} WHERE id = ?", (doc_id,)).fetchone()
+                        if linha: novo = {**json.loads(linha[0]), **novo}
+                    self._conexao.execute(f"INSERT OR REPLACE INTO {tabela} (id, dados) VALUES (?, ?)",
+                                          (doc_id, json.dumps(novo, ensure_ascii=False)))
+                    self._marcar_tempo(nome, doc_id)
+        alteradas = {}
+        for _, nome, doc_id, _, _ in ops: alteradas.setdefault(nome, set()).add(doc_id)
+        self._avisar(alteradas)
+
+    def collection(self, nome):
+        return ColecaoSQLite(self, nome)
+
+    def batch(self):
+        return LoteSQLite(self)
+
+    def limpar_colecao(self, nome):
+        with self._lock:
+            self._garantir_tabela(nome)
+            with self._conexao: self._conexao.execute(f"DELETE FROM {_nome_tabela(nome)}")
+
+    def total_documentos(self):
+        with self._lock:
+            nomes = [r[0] for r in self._conexao.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return {nome: self._conexao.execute(f"SELECT COUNT(*) FROM {_nome_tabela(nome)}").fetchone()[0] for nome in nomes}
+
+
+def criar_backend(tipo, caminho_sqlite=None):
+    """Instancia um backend local ('memoria' ou 'sqlite')."""
+    if tipo == 'memoria': return FirestoreMemoria()
+    if tipo == 'sqlite': return FirestoreSQLite(caminho_sqlite or "estoque_local.sqlite")
+    raise ValueError(f"Backend de armazenamento desconhecido: {tipo}")
@@ -0,0 +1,331 @@
+"""Benchmark do pipeline do painel com dados sintéticos e banco local (armazenamento.py).
+
+Uso (a partir da raiz do repositório):
+
+    python benchmarks/executar_benchmark.py --escala 1 --repeticoes 3 --saida resultados.json
+    python benchmarks/executar_benchmark.py --escala 1 --comparar resultados.json
+    python benchmarks/executar_benchmark.py --backend sqlite
+
+Mede os parsers (PDF Sisflora, HTML Plenus, SISTRANSF, consumo), as gravações em
+lote, a importação incremental do Plenus (um dia novo), o saldo Sisflora completo/delta, a exportação do histórico para Excel, o agrupamento automático, a conferência de saldo estático, a consulta filtrada do histórico de
+transformação, a auditoria de fluxo (carga + cálculo) e as séries dos gráficos de tendência.
+O arquivo de saída traz a mediana/mínimo de cada etapa mais linhas e documentos
+lidos/gravados, para comparar execuções e pegar regressões.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Antes de importar o app: sem log de diagnóstico em disco
+os.environ.setdefault('ESTOQUE_LOG_DIAGNOSTICO', '')
+
+import pandas as pd
+
+import gerar_dados
+
+# Tamanhos base (escala 1). Escala 10 ~ um ano de uma serraria grande.
+TAMANHOS_BASE = {
+    'sisflora_linhas': 1500,
+    'plenus_skus': 150,
+    'plenus_dias': 30,
+    'sistransf_transformacoes': 4000,
+    'consumo_linhas': 2000,
+}
+
+
+def importar_app(backend, caminho_sqlite=None):
+    """Importa o painel apontando para um backend local (sem Firebase real)."""
+    os.environ['ESTOQUE_BACKEND'] = backend
+    if caminho_sqlite: os.environ['ESTOQUE_SQLITE_CAMINHO'] = caminho_sqlite
+    # O app roda em modo "bare" (sem streamlit run): silencia os avisos de ScriptRunContext
+    for nome in ('streamlit.runtime.scriptrunner_utils.script_run_context', 'streamlit.runtime.caching.cache_data_api'):
+        logging.getLogger(nome).disabled = True
+    import painel_principal
+    return painel_principal
+
+
+def medir(pp, nome, func, repeticoes, preparar=None):
+    """Roda func repeticoes vezes; devolve estatísticas e o último resultado."""
+    tempos, etapa_final, resultado = [], None, None
+    for _ in range(repeticoes):
+        if preparar: preparar()
+        with pp.medir_etapa(f"bench_{nome}") as etapa:
+            t0 = time.perf_counter()
+            resultado = func()
+            tempos.append(time.perf_counter() - t0)
+        etapa_final = etapa
+    linhas = pp._contar_linhas(resultado)
+    stats = {
+        'segundos_mediana': round(statistics.median(tempos), 4),
+        'segundos_min': round(min(tempos), 4),
+        'repeticoes': repeticoes,
+        'linhas': linhas,
+        'docs_lidos': etapa_final['docs_lidos'],
+        'docs_escritos': etapa_final['docs_escritos'],
+    }
+    print(f"  {nome:<28} {stats['segundos_mediana']:>9.4f}s  linhas={linhas}  lidos={stats['docs_lidos']}  gravados={stats['docs_escritos']}")
+    return stats, resultado
+
+
+def montar_agrupamentos(df_sis, df_ple, df_transf):
+    """Agrupa por nome popular da essência + categoria (como um admin faria no radar)."""
+    agrup_sis, agrup_ple = {}, {}
+    for item, cat in zip(df_sis['Item_Completo'], df_sis['Cat_Auto']):
+        agrup_sis[item] = f"{item.rsplit(' - ', 1)[-1].split(' ')[0].upper()} {cat}"
+    for prod, ess in zip(df_transf['produto'], df_transf['essencia']):
+        item = f"{prod} - {ess}" if ess else prod
+        agrup_sis.setdefault(item, f"{ess.rsplit(' - ', 1)[-1].split(' ')[0].upper()} SERRADAS")
+    for item, cat in zip(df_ple['Item_Completo'], df_ple['Cat_Auto']):
+        agrup_ple[item] = f"{item.split(' ')[1].upper()} {cat}"
+    vinculos = {g: g for g in set(agrup_ple.values())}
+    return agrup_sis, agrup_ple, vinculos
+
+
+def gravar_mapeamentos(db, agrup_sis, agrup_ple, vinculos):
+    for origem, mapa in [("SISFLORA", agrup_sis), ("PLENUS", agrup_ple)]:
+        for i, (item, grupo) in enumerate(mapa.items()):
+            db.collection('agrupamentos').document(f"{origem}_{i}").set(
+                {'item_original': item, 'nome_grupo': grupo, 'origem': origem, 'categoria': grupo.split(' ')[-1]})
+    for gp, gs in vinculos.items():
+        db.collection('vinculos').document(gp).set({'grupo_plenus': gp, 'grupo_sisflora': gs})
+
+
+def preparar_plenus_para_db(df_ple):
+    """Mesmo recorte do botão '💾 Salvar Filtrados no Firebase'."""
+    df_save = df_ple.rename(columns={'tipo': 'tipo_movimento', 'saldo': 'saldo_apos'})
+    df_save = df_save[df_save['data_movimento'].notna()]
+    cols = ['sku', 'produto', 'categoria', 'data_movimento', 'tipo_movimento', 'entrada', 'saida', 'saldo_apos', 'arquivo_origem', 'filial']
+    return df_save[[c for c in cols if c in df_save.columns]]
+
+
+def preparar_consumo_para_db(df_loaded):
+    """Mesmo recorte do botão '💾 CONFIRMAR: Salvar no DB' do consumo."""
+    df_to_save = pd.DataFrame()
+    df_to_save['data_consumo'] = df_loaded['Data']
+    df_to_save['produto'] = df_loaded['Nome Popular']
+    df_to_save['essencia'] = ""
+    df_to_save['volume'] = df_loaded['Quantidade']
+    df_to_save['documento'] = df_loaded['Motivo']
+    df_to_save['arquivo_origem'] = 'bench_consumo.xlsx'
+    df_json = df_loaded.assign(Data=df_loaded['Data'].astype(str))
+    df_to_save['dados_json'] = [json.dumps(r, default=str) for r in df_json.to_dict(orient='records')]
+    return df_to_save
+
+
+def executar(escala, repeticoes, backend='memoria'):
+    tam = {k: max(1, int(v * escala)) for k, v in TAMANHOS_BASE.items()}
+    caminho_sqlite = None
+    if backend == 'sqlite':
+        caminho_sqlite = os.path.join(tempfile.mkdtemp(prefix='bench_estoque_'), 'bench.sqlite')
+    pp = importar_app(backend, caminho_sqlite)
+    db = pp.db
+
+    print(f"Gerando dados sintéticos (escala {escala}): {tam}")
+    pdf_bytes = gerar_dados.gerar_pdf_sisflora(tam['sisflora_linhas']).getvalue()
+    html = gerar_dados.gerar_html_plenus(tam['plenus_skus'], tam['plenus_dias'])
+    df_transf_raw = gerar_dados.gerar_df_sistransf(tam['sistransf_transformacoes'], dias=tam['plenus_dias'])
+    consumo_bytes = gerar_dados.gerar_excel_consumo(tam['consumo_linhas'], dias=tam['plenus_dias']).getvalue()
+    for col in ["Volume Origem", "Volume Gerado"]:
+        df_transf_raw[col] = df_transf_raw[col].str.replace(",", ".").astype(float)
+
+    res = {}
+    print("Etapas:")
+
+    res['parse_sisflora_pdf'], df_sis = medir(pp, 'parse_sisflora_pdf', lambda: pp.extrair_dados_sisflora(io.BytesIO(pdf_bytes)),
+                                              repeticoes, preparar=pp.extrair_dados_sisflora.clear)
+    res['parse_plenus_html'], (df_ple, _, validacao_ple) = medir(pp, 'parse_plenus_html', lambda: pp.extrair_dados_plenus_html(html, "bench.html"),
+                                                                 repeticoes, preparar=pp.extrair_dados_plenus_html.clear)
+    # O HTML sintético fecha os saldos: qualquer SKU fora de "OK" é erro da conferência
+    if (validacao_ple['Status'] != "OK").any():
+        print(f"    AVISO: {int((validacao_ple['Status'] != 'OK').sum())} SKUs com saldo divergente no HTML sintético")
+    res['transform_sistransf'], df_transf = medir(pp, 'transform_sistransf', lambda: pp.transform_data_sistransf(df_transf_raw, "bench.xlsx"),
+                                                  repeticoes)
+    res['load_consumo_excel'], df_consumo_xls = medir(pp, 'load_consumo_excel', lambda: pp.load_data_consumo_excel(io.BytesIO(consumo_bytes)),
+                                                      repeticoes, preparar=pp.load_data_consumo_excel.clear)
+
+    agrup_sis, agrup_ple, vinculos = montar_agrupamentos(df_sis, df_ple, df_transf)
+    gravar_mapeamentos(db, agrup_sis, agrup_ple, vinculos)
+
+    df_ple_db = preparar_plenus_para_db(df_ple)
+    df_cons_db = preparar_consumo_para_db(df_consumo_xls)
+    limpar = lambda col: (lambda: db.limpar_colecao(col))
+    res['salvar_plenus'], _ = medir(pp, 'salvar_plenus', lambda: pp.salvar_lote_smart('plenus_historico', 'data_movimento', df_ple_db),
+                                    repeticoes, preparar=limpar('plenus_historico'))
+    # Importação diária: o banco já tem todos os dias menos o último; lê o mesmo HTML com corte,
+    # concilia a sobreposição e grava só o dia novo
+    corte = df_ple_db['data_movimento'].max()
+    corte = (pd.Timestamp(corte) - pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+    def preparar_incremental():
+        pp.extrair_dados_plenus_html.clear()
+        db.limpar_colecao('plenus_historico')
+        pp.salvar_lote_smart('plenus_historico', 'data_movimento', df_ple_db[df_ple_db['data_movimento'] <= corte])
+    def importar_incremental():
+        df_novo, _, validacao = pp.extrair_dados_plenus_html(html, "bench.html", corte)
+        pp.conciliar_sobreposicao_plenus(validacao, corte)
+        return pp.salvar_lote_smart('plenus_historico', 'data_movimento', preparar_plenus_para_db(df_novo))
+    res['importar_plenus_incremental'], _ = medir(pp, 'importar_plenus_incremental', importar_incremental,
+                                                  repeticoes, preparar=preparar_incremental)
+    res['salvar_transf'], _ = medir(pp, 'salvar_transf', lambda: pp.salvar_lote_smart('transf_historico', 'data_realizacao', df_transf),
+                                    repeticoes, preparar=limpar('transf_historico'))
+    res['salvar_consumo'], _ = medir(pp, 'salvar_consumo', lambda: pp.salvar_lote_smart('consumo_historico', 'data_consumo', df_cons_db),
+                                     repeticoes, preparar=limpar('consumo_historico'))
+
+    # Saldo Sisflora: 1º dia completo; 2º dia com ~2% das linhas alteradas vira delta
+    df_sis_dia2 = df_sis.copy()
+    df_sis_dia2.loc[df_sis_dia2.index[::50], 'Volume Disponivel'] += 1.0
+    dia1, dia2 = date(2024, 1, 1), date(2024, 1, 2)
+    def limpar_sisflora():
+        db.limpar_colecao('sisflora_historico')
+        db.limpar_colecao('sisflora_snapshots')
+    def preparar_delta():
+        limpar_sisflora()
+        pp.salvar_lote_sisflora_db(df_sis, dia1, "bench.pdf")
+    res['salvar_sisflora_completo'], _ = medir(pp, 'salvar_sisflora_completo', lambda: pp.salvar_lote_sisflora_db(df_sis, dia1, "bench.pdf"),
+                                               repeticoes, preparar=limpar_sisflora)
+    res['salvar_sisflora_delta'], _ = medir(pp, 'salvar_sisflora_delta', lambda: pp.salvar_lote_sisflora_db(df_sis_dia2, dia2, "bench2.pdf"),
+                                            repeticoes, preparar=preparar_delta)
+    res['carregar_sisflora_delta'], _ = medir(pp, 'carregar_sisflora_delta', lambda: pp.carregar_sisflora_data_db(dia2), repeticoes)
+
+    caminho_export = os.path.join(tempfile.gettempdir(), 'bench_export.xlsx')
+    res['exportar_xlsx'], _ = medir(pp, 'exportar_xlsx', lambda: pp.exportacao.exportar_arquivo(df_transf, 'xlsx', caminho_export),
+                                    repeticoes)
+    os.remove(caminho_export)
+
+    res['conferencia_saldo'], _ = medir(pp, 'conferencia_saldo',
+                                        lambda: pp.calcular_conferencia_saldo(df_sis, df_ple, agrup_sis, agrup_ple, vinculos), repeticoes)
+
+    # Agrupamento automático de todos os itens (como se nada estivesse agrupado)
+    pendentes = pd.concat([
+        pd.DataFrame({'Item_Completo': df_sis['Item_Completo'], 'Categoria': df_sis['Cat_Auto'], 'origem': 'SISFLORA'}),
+        pd.DataFrame({'Item_Completo': df_ple['Item_Completo'], 'Categoria': df_ple['categoria'], 'origem': 'PLENUS'})])
+    res['propor_agrupamentos'], _ = medir(pp, 'propor_agrupamentos', lambda: [
+        pp.propor_agrupamentos(grupo, origem) for origem, grupo in pendentes.groupby('origem')], repeticoes)
+
+    dt_ini = date(2024, 1, 1)
+    dt_fim = dt_ini + pd.Timedelta(days=tam['plenus_dias'])
+    espelho_ativo, pp.ESPELHO_ATIVO = pp.ESPELHO_ATIVO, False  # caminho direto no banco + pandas
+    res['auditoria_carga'], dados_aud = medir(pp, 'auditoria_carga', lambda: pp.carregar_dados_auditoria(dt_ini, dt_fim), repeticoes)
+    res['auditoria_calculo'], df_aud = medir(pp, 'auditoria_calculo',
+                                             lambda: pp.calcular_auditoria_fluxo(*dados_aud, agrup_sis, agrup_ple, vinculos), repeticoes)
+    res['serie_calculo'], df_serie = medir(pp, 'serie_calculo',
+                                           lambda: pp.calcular_serie_fluxo(*dados_aud, agrup_sis, agrup_ple, vinculos), repeticoes)
+    # Histórico com filtros: o plano manda ao banco o filtro mais seletivo que tem índice
+    filtros_transf = [{'col': 'Produto', 'vals': [df_transf['produto'].iloc[0]]},
+                      {'col': 'Situação', 'vals': [df_transf['situacao'].iloc[0]]}]
+    res['consulta_transf_filtrada'], df_filtrado = medir(
+        pp, 'consulta_transf_filtrada', lambda: pp.carregar_transf_filtrado_db(dt_ini, dt_fim, filtros_transf), repeticoes)
+    print(f"  consulta_transf_filtrada: {df_filtrado.attrs.get('plano_consulta')}")
+    pp.ESPELHO_ATIVO = espelho_ativo
+    if pp.obter_espelho() is not None:
+        def sincronizar():
+            return sum(pp.sincronizar_espelho(c, dt_ini, dt_fim) for c in pp.analitico.COLECOES_ESPELHO)
+        res['espelho_sync'], _ = medir(pp, 'espelho_sync', sincronizar, repeticoes, preparar=lambda: pp.obter_espelho().invalidar())
+        res['auditoria_sql'], df_aud_sql = medir(pp, 'auditoria_sql',
+                                                 lambda: pp.calcular_auditoria_fluxo_sql(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos), repeticoes)
+        conferir_auditorias(df_aud, df_aud_sql)
+        res['serie_sql'], df_serie_sql = medir(pp, 'serie_sql',
+                                               lambda: pp.carregar_serie_fluxo(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos), repeticoes)
+        conferir_series(df_serie, df_serie_sql, df_aud)
+
+    return {
+        'quando': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit_atual(),
+        'escala': escala,
+        'backend': backend,
+        'tamanhos': tam,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'resultados': res,
+    }
+
+
+def conferir_auditorias(df_pandas, df_sql):
+    """A auditoria em SQL tem que bater com a de pandas (mesmos grupos e valores)."""
+    a = df_pandas.sort_values('Grupo').reset_index(drop=True)
+    b = df_sql.sort_values('Grupo').reset_index(drop=True)[a.columns] if not df_sql.empty else df_sql
+    try:
+        pd.testing.assert_frame_equal(a, b, check_dtype=False, atol=1e-6)
+        print("  auditoria_sql confere com auditoria_calculo")
+    except AssertionError as e:
+        print(f"  ATENÇÃO: auditoria_sql difere de auditoria_calculo:\n{e}")
+
+
+def conferir_series(df_pandas, df_sql, df_aud):
+    """Série diária de tendências: SQL (agregados_diarios) = pandas, e a soma por grupo = auditoria."""
+    chaves = ['Periodo', 'Grupo']
+    a = df_pandas.sort_values(chaves).reset_index(drop=True)
+    b = df_sql.sort_values(chaves).reset_index(drop=True)[a.columns]
+    # A auditoria descarta grupos com tudo zerado; a série pode ter dias zerados
+    somas = a.groupby('Grupo')[['Sis_Ent', 'Sis_Sai', 'Ple_Ent', 'Ple_Sai']].sum()
+    somas = somas[somas.abs().max(axis=1) > 0.0001].sort_index()
+    aud = df_aud.set_index('Grupo')[somas.columns].sort_index()
+    try:
+        pd.testing.assert_frame_equal(a, b, check_dtype=False, atol=1e-6)
+        pd.testing.assert_frame_equal(somas, aud, check_dtype=False, atol=1e-6)
+        print("  serie_sql confere com serie_calculo e com a auditoria")
+    except AssertionError as e:
+        print(f"  ATENÇÃO: séries de tendência divergem:\n{e}")
+
+
+def _commit_atual():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, text=True).strip()
+    except Exception:
+        return None
+
+
+def comparar(atual, base, tolerancia):
+    """Imprime a variação por etapa; devolve as etapas que pioraram além da tolerância."""
+    piores = []
+    print(f"\nComparação com {base.get('commit')} ({base.get('quando')}):")
+    for etapa, r in atual['resultados'].items():
+        ref = base.get('resultados', {}).get(etapa)
+        if not ref or not ref['segundos_mediana']:
+            print(f"  {etapa:<28} (sem base)")
+            continue
+        var = r['segundos_mediana'] / ref['segundos_mediana'] - 1
+        marca = "  ⚠️ REGRESSÃO" if var > tolerancia else ""
+        print(f"  {etapa:<28} {ref['segundos_mediana']:>9.4f}s -> {r['segundos_mediana']:>9.4f}s ({var:+.0%}){marca}")
+        if var > tolerancia: piores.append(etapa)
+    return piores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--escala', type=float, default=1.0, help="multiplicador dos tamanhos base")
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--saida', default=None, help="arquivo JSON de resultados")
+    parser.add_argument('--comparar', default=None, help="JSON de uma execução anterior")
+    parser.add_argument('--backend', choices=['memoria', 'sqlite'], default='memoria',
+                        help="backend local usado no lugar do Firestore")
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="piora aceitável antes de acusar regressão")
+    args = parser.parse_args()
+
+    resultado = executar(args.escala, args.repeticoes, args.backend)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados gravados em {args.saida}")
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)
+        if base.get('escala') != resultado['escala']:
+            print(f"⚠️ Escalas diferentes ({base.get('escala')} x {resultado['escala']}): comparação só indicativa.")
+        if comparar(resultado, base, args.tolerancia): sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
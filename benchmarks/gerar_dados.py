@@ -0,0 +1,150 @@
+"""Geradores de arquivos sintéticos no formato dos exports reais.
+
+- PDF de saldo Sisflora (tabela Produto / Essência / Unidade / Volume)
+- HTML do Plenus com o layout de classes s29 (categoria), s12 (produto),
+  s13 (data), s14 (tipo), s15/s16/s17 (entrada/saída/saldo)
+- Excel do SISTRANSF (COLS_SISTRANSF_EXCEL) e planilha do SISCONSUMO
+
+Tudo é determinístico a partir da semente, para que duas execuções do
+benchmark meçam exatamente os mesmos dados.
+"""
+import io
+import random
+from datetime import date, timedelta
+
+import pandas as pd
+
+PRODUTOS_SISFLORA = [
+    "10 - TORAS DE MADEIRA NATIVA", "20 - MADEIRA SERRADA EM BRUTO",
+    "3030 - MADEIRA SERRADA APROVEITAMENTO", "50 - MADEIRA BENEFICIADA",
+    "40 - LENHA",  # código fora de codigos_aceitos (regras_classificacao.json): o parser descarta
+]
+ESSENCIAS = [
+    ("Handroanthus serratifolius", "IPÊ"), ("Dipteryx odorata", "CUMARU"), ("Hymenaea courbaril", "JATOBÁ"),
+    ("Manilkara huberi", "MAÇARANDUBA"), ("Cedrela odorata", "CEDRO"), ("Apuleia leiocarpa", "GARAPEIRA"),
+    ("Mezilaurus itauba", "ITAÚBA"), ("Qualea paraensis", "CAMBARÁ"), ("Erisma uncinatum", "CEDRINHO"),
+    ("Goupia glabra", "CUPIÚBA"), ("Astronium lecointei", "MUIRACATIARA"), ("Tabebuia impetiginosa", "IPÊ ROXO"),
+]
+SUFIXOS_ESSENCIA = ["", "", "", " CCSEMA - 1234", " PMFS 123/2021", " AUTEX", " GERAL ST 12,5"]
+PRODUTOS_PLENUS = [
+    ("SERRADA", ["TABUA", "VIGA", "CAIBRO", "PRANCHA", "RIPA"]),
+    ("TORAS", ["TORA", "TORO"]),
+    ("BENEFICIADA", ["DECK", "FORRO", "ASSOALHO", "BENEF"]),
+]
+SITUACOES = ["Realizada", "Realizada", "Realizada", "Cancelada"]
+
+
+def fmt_br(valor, casas=4):
+    return f"{valor:,.{casas}f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def gerar_pdf_sisflora(n_linhas, semente=42):
+    """PDF de saldo com n_linhas itens (com quebras de essência em 2 linhas, como no real)."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet
+
+    rnd = random.Random(semente)
+    linhas = [["Produto", "Essência", "Unidade", "Volume Disponível"]]
+    for _ in range(n_linhas):
+        produto = rnd.choice(PRODUTOS_SISFLORA)
+        cientifico, popular = rnd.choice(ESSENCIAS)
+        essencia = f"{cientifico} - {popular}{rnd.choice(SUFIXOS_ESSENCIA)}"
+        volume = fmt_br(rnd.uniform(0, 5000))
+        if rnd.random() < 0.1:
+            # Essência longa quebrada: a 2ª linha vem sem produto (o parser concatena)
+            corte = len(cientifico)
+            linhas.append([produto, essencia[:corte], "M3", volume])
+            linhas.append(["", essencia[corte:].strip(), "", ""])
+        else:
+            linhas.append([produto, essencia, "M3", volume])
+
+    saida = io.BytesIO()
+    doc = SimpleDocTemplate(saida, pagesize=landscape(A4))
+    tabela = LongTable(linhas, repeatRows=1, colWidths=[220, 300, 60, 120])
+    tabela.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+        ('FONTSIZE', (0, 0), (-1, -1), 7),
+    ]))
+    estilos = getSampleStyleSheet()
+    doc.build([Paragraph("GOVERNO DO ESTADO - SISFLORA - Saldo de Produtos", estilos['Title']), tabela])
+    saida.seek(0)
+    return saida
+
+
+def gerar_html_plenus(n_skus, dias, movimentos_por_dia=2, data_inicio=date(2024, 1, 1), semente=42):
+    """HTML do relatório de movimentação do Plenus com saldos consistentes por SKU."""
+    rnd = random.Random(semente)
+    partes = ["<html><body><table>"]
+    skus_por_categoria = {}
+    for i in range(n_skus):
+        categoria, tipos = PRODUTOS_PLENUS[i % len(PRODUTOS_PLENUS)]
+        skus_por_categoria.setdefault(categoria, []).append((f"{1000 + i}", f"{rnd.choice(tipos)} {rnd.choice(ESSENCIAS)[1]} {i}"))
+
+    for categoria, skus in skus_por_categoria.items():
+        partes.append(f'<tr><td class="s29">Categoria: {categoria}</td></tr>')
+        for sku, nome in skus:
+            partes.append(f'<tr><td class="s12">{sku} - {nome}</td></tr>')
+            saldo = rnd.uniform(10, 500)
+            partes.append(f'<tr><td class="s13"></td><td class="s14">Anterior:</td><td class="s15"></td>'
+                          f'<td class="s16"></td><td class="s17">{fmt_br(saldo)}</td></tr>')
+            for d in range(dias):
+                data_txt = (data_inicio + timedelta(days=d)).strftime("%d/%m/%Y")
+                for _ in range(movimentos_por_dia):
+                    if rnd.random() < 0.5:
+                        ent, sai, tipo = rnd.uniform(0, 20), 0.0, "Entrada"
+                    else:
+                        ent, sai, tipo = 0.0, min(rnd.uniform(0, 20), saldo), "Saída"
+                    saldo = saldo + ent - sai
+                    partes.append(f'<tr><td class="s13">{data_txt}</td><td class="s14">{tipo}</td>'
+                                  f'<td class="s15">{fmt_br(ent)}</td><td class="s16">{fmt_br(sai)}</td>'
+                                  f'<td class="s17">{fmt_br(saldo)}</td></tr>')
+            partes.append(f'<tr><td class="s13"></td><td class="s25">Total:</td><td class="s21"></td>'
+                          f'<td class="s22"></td><td class="s23">{fmt_br(saldo)}</td></tr>')
+    partes.append("</table></body></html>")
+    return "\n".join(partes)
+
+
+def gerar_df_sistransf(n_transformacoes, data_inicio=date(2024, 1, 1), dias=30, semente=42):
+    """DataFrame com as colunas do Excel do SISTRANSF (tudo texto, como lido com dtype=str)."""
+    rnd = random.Random(semente)
+    linhas = []
+    for i in range(n_transformacoes):
+        cientifico, popular = rnd.choice(ESSENCIAS)
+        data_txt = (data_inicio + timedelta(days=rnd.randrange(dias))).strftime("%d/%m/%Y")
+        vol_origem = rnd.uniform(1, 50)
+        linhas.append({
+            "Número": str(100000 + i), "Data Realização": data_txt, "Situação": rnd.choice(SITUACOES),
+            "Produto Origem": "TORAS DE MADEIRA NATIVA", "Essência Origem": f"{cientifico} - {popular}",
+            "Volume Origem": fmt_br(vol_origem, 4).replace(".", ""), "Unidade Origem": "M3",
+            "Produto Gerado": rnd.choice(["MADEIRA SERRADA EM BRUTO", "MADEIRA SERRADA APROVEITAMENTO", ""]),
+            "Essência Gerada": f"{cientifico} - {popular}",
+            "Volume Gerado": fmt_br(vol_origem * 0.45, 4).replace(".", ""), "Unidade Gerada": "M3",
+        })
+    return pd.DataFrame(linhas)
+
+
+def gerar_excel_sistransf(n_transformacoes, **kwargs):
+    saida = io.BytesIO()
+    gerar_df_sistransf(n_transformacoes, **kwargs).to_excel(saida, index=False)
+    saida.seek(0)
+    return saida
+
+
+def gerar_excel_consumo(n_linhas, data_inicio=date(2024, 1, 1), dias=30, semente=42):
+    """Planilha do SISCONSUMO: 1ª linha é título, cabeçalho na 2ª (lida com header=1)."""
+    rnd = random.Random(semente)
+    linhas = []
+    for i in range(n_linhas):
+        linhas.append({
+            "Data": data_inicio + timedelta(days=rnd.randrange(dias)),
+            "Nome Popular": rnd.choice(ESSENCIAS)[1], "Quantidade": round(rnd.uniform(0.1, 30), 4),
+            "Motivo": rnd.choice(["CONSUMO PRÓPRIO", "PERDA", "QUEIMA"]), "Documento": f"DC-{i}",
+        })
+    saida = io.BytesIO()
+    with pd.ExcelWriter(saida, engine='openpyxl') as writer:
+        pd.DataFrame([["RELATÓRIO DE CONSUMO"]]).to_excel(writer, index=False, header=False, startrow=0)
+        pd.DataFrame(linhas).to_excel(writer, index=False, startrow=1)
+    saida.seek(0)
+    return saida
@@ -0,0 +1,209 @@
+"""Confere as versões em lote (vetorizadas) contra as funções escalares originais do painel.
+
+Uso (a partir da raiz do repositório):
+
+    python benchmarks/verificar_equivalencias.py --linhas 500000 --semente 42
+
+Para cada par gera entradas aleatórias (valores dos geradores sintéticos, casos de
+borda e lixo), compara linha a linha a saída em lote com a da função escalar e mede
+o tempo das duas. Sai com código 1 se alguma divergir. No fim mede a renderização de
+uma tabela de --linhas-tabela linhas (Styler x preparar_exibicao).
+"""
+import argparse
+import random
+import sys
+import time
+
+import pandas as pd
+
+from executar_benchmark import importar_app
+import gerar_dados
+
+
+def _cronometrar(func):
+    t0 = time.perf_counter()
+    res = func()
+    return res, time.perf_counter() - t0
+
+
+def _comparar(nome, esperado, obtido, t_escalar, t_lote):
+    esperado, obtido = pd.Series(list(esperado)), pd.Series(list(obtido))
+    iguais = (esperado == obtido) | (esperado.isna() & obtido.isna())
+    divergentes = int((~iguais).sum())
+    ganho = t_escalar / t_lote if t_lote else float('inf')
+    print(f"  {nome:<28} escalar {t_escalar:>8.3f}s  lote {t_lote:>7.3f}s  ({ganho:>5.1f}x)  divergências={divergentes}")
+    for i in esperado.index[~iguais][:5]:
+        print(f"      linha {i}: escalar={esperado[i]!r} lote={obtido[i]!r}")
+    return divergentes == 0
+
+
+def itens_sisflora(n, rnd):
+    extras = ["", "3030", "1", "5O - ERRO", "nan", "  10 - TORAS"]
+    itens = []
+    for _ in range(n):
+        if rnd.random() < 0.05:
+            itens.append(rnd.choice(extras))
+        else:
+            produto = rnd.choice(gerar_dados.PRODUTOS_SISFLORA)
+            itens.append(f"{produto} - {rnd.choice(gerar_dados.ESSENCIAS)[1]}")
+    return itens
+
+
+def itens_plenus(n, rnd):
+    extras = ["", "deck ipê", "Tora-Toro", "VIGOTA", "SERRADINHO", "X (OUTROS)"]
+    itens = []
+    for i in range(n):
+        if rnd.random() < 0.05:
+            itens.append(rnd.choice(extras))
+        else:
+            categoria, tipos = rnd.choice(gerar_dados.PRODUTOS_PLENUS)
+            itens.append(f"{rnd.choice(tipos)} {rnd.choice(gerar_dados.ESSENCIAS)[1]} {i % 300} ({categoria})")
+    return itens
+
+
+def categoria_original(item, origem):
+    """Cadeia if/elif que existia antes de regras_classificacao.json (referência fixa)."""
+    txt = str(item)
+    if origem == "SISFLORA":
+        if txt.startswith("10"): return "TORAS"
+        if txt.startswith("20") or txt.startswith("3030"): return "SERRADAS"
+        if txt.startswith("50"): return "BENEFICIADAS"
+        return "OUTROS"
+    txt = txt.upper()
+    if any(t in txt for t in ("BENEF", "DECK", "FORRO", "ASSOALHO")): return "BENEFICIADAS"
+    if any(t in txt for t in ("TORA", "TORO")): return "TORAS"
+    if any(t in txt for t in ("SERRAD", "CAIBRO", "VIGA", "PRANCH", "RIPA")): return "SERRADAS"
+    return "OUTROS"
+
+
+def verificar_categorias(pp, n, rnd):
+    """Motor de regras (arquivo padrão) contra a cadeia original, em lote e item a item."""
+    ok = True
+    for origem, gerar in (("SISFLORA", itens_sisflora), ("PLENUS", itens_plenus)):
+        itens = pd.Series(gerar(n, rnd))
+        esperado, t_esc = _cronometrar(lambda: itens.apply(lambda x: categoria_original(x, origem)))
+        obtido, t_lote = _cronometrar(lambda: pp.detectar_categorias(itens, origem))
+        ok &= _comparar(f"categoria {origem.lower()}", esperado, obtido, t_esc, t_lote)
+        amostra = itens.head(20_000)
+        ok &= bool((amostra.apply(lambda x: pp.detecting_category(x, origem)) == esperado.head(20_000)).all())
+        # Coluna category (como vem do banco) tem que dar o mesmo resultado
+        obtido_cat = pp.detectar_categorias(itens.astype('category'), origem)
+        ok &= bool((obtido_cat.to_numpy() == obtido.to_numpy()).all())
+    return ok
+
+
+def verificar_item_completo(pp, n, rnd):
+    # Sem nulos: no escalar essência nula virava "produto - nan" (o lote segue o SQL e trata como vazia)
+    df = pd.DataFrame({
+        'Produto': [rnd.choice(gerar_dados.PRODUTOS_SISFLORA) for _ in range(n)],
+        'Essencia': [rnd.choice([e[1] for e in gerar_dados.ESSENCIAS] + [""]) for _ in range(n)],
+    })
+    escalar = lambda x: f"{x['Produto']} - {x['Essencia']}" if x['Essencia'] else x['Produto']
+    esperado, t_esc = _cronometrar(lambda: df.apply(escalar, axis=1))
+    obtido, t_lote = _cronometrar(lambda: pp.montar_item_completo(df['Produto'], df['Essencia']))
+    return _comparar("Item_Completo", esperado, obtido, t_esc, t_lote)
+
+
+LIXO_NUMERICO = ["abc", "1.234.567", "1,2,3", "--1", "R$ 10", "12 m3", "1,5e3x", "None", "-"]
+ESPECIAIS_NUMERICOS = ["", "   ", "nan", "inf", "-Infinity", "1_000", "1e5", "+3,0", "-0,0001", ".5", "5.", " 12,5 ",
+                       None, float('nan'), True, 0, 7, 2.5, -1e-7, 10 ** 20]
+
+
+def textos_numericos(n, rnd):
+    """Células como as dos PDFs/HTMLs: BR com e sem milhar, floats simples, especiais e lixo."""
+    valores = []
+    for _ in range(n):
+        sorteio = rnd.random()
+        numero = rnd.uniform(-1e6, 1e6) * 10 ** rnd.randint(-6, 0)
+        if sorteio < 0.55: valores.append(gerar_dados.fmt_br(numero, rnd.randint(0, 6)))
+        elif sorteio < 0.75: valores.append(gerar_dados.fmt_br(numero, rnd.randint(0, 6)).replace(".", ""))
+        elif sorteio < 0.90: valores.append(repr(numero))
+        elif sorteio < 0.96: valores.append(rnd.choice(ESPECIAIS_NUMERICOS))
+        else: valores.append(rnd.choice(LIXO_NUMERICO))
+    return valores
+
+
+def verificar_numeros_br(pp, n, rnd):
+    """Propriedades: mesmo valor que parse_float_inteligente em toda célula (lote e escalar rápido);
+    inválida só onde o original devolvia 0.0, e todo lixo conhecido aparece como inválido."""
+    serie = pd.Series(textos_numericos(n, rnd), dtype=object)
+    esperado, t_esc = _cronometrar(lambda: serie.apply(pp.parse_float_inteligente))
+    (obtido, invalidos), t_lote = _cronometrar(lambda: pp.converter_numeros_br(serie))
+    ok = _comparar("parse_float (lote)", esperado, obtido, t_esc, t_lote)
+    rapido, t_rap = _cronometrar(lambda: [pp.parse_float_br(v)[0] for v in serie])
+    ok &= _comparar("parse_float (escalar rápido)", esperado, rapido, t_esc, t_rap)
+
+    eh_lixo = serie.isin(LIXO_NUMERICO)
+    marcadas = serie.index.isin(invalidos.index)
+    ok &= bool((esperado[marcadas] == 0.0).all())
+    ok &= bool(marcadas[eh_lixo.to_numpy()].all())
+    ok &= bool((pd.Series([not pp.parse_float_br(v)[1] for v in serie]) == marcadas).all())
+    # Coluna já numérica passa direto
+    numeros = pd.Series([rnd.uniform(0, 100) for _ in range(1000)])
+    ok &= bool((pp.converter_numeros_br(numeros)[0] == numeros).all())
+    print(f"  {'células inválidas':<28} {int(marcadas.sum())} marcadas ({int(eh_lixo.sum())} de lixo conhecido)  {'ok' if ok else 'FALHOU'}")
+    return ok
+
+
+def verificar_formatacao_br(pp, n, rnd):
+    numeros = [rnd.uniform(-1e6, 1e6) * 10 ** rnd.randint(-6, 0) for _ in range(n)]
+    numeros[:6] = [0.0, -0.0, 0.00005, -0.00005, 1e15, 123456789.12345]
+    serie = pd.Series(numeros)
+    esperado, t_esc = _cronometrar(lambda: serie.apply(pp.formatar_br))
+    obtido, t_lote = _cronometrar(lambda: pp.formatar_br_series(serie))
+    ok = _comparar("formatar_br", esperado, obtido, t_esc, t_lote)
+    # Inteiros e nulos (nulo vira vazio na tabela)
+    inteiros = pd.Series([rnd.randint(-10 ** 9, 10 ** 9) for _ in range(1000)])
+    ok &= bool((pp.formatar_br_series(inteiros) == inteiros.map(lambda v: pp.formatar_br(int(v)))).all())
+    ok &= pp.formatar_br_series(pd.Series([1.5, None])).tolist() == ["1,5000", ""]
+    return ok
+
+
+VERIFICACOES = [verificar_categorias, verificar_item_completo, verificar_numeros_br, verificar_formatacao_br]
+
+
+def medir_renderizacao(pp, n, rnd):
+    """Tempo do st.dataframe (serialização no servidor) com a tabela do movimento Plenus:
+    Styler com formatar_br por célula (como era) x colunas preparadas por preparar_exibicao."""
+    import streamlit as st
+    dias = pd.to_datetime("2024-01-01") + pd.to_timedelta([rnd.randrange(365) for _ in range(n)], unit='D')
+    df = pd.DataFrame({
+        'data': dias.strftime("%d/%m/%Y"), 'sku': [str(rnd.randrange(1, 5000)) for _ in range(n)],
+        'produto': [rnd.choice(gerar_dados.PRODUTOS_SISFLORA) for _ in range(n)],
+        'categoria': pd.Categorical([rnd.choice(["TORAS", "SERRADAS", "BENEFICIADAS"]) for _ in range(n)]),
+        'tipo': "Entrada",
+        'entrada': [rnd.uniform(0, 100) for _ in range(n)], 'saida': [rnd.uniform(0, 100) for _ in range(n)],
+        'saldo': [rnd.uniform(-500, 5000) for _ in range(n)],
+    })
+    print(f"Renderização ({n} linhas x {len(df.columns)} colunas):")
+    # O Streamlit recusa Styler acima de styler.render.max_elements (262.144 células por padrão)
+    with pd.option_context("styler.render.max_elements", df.size + 1):
+        _, t_styler = _cronometrar(lambda: st.dataframe(df.style.format(
+            {'entrada': pp.formatar_br, 'saida': pp.formatar_br, 'saldo': pp.formatar_br})))
+    print(f"  {'Styler (antes)':<28} {t_styler:>8.3f}s")
+    for modo in ('navegador', 'br'):
+        def renderizar():
+            df_exib, col_config = pp.preparar_exibicao(df, modo)
+            st.dataframe(df_exib, column_config=col_config)
+        _, t_modo = _cronometrar(renderizar)
+        print(f"  {'preparar_exibicao ' + modo:<28} {t_modo:>8.3f}s  ({t_styler / t_modo:>6.1f}x)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--linhas', type=int, default=500_000)
+    ap.add_argument('--semente', type=int, default=42)
+    ap.add_argument('--linhas-tabela', type=int, default=100_000, help="linhas da medição de renderização (0 = pular)")
+    args = ap.parse_args()
+
+    pp = importar_app('memoria')
+    rnd = random.Random(args.semente)
+    print(f"Equivalências ({args.linhas} linhas, semente {args.semente}):")
+    ok = all([verificar(pp, args.linhas, rnd) for verificar in VERIFICACOES])
+    if args.linhas_tabela: medir_renderizacao(pp, args.linhas_tabela, rnd)
+    print("OK" if ok else "DIVERGÊNCIAS ENCONTRADAS")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
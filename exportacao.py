@@ -0,0 +1,171 @@
+"""Exportação de relatórios em fluxo: Excel (xlsxwriter), CSV e Parquet.
+
+O Excel é escrito em modo constant_memory: cada linha vai direto para o XML
+da planilha (em arquivo temporário) e sai da memória, em vez de montar a pasta
+de trabalho inteira antes de salvar. As linhas vêm de um gerador que percorre
+o DataFrame em blocos, e a largura das colunas é estimada por uma amostra.
+
+Acima do limite de linhas do Excel (ou quando pedido), o relatório sai em
+Parquet (se pyarrow estiver instalado) ou CSV, também escritos bloco a bloco.
+"""
+import os
+import tempfile
+from datetime import date, datetime
+
+import pandas as pd
+import xlsxwriter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # sem pyarrow a alternativa para arquivos grandes é o CSV
+    pa = pq = None
+
+# Uma planilha do Excel tem 1.048.576 linhas, uma delas é o cabeçalho
+MAX_LINHAS_XLSX = 1_048_575
+TAMANHO_BLOCO = 50_000
+AMOSTRA_LARGURAS = 500
+LARGURA_MIN, LARGURA_MAX = 8, 60
+
+FORMATOS = {
+    'xlsx': {'rotulo': 'Excel', 'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'csv': {'rotulo': 'CSV', 'mime': 'text/csv'},
+    'parquet': {'rotulo': 'Parquet', 'mime': 'application/vnd.apache.parquet'},
+}
+TIPOS_XLSX = (str, int, float, bool, datetime, date)
+
+
+def formatos_disponiveis():
+    return [f for f in FORMATOS if f != 'parquet' or pq is not None]
+
+
+def escolher_formato(n_linhas, pedido='auto', max_linhas_xlsx=MAX_LINHAS_XLSX):
+    """Formato efetivo: Excel até o limite de linhas; acima dele, Parquet (ou CSV sem pyarrow)."""
+    grande = 'parquet' if pq is not None else 'csv'
+    if pedido == 'auto' or pedido not in formatos_disponiveis():
+        return 'xlsx' if n_linhas <= max_linhas_xlsx else grande
+    if pedido == 'xlsx' and n_linhas > max_linhas_xlsx:
+        return grande
+    return pedido
+
+
+def blocos_df(df, tamanho=TAMANHO_BLOCO):
+    """Fatias consecutivas do DataFrame (views, sem cópia do todo)."""
+    for inicio in range(0, len(df), tamanho):
+        yield df.iloc[inicio:inicio + tamanho]
+
+
+def larguras_por_amostra(df, amostra=AMOSTRA_LARGURAS):
+    """Largura de cada coluna pelo maior texto entre o cabeçalho e as primeiras linhas."""
+    trecho = df.head(amostra)
+    larguras = []
+    for col in df.columns:
+        serie = trecho[col]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            maior = 10
+        elif pd.api.types.is_float_dtype(serie):
+            # Excel mostra com separador de milhar e 4 casas
+            maior = len(f"{serie.abs().max():,.4f}") if serie.notna().any() else 0
+        else:
+            maior = int(serie.astype(str).str.len().max()) if len(serie) else 0
+        larguras.append(min(max(maior, len(str(col)), LARGURA_MIN) + 2, LARGURA_MAX))
+    return larguras
+
+
+def _valores_xlsx(bloco):
+    """Bloco -> listas por coluna com objetos Python que o xlsxwriter aceita (nulos viram None)."""
+    colunas = []
+    for col in bloco.columns:
+        serie = bloco[col]
+        if serie.dtype == object:
+            # Firestore pode trazer listas/dicionários: vão como texto
+            nulos = serie.isna().tolist()
+            colunas.append([None if nulo else (v if isinstance(v, TIPOS_XLSX) else str(v))
+                            for v, nulo in zip(serie.tolist(), nulos)])
+        else:
+            colunas.append(serie.astype(object).where(serie.notna(), None).tolist())
+    return colunas
+
+
+def linhas_xlsx(blocos):
+    """Gera as linhas (tuplas) de cada bloco, uma por vez."""
+    for bloco in blocos:
+        yield from zip(*_valores_xlsx(bloco))
+
+
+def escrever_xlsx(destino, colunas, linhas, larguras=None, formatos_coluna=None, nome_aba='Relatorio'):
+    """Escreve linhas de um gerador numa planilha em constant_memory. Devolve o nº de linhas."""
+    wb = xlsxwriter.Workbook(destino, {'constant_memory': True, 'remove_timezone': True,
+                                       'tmpdir': tempfile.gettempdir()})
+    try:
+        ws = wb.add_worksheet(nome_aba)
+        negrito = wb.add_format({'bold': True})
+        estilos = {'numero': wb.add_format({'num_format': '#,##0.0000'}),
+                   'data': wb.add_format({'num_format': 'dd/mm/yyyy'})}
+        for i in range(len(colunas)):
+            fmt = estilos.get((formatos_coluna or {}).get(i))
+            ws.set_column(i, i, larguras[i] if larguras else 20, fmt)
+        ws.write_row(0, 0, [str(c) for c in colunas], negrito)
+        ws.freeze_panes(1, 0)
+        n = 0
+        for n, linha in enumerate(linhas, start=1):
+            ws.write_row(n, 0, linha)
+        if n: ws.autofilter(0, 0, n, len(colunas) - 1)
+    finally:
+        wb.close()
+    return n
+
+
+def escrever_csv(destino, blocos):
+    """CSV no padrão do Excel em português (';' e vírgula decimal), bloco a bloco."""
+    n = 0
+    with open(destino, 'w', encoding='utf-8-sig', newline='') as arq:
+        for i, bloco in enumerate(blocos):
+            bloco.to_csv(arq, sep=';', decimal=',', index=False, header=(i == 0), date_format='%d/%m/%Y')
+            n += len(bloco)
+    return n
+
+
+def escrever_parquet(destino, blocos):
+    """Parquet com um row group por bloco (esquema fixado pelo primeiro)."""
+    escritor, n = None, 0
+    try:
+        for bloco in blocos:
+            # Colunas de texto misto (ex.: números e textos do Firestore) viram string
+            bloco = bloco.astype({c: 'string' for c in bloco.columns if bloco[c].dtype == object})
+            tabela = pa.Table.from_pandas(bloco, preserve_index=False,
+                                          schema=escritor.schema if escritor else None)
+            if escritor is None: escritor = pq.ParquetWriter(destino, tabela.schema)
+            escritor.write_table(tabela)
+            n += len(bloco)
+    finally:
+        if escritor is not None: escritor.close()
+    return n
+
+
+def exportar_arquivo(df, formato, destino, nome_aba='Relatorio', tamanho_bloco=TAMANHO_BLOCO):
+    """Grava df em destino no formato pedido ('xlsx', 'csv' ou 'parquet'). Devolve o nº de linhas."""
+    if formato == 'csv': return escrever_csv(destino, blocos_df(df, tamanho_bloco))
+    if formato == 'parquet':
+        if pq is None: raise RuntimeError("pyarrow não está instalado")
+        return escrever_parquet(destino, blocos_df(df, tamanho_bloco))
+    if len(df) > MAX_LINHAS_XLSX:
+        raise ValueError(f"{len(df)} linhas não cabem numa planilha do Excel (máx. {MAX_LINHAS_XLSX})")
+    formatos_coluna = {}
+    for i, col in enumerate(df.columns):
+        if pd.api.types.is_datetime64_any_dtype(df[col]): formatos_coluna[i] = 'data'
+        elif pd.api.types.is_float_dtype(df[col]): formatos_coluna[i] = 'numero'
+    return escrever_xlsx(destino, list(df.columns), linhas_xlsx(blocos_df(df, tamanho_bloco)),
+                         larguras_por_amostra(df), formatos_coluna, nome_aba)
+
+
+def exportar_bytes(df, formato, **kwargs):
+    """Gera o arquivo num temporário e devolve o conteúdo (para o st.download_button)."""
+    fd, caminho = tempfile.mkstemp(prefix='estoque_export_', suffix=f'.{formato}')
+    os.close(fd)
+    try:
+        exportar_arquivo(df, formato, caminho, **kwargs)
+        with open(caminho, 'rb') as arq:
+            return arq.read()
+    finally:
+        os.remove(caminho)
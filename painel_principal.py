@@ -4,84 +4,800 @@ import pandas as pd
 import plotly.express as px
 import re
 import io
+import os
 import json
 import time
+import tempfile
+import threading
+import bisect
+import functools
+import itertools
+import traceback
+import uuid
+import unicodedata
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from bs4 import BeautifulSoup
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 from difflib import SequenceMatcher
 
 # --- FIREBASE IMPORTS ---
 import firebase_admin
 from firebase_admin import credentials, firestore
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+import analitico
+import armazenamento
+import exportacao
+import regras
 
 # --- CONFIGURAÇÃO ---
 st.set_page_config(page_title="🌲 Sistema S&P - Web Firebase", layout="wide")
 
-# --- INICIALIZAÇÃO FIREBASE ---
-# Verifica se já inicializou para não dar erro de "App already exists"
-if not firebase_admin._apps:
-    # Tenta pegar das secrets do Streamlit (Produção)
-    if 'firebase' in st.secrets:
-        cred_dict = dict(st.secrets['firebase'])
-        cred = credentials.Certificate(cred_dict)
-    # Senão, tenta pegar arquivo local (Desenvolvimento)
-    else:
-        try:
-            cred = credentials.Certificate("serviceAccountKey.json")
-        except:
-            st.error("❌ Arquivo 'serviceAccountKey.json' não encontrado e secrets não configuradas.")
-            st.stop()
-    
-    firebase_admin.initialize_app(cred)
+def config_app(chave, padrao=None):
+    """Lê configuração da variável ESTOQUE_<CHAVE> ou da seção [app] das secrets."""
+    val = os.environ.get(f"ESTOQUE_{chave.upper()}")
+    if val is not None: return val
+    try:
+        if 'app' in st.secrets and chave in st.secrets['app']:
+            return st.secrets['app'][chave]
+    except Exception: pass
+    return padrao
+
+# --- INICIALIZAÇÃO DO BANCO ---
+# "firestore" (padrão, produção) ou um backend local de armazenamento.py: "memoria" / "sqlite"
+BACKEND_DADOS = str(config_app('backend', 'firestore')).strip().lower()
+
+@st.cache_resource
+def conectar_backend_local(tipo, caminho_sqlite):
+    # cache_resource: o mesmo banco local é compartilhado por todas as sessões e reruns
+    return armazenamento.criar_backend(tipo, caminho_sqlite)
+
+if BACKEND_DADOS in armazenamento.BACKENDS_LOCAIS:
+    db = conectar_backend_local(BACKEND_DADOS, config_app('sqlite_caminho', 'estoque_local.sqlite'))
+else:
+    # Verifica se já inicializou para não dar erro de "App already exists"
+    if not firebase_admin._apps:
+        # Tenta pegar das secrets do Streamlit (Produção)
+        if 'firebase' in st.secrets:
+            cred_dict = dict(st.secrets['firebase'])
+            cred = credentials.Certificate(cred_dict)
+        # Senão, tenta pegar arquivo local (Desenvolvimento)
+        else:
+            try:
+                cred = credentials.Certificate("serviceAccountKey.json")
+            except:
+                st.error("❌ Arquivo 'serviceAccountKey.json' não encontrado e secrets não configuradas.")
+                st.stop()
+        
+        firebase_admin.initialize_app(cred)
+
+    db = firestore.client()
+
+# --- UNIDADES (FILIAIS) ---
+# Cada unidade (serraria / CNPJ) tem seu próprio histórico: as coleções de COLECOES_POR_UNIDADE
+# ficam em unidades/{filial}/{colecao} e todo documento gravado leva o campo 'filial'. O catálogo
+# (agrupamentos, vínculos) e as configurações continuam globais. A unidade ativa vem do seletor
+# da barra lateral e vai junto para as threads das tarefas e leituras paralelas, como a sessão;
+# com_unidade() roda uma função em outra unidade (auditoria de várias unidades em paralelo).
+# Com unidade_padrao_na_raiz (padrão), a primeira unidade continua nas coleções da raiz, onde
+# está o histórico de antes das unidades, até ele ser copiado com migrar_raiz_para_unidade.
+COLECOES_POR_UNIDADE = ('plenus_historico', 'transf_historico', 'consumo_historico', 'sisflora_historico', 'sisflora_snapshots', 'importacoes')
+
+def ler_unidades(valor):
+    """'MATRIZ=Serraria Sede 12.345.678/0001-90, FILIAL2' (ou lista) -> {código: rótulo}, na ordem."""
+    itens = valor if isinstance(valor, (list, tuple)) else str(valor).split(',')
+    unidades = {}
+    for item in itens:
+        codigo, _, rotulo = str(item).partition('=')
+        codigo = codigo.strip().upper()
+        if not codigo: continue
+        if not re.fullmatch(r'[A-Z0-9_-]+', codigo):
+            raise ValueError(f"Código de unidade inválido: '{codigo}' (use letras, números, _ ou -).")
+        unidades[codigo] = rotulo.strip() or codigo
+    return unidades or {'MATRIZ': 'MATRIZ'}
+
+UNIDADES = ler_unidades(config_app('unidades', 'MATRIZ'))
+UNIDADE_PADRAO = next(iter(UNIDADES))
+UNIDADE_PADRAO_NA_RAIZ = str(config_app('unidade_padrao_na_raiz', '1')).lower() not in ('0', 'false', 'nao', 'não')
+
+def unidade_ativa():
+    """Unidade da execução atual: a fixada na thread (tarefa, leitura paralela, com_unidade) ou a da sessão."""
+    filial = getattr(_contexto_tarefa, 'filial', None)
+    if filial: return filial
+    if get_script_run_ctx() is None: return UNIDADE_PADRAO
+    filial = st.session_state.get('filial')
+    return filial if filial in UNIDADES else UNIDADE_PADRAO
+
+@contextmanager
+def usando_unidade(filial):
+    anterior = getattr(_contexto_tarefa, 'filial', None)
+    _contexto_tarefa.filial = filial
+    try: yield
+    finally: _contexto_tarefa.filial = anterior
+
+def com_unidade(filial, func, *args, **kwargs):
+    with usando_unidade(filial):
+        return func(*args, **kwargs)
+
+def caminho_colecao(nome, filial=None):
+    """Caminho da coleção no banco para a unidade (a ativa, se não for dada)."""
+    if nome not in COLECOES_POR_UNIDADE: return nome
+    filial = filial or unidade_ativa()
+    if filial == UNIDADE_PADRAO and UNIDADE_PADRAO_NA_RAIZ: return nome
+    return f"unidades/{filial}/{nome}"
+
+def colecao_db(nome, filial=None):
+    return db.collection(caminho_colecao(nome, filial))
+
+def conferir_unidade_df(df, filial):
+    """Dados lidos com outra unidade ativa não podem ser gravados nesta."""
+    if df is None or 'filial' not in getattr(df, 'columns', []): return
+    outras = set(df['filial'].dropna().astype(str)) - {filial}
+    if outras:
+        raise ValueError(f"Dados da unidade {', '.join(sorted(outras))} não podem ser gravados na unidade {filial}.")
+
+# --- ESPELHO ANALÍTICO LOCAL (DUCKDB) ---
+# Cópia local do histórico (transf/consumo/plenus) para consultas e auditoria em SQL.
+# Os dias sincronizados valem TTL_ESPELHO_MIN; gravações/exclusões do painel invalidam o período.
+ESPELHO_ATIVO = analitico.duckdb is not None and str(config_app('espelho_local', '1')).lower() not in ('0', 'false', 'nao', 'não')
+TTL_ESPELHO_MIN = float(config_app('ttl_espelho_min', 30))
+
+@st.cache_resource
+def conectar_espelho(caminho):
+    return analitico.EspelhoHistorico(caminho)
+
+@st.cache_resource
+def _falha_espelho():
+    # Erro da última tentativa de abrir o espelho (mostrado na sidebar do diagnóstico)
+    return {'erro': None, 'quando': 0.0}
+
+def obter_espelho():
+    """Espelho do processo, ou None se desativado/indisponível (aí as leituras vão direto ao banco)."""
+    if not ESPELHO_ATIVO: return None
+    falha = _falha_espelho()
+    # Depois de uma falha, só tenta abrir de novo quando as marcas de sincronização venceriam
+    if falha['erro'] and time.time() - falha['quando'] < TTL_ESPELHO_MIN * 60: return None
+    # Banco em memória some ao reiniciar: o espelho dele também não pode persistir
+    padrao = ":memory:" if BACKEND_DADOS == 'memoria' else os.path.join(tempfile.gettempdir(), f"estoque_espelho_{BACKEND_DADOS}.duckdb")
+    try:
+        espelho = conectar_espelho(config_app('espelho_caminho', padrao))
+    except Exception as e:
+        falha.update(erro=f"{type(e).__name__}: {e}", quando=time.time())
+        return None
+    falha['erro'] = None
+    return espelho
 
-db = firestore.client()
+# --- EXPORTAÇÃO DE RELATÓRIOS ---
+# Acima deste nº de linhas o "Auto" troca o Excel por Parquet/CSV (o Excel aceita até ~1 milhão)
+MAX_LINHAS_EXPORT_XLSX = min(int(config_app('export_max_linhas_xlsx', 200_000)), exportacao.MAX_LINHAS_XLSX)
+
+# --- EXIBIÇÃO DE TABELAS ---
+# 'navegador': números vão como números (NumberColumn 'localized', separadores do idioma do navegador)
+# 'br': texto pré-formatado 1.234,5678 em qualquer navegador (a ordenação da coluna passa a ser alfabética)
+FORMATO_NUMEROS_TABELA = str(config_app('formato_numeros_tabela', 'navegador')).strip().lower()
+CASAS_TABELA = 4
 
 # --- CONSTANTES ---
-MAPA_CORRECAO_PRODUTOS = {
-    "10": "10 - Toras de Madeira Nativa",
-    "20": "20 - Madeira Serrada em Bruto",
-    "3030": "3030 - Madeira Serrada Aproveitamento", 
-    "50": "50 - Madeira Beneficiada"
-}
-CODIGOS_ACEITOS = ["10", "20", "3030", "50"]
-TERMOS_GENERICOS = [
-    "TORAS DE MADEIRA NATIVA", "MADEIRA SERRADA EM BRUTO", 
-    "MADEIRA SERRADA APROVEITAMENTO", "MADEIRA BENEFICIADA", 
-    "MADEIRA", "TORAS", "SERRADA", "BENEFICIADA"
-]
 COLS_SISTRANSF_EXCEL = [
     "Número", "Data Realização", "Situação", 
     "Produto Origem", "Essência Origem", "Volume Origem", "Unidade Origem", 
     "Produto Gerado", "Essência Gerada", "Volume Gerado", "Unidade Gerada"
 ]
 
+# --- SCHEMAS DE TIPOS POR COLEÇÃO (MEMÓRIA) ---
+# 'category' para textos repetidos, 'datetime' para datas YYYY-MM-DD e float64 para volumes.
+# Volumes ficam em float64: float32 perde a 4ª casa decimal acima de ~1.000 m³.
+SCHEMAS_COLECOES = {
+    'plenus_historico': {
+        'sku': 'category', 'produto': 'category', 'categoria': 'category', 'tipo_movimento': 'category',
+        'arquivo_origem': 'category', 'data_movimento': 'datetime',
+        'entrada': 'float64', 'saida': 'float64', 'saldo_apos': 'float64'
+    },
+    'transf_historico': {
+        'situacao': 'category', 'tipo_produto': 'category', 'produto': 'category', 'essencia': 'category',
+        'popular': 'category', 'unidade': 'category', 'arquivo_origem': 'category',
+        'data_realizacao': 'datetime', 'volume': 'float64'
+    },
+    'consumo_historico': {
+        'produto': 'category', 'essencia': 'category', 'documento': 'category', 'arquivo_origem': 'category',
+        'data_consumo': 'datetime', 'volume': 'float64'
+    },
+    'sisflora_historico': {
+        'produto': 'category', 'essencia': 'category', 'unidade': 'category', 'codigo': 'category',
+        'cat_auto': 'category', 'arquivo_origem': 'category', 'data_referencia': 'datetime',
+        'volume_disponivel': 'float64'
+    },
+}
+
+def memoria_df_mb(df):
+    return float(df.memory_usage(deep=True).sum()) / (1024 * 1024)
+
+def otimizar_tipos_df(df, schema=None, auto_categoria=False):
+    """Converte colunas conforme o schema (category/datetime/float) sem alterar o df original."""
+    if df.empty: return df
+    schema = schema or {}
+    convertidas = {}
+    for col in df.columns:
+        tipo = schema.get(col)
+        if tipo is None and auto_categoria and df[col].dtype == object:
+            # Só vira category se os valores se repetem bastante
+            if df[col].nunique(dropna=True) <= len(df) * 0.5: tipo = 'category'
+        if tipo == 'category':
+            convertidas[col] = df[col].astype('category')
+        elif tipo == 'datetime':
+            convertidas[col] = pd.to_datetime(df[col], errors='coerce')
+        elif tipo in ('float32', 'float64'):
+            convertidas[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(tipo)
+    if not convertidas: return df
+    return df.assign(**convertidas)
+
+def registrar_memoria_carga(nome, linhas, antes_mb, depois_mb):
+    """Guarda o consumo de memória da última carga de cada coleção (exibido na sidebar)."""
+    tarefa = getattr(_contexto_tarefa, 'tarefa', None)
+    # Dentro de tarefa em segundo plano não há session_state: vai para a tarefa e é recolhido depois
+    rel = tarefa['relatorio_memoria'] if tarefa else st.session_state.setdefault('relatorio_memoria', {})
+    rel[nome] = {'Linhas': linhas, 'Antes (MB)': round(antes_mb, 2), 'Depois (MB)': round(depois_mb, 2)}
+
+def montar_item_plenus(df):
+    """Chave 'produto (categoria)' do Plenus; funciona com colunas object ou category."""
+    categoria = df['categoria'].astype(object).fillna("") if 'categoria' in df.columns else pd.Series("", index=df.index)
+    return df['produto'].astype(str) + " (" + categoria.astype(str) + ")"
+
+def montar_item_completo(produto, essencia):
+    """Chave 'produto - essência' (só o produto quando não há essência) em lote.
+
+    Essência nula conta como vazia, como no SQL do espelho (coalesce(essencia, ''))."""
+    produto = produto.astype(object)
+    essencia = essencia.astype(object).where(essencia.notna(), "").astype(str)
+    tem_essencia = essencia != ""
+    return produto.where(~tem_essencia, produto.astype(str) + " - " + essencia)
+
+# --- GERENCIADOR DE DADOS DA SESSÃO (ORÇAMENTO DE MEMÓRIA) ---
+# Os DataFrames grandes ficam num armazém do servidor (compartilhado entre sessões) que
+# conhece o tamanho de cada frame. Quando o limite da sessão ou o global estoura, os frames
+# acessados há mais tempo são despejados em Parquet e recarregados no próximo acesso.
+# Chave no armazém: (sessão, unidade, nome): trocar de unidade mostra os frames dela.
+LIMITE_SESSAO_MB = float(config_app('limite_sessao_mb', 512))
+LIMITE_GLOBAL_MB = float(config_app('limite_global_mb', 2048))
+TTL_DADOS_SESSAO_H = float(config_app('ttl_dados_sessao_h', 12))
+DIR_SPILL = config_app('dir_spill', os.path.join(tempfile.gettempdir(), 'estoque_spill'))
+
+@st.cache_resource
+def _armazem_dados():
+    return {'lock': threading.RLock(), 'itens': {}}
+
+def _id_sessao():
+    tarefa = getattr(_contexto_tarefa, 'tarefa', None)
+    if tarefa: return tarefa['sessao']
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else 'local'
+
+def gravar_frame(df, arquivo):
+    """Parquet (ou pickle, se não der) em arquivo; devolve o formato usado."""
+    os.makedirs(os.path.dirname(arquivo), exist_ok=True)
+    try:
+        df.to_parquet(arquivo, index=False)
+        return 'parquet'
+    except Exception:
+        # Colunas object com tipos mistos (ex: JSON do consumo) não vão para Parquet
+        df.to_pickle(arquivo + '.pkl')
+        return 'pickle'
+
+def ler_frame(arquivo, formato):
+    return pd.read_pickle(arquivo + '.pkl') if formato == 'pickle' else pd.read_parquet(arquivo)
+
+def _despejar_item(item):
+    """Grava o frame em disco e libera a memória (o registro continua no armazém)."""
+    item['formato'] = gravar_frame(item['df'], item['arquivo'])
+    item['df'] = None
+
+def _recarregar_item(item):
+    item['df'] = ler_frame(item['arquivo'], item['formato'])
+
+def _apagar_arquivos_item(item):
+    for arq in [item['arquivo'], item['arquivo'] + '.pkl']:
+        if os.path.exists(arq): os.remove(arq)
+
+def _chave_armazem(chave):
+    return (_id_sessao(), unidade_ativa(), chave)
+
+def _aplicar_orcamento(sessao, chave_protegida=None):
+    """Despeja os frames mais frios até respeitar os limites da sessão e do servidor."""
+    itens = _armazem_dados()['itens']
+    agora = time.time()
+    for k in [k for k, it in itens.items() if agora - it['acesso'] > TTL_DADOS_SESSAO_H * 3600]:
+        _apagar_arquivos_item(itens.pop(k))
+
+    em_memoria = sorted([(k, it) for k, it in itens.items() if it['df'] is not None and k != chave_protegida],
+                        key=lambda x: x[1]['acesso'])
+    uso_sessao = sum(it['bytes'] for k, it in itens.items() if k[0] == sessao and it['df'] is not None)
+    uso_global = sum(it['bytes'] for it in itens.values() if it['df'] is not None)
+    for k, it in em_memoria:
+        estoura_sessao = k[0] == sessao and uso_sessao > LIMITE_SESSAO_MB * 1024 * 1024
+        estoura_global = uso_global > LIMITE_GLOBAL_MB * 1024 * 1024
+        if not (estoura_sessao or estoura_global): continue
+        _despejar_item(it)
+        uso_global -= it['bytes']
+        if k[0] == sessao: uso_sessao -= it['bytes']
+
+# Cada gravação de frame ganha uma versão nova (índices derivados sabem quando refazer)
+_versoes_df = itertools.count(1)
+
+def guardar_df_sessao(chave, valor):
+    """Guarda um DataFrame (ou lista de dicts) da sessão sob o orçamento de memória."""
+    if valor is None:
+        remover_df_sessao(chave)
+        return
+    tipo = 'lista' if isinstance(valor, list) else 'df'
+    df = pd.DataFrame(valor) if tipo == 'lista' else valor
+    k = _chave_armazem(chave)
+    arm = _armazem_dados()
+    with arm['lock']:
+        antigo = arm['itens'].get(k)
+        if antigo: _apagar_arquivos_item(antigo)
+        arm['itens'][k] = {
+            'df': df, 'tipo': tipo, 'bytes': int(df.memory_usage(deep=True).sum()),
+            'acesso': time.time(), 'formato': None, 'versao': next(_versoes_df),
+            'arquivo': os.path.join(DIR_SPILL, re.sub(r'[^\w-]', '_', k[0]), k[1], f"{chave}.parquet")
+        }
+        _aplicar_orcamento(k[0], k)
+
+def obter_df_sessao(chave, padrao=None):
+    """Devolve o frame da sessão, recarregando do disco se ele foi despejado."""
+    k = _chave_armazem(chave)
+    arm = _armazem_dados()
+    with arm['lock']:
+        item = arm['itens'].get(k)
+        if item is None: return padrao
+        item['acesso'] = time.time()
+        if item['df'] is None:
+            _recarregar_item(item)
+            _aplicar_orcamento(k[0], k)
+        return item['df'].to_dict(orient='records') if item['tipo'] == 'lista' else item['df']
+
+def versao_df_sessao(chave):
+    item = _armazem_dados()['itens'].get(_chave_armazem(chave))
+    return item['versao'] if item else None
+
+def tem_df_sessao(chave):
+    return _chave_armazem(chave) in _armazem_dados()['itens']
+
+def remover_df_sessao(chave):
+    arm = _armazem_dados()
+    with arm['lock']:
+        item = arm['itens'].pop(_chave_armazem(chave), None)
+        if item: _apagar_arquivos_item(item)
+
+def resumo_dados_sessao():
+    """Tabela de uso (MB / memória ou disco) dos frames da sessão atual."""
+    sessao = _id_sessao()
+    arm = _armazem_dados()
+    with arm['lock']:
+        # Cópia sob o lock: outras sessões gravam/despejam frames enquanto a tabela é montada
+        itens = [(k, it['bytes'], it['df'] is not None) for k, it in arm['itens'].items()]
+    linhas = [{'Filial': k[1], 'Chave': k[2], 'MB': round(n_bytes / (1024 * 1024), 2), 'Local': 'memória' if em_memoria else 'disco'}
+              for k, n_bytes, em_memoria in itens if k[0] == sessao]
+    uso_global = sum(n_bytes for _, n_bytes, em_memoria in itens if em_memoria) / (1024 * 1024)
+    return pd.DataFrame(linhas), uso_global
+
+# --- INSTRUMENTAÇÃO (TEMPO / LINHAS / LEITURAS / ESCRITAS / MEMÓRIA) ---
+# Cada etapa medida vira um registro no buffer do servidor (painel 🩺 da sidebar)
+# e uma linha JSON em ARQUIVO_LOG_DIAGNOSTICO (vazio = desliga o log).
+ARQUIVO_LOG_DIAGNOSTICO = config_app('log_diagnostico', os.path.join(tempfile.gettempdir(), 'estoque_diagnostico.jsonl'))
+_pilha_etapas = threading.local()
+
+@st.cache_resource
+def _diagnostico_global():
+    return {'lock': threading.Lock(), 'registros': deque(maxlen=2000)}
+
+def _etapas_ativas():
+    if not hasattr(_pilha_etapas, 'lista'): _pilha_etapas.lista = []
+    return _pilha_etapas.lista
+
+def contar_leituras(n=1):
+    """Soma documentos lidos na etapa em andamento (e nas etapas pai)."""
+    for etapa in _etapas_ativas(): etapa['docs_lidos'] += n
+
+def contar_escritas(n=1):
+    for etapa in _etapas_ativas(): etapa['docs_escritos'] += n
+
+def stream_contado(query):
+    """query.stream() contando cada documento lido."""
+    for doc in query.stream():
+        contar_leituras()
+        yield doc
+
+def commit_lote(batch, n_ops):
+    batch.commit()
+    contar_escritas(n_ops)
+
+def _contar_linhas(res):
+    if isinstance(res, tuple) and res: res = res[0]
+    if isinstance(res, (pd.DataFrame, list, dict)): return len(res)
+    return None
+
+def _registrar_etapa(registro):
+    diag = _diagnostico_global()
+    with diag['lock']:
+        diag['registros'].append(registro)
+        if ARQUIVO_LOG_DIAGNOSTICO:
+            try:
+                with open(ARQUIVO_LOG_DIAGNOSTICO, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(registro, default=str, ensure_ascii=False) + "\n")
+            except OSError: pass
+
+@contextmanager
+def medir_etapa(nome, **extras):
+    """Mede tempo, linhas, leituras/escritas no Firestore e pico de memória (se tracemalloc ativo)."""
+    pilha = _etapas_ativas()
+    etapa = {'etapa': nome, 'linhas': None, 'docs_lidos': 0, 'docs_escritos': 0, '_pico': 0, '_mem_ini': 0}
+    etapa.update(extras)
+    if tracemalloc.is_tracing():
+        atual, pico = tracemalloc.get_traced_memory()
+        # reset_peak é global: guarda nas etapas pai o pico visto até aqui
+        for pai in pilha: pai['_pico'] = max(pai['_pico'], pico)
+        tracemalloc.reset_peak()
+        etapa['_mem_ini'] = atual
+    pilha.append(etapa)
+    t0 = time.perf_counter()
+    try:
+        yield etapa
+    finally:
+        pilha.pop()
+        registro = {k: v for k, v in etapa.items() if not k.startswith('_')}
+        registro['segundos'] = round(time.perf_counter() - t0, 4)
+        registro['pico_mb'] = None
+        if tracemalloc.is_tracing():
+            pico = max(etapa['_pico'], tracemalloc.get_traced_memory()[1])
+            registro['pico_mb'] = round(max(pico - etapa['_mem_ini'], 0) / (1024 * 1024), 2)
+            for pai in pilha: pai['_pico'] = max(pai['_pico'], pico)
+        registro['sessao'] = _id_sessao()
+        registro['quando'] = datetime.now().isoformat(timespec='seconds')
+        _registrar_etapa(registro)
+
+def instrumentar(nome=None):
+    """Decorator de medir_etapa; conta as linhas do DataFrame/lista devolvido."""
+    def deco(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with medir_etapa(nome or func.__name__) as etapa:
+                res = func(*args, **kwargs)
+                if etapa['linhas'] is None: etapa['linhas'] = _contar_linhas(res)
+                return res
+        return wrapper
+    return deco
+
+def ativar_perfil_memoria(ativo):
+    """Liga/desliga tracemalloc (custo extra em todas as sessões enquanto ligado)."""
+    if ativo and not tracemalloc.is_tracing(): tracemalloc.start()
+    elif not ativo and tracemalloc.is_tracing(): tracemalloc.stop()
+
+def resumo_diagnostico(sessao=None):
+    diag = _diagnostico_global()
+    with diag['lock']:
+        regs = [r for r in diag['registros'] if sessao is None or r.get('sessao') == sessao]
+    cols = ['quando', 'etapa', 'segundos', 'linhas', 'docs_lidos', 'docs_escritos', 'pico_mb']
+    df = pd.DataFrame(regs)
+    if df.empty: return pd.DataFrame(columns=cols)
+    return df[[c for c in cols if c in df.columns] + [c for c in df.columns if c not in cols and c != 'sessao']].iloc[::-1]
+
+# --- TAREFAS EM SEGUNDO PLANO (LEITURA DE PDF / GRAVAÇÃO / AUDITORIA) ---
+# O trabalho pesado roda num pool de threads do servidor. A sessão guarda só o id da
+# tarefa em st.session_state['tarefas'][chave]; um rerun não reinicia nada: o painel de
+# status consulta o registro periodicamente e, quando a tarefa acaba, o script recolhe o
+# resultado. O cancelamento é cooperativo (a tarefa confere entre páginas/lotes/etapas).
+MAX_TAREFAS_PARALELAS = int(config_app('max_tarefas', 4))
+TTL_TAREFAS_H = 2
+_contexto_tarefa = threading.local()
+
+class TarefaCancelada(Exception):
+    pass
+
+@st.cache_resource
+def _registro_tarefas():
+    return {'lock': threading.Lock(), 'tarefas': {},
+            'pool': ThreadPoolExecutor(max_workers=MAX_TAREFAS_PARALELAS, thread_name_prefix='tarefa')}
+
+def _executar_tarefa(tarefa, func, args, kwargs):
+    _contexto_tarefa.tarefa = tarefa
+    _contexto_tarefa.filial = tarefa['filial']
+    try:
+        if tarefa['cancelar'].is_set(): raise TarefaCancelada()
+        tarefa['status'] = 'executando'
+        tarefa['resultado'] = func(tarefa, *args, **kwargs)
+        tarefa['progresso'] = 1.0
+        tarefa['status'] = 'concluida'
+    except TarefaCancelada:
+        tarefa['status'] = 'cancelada'
+    except Exception as e:
+        tarefa['erro'] = f"{type(e).__name__}: {e}"
+        tarefa['status'] = 'erro'
+        traceback.print_exc()
+    finally:
+        tarefa['fim'] = time.time()
+        _contexto_tarefa.tarefa = None
+        _contexto_tarefa.filial = None
+
+def iniciar_tarefa(chave, descricao, func, *args, **kwargs):
+    """Agenda func(tarefa, *args, **kwargs) no pool e liga a tarefa à chave na sessão."""
+    reg = _registro_tarefas()
+    tarefa = {
+        'id': uuid.uuid4().hex[:12], 'chave': chave, 'descricao': descricao, 'sessao': _id_sessao(), 'filial': unidade_ativa(),
+        'status': 'na fila', 'progresso': 0.0, 'mensagem': '', 'parcial': None,
+        'resultado': None, 'erro': None, 'relatorio_memoria': {},
+        'cancelar': threading.Event(), 'inicio': time.time(), 'fim': None,
+    }
+    with reg['lock']:
+        # Esquece tarefas encerradas há muito tempo (resultado nunca recolhido)
+        limite = time.time() - TTL_TAREFAS_H * 3600
+        for tid in [t for t, v in reg['tarefas'].items() if v['fim'] and v['fim'] < limite]:
+            del reg['tarefas'][tid]
+        reg['tarefas'][tarefa['id']] = tarefa
+    st.session_state.setdefault('tarefas', {})[chave] = tarefa['id']
+    reg['pool'].submit(_executar_tarefa, tarefa, func, args, kwargs)
+    return tarefa['id']
+
+def atualizar_tarefa(tarefa, progresso=None, mensagem=None, parcial=None):
+    """Chamada de dentro da tarefa: publica o andamento e interrompe se o cancelamento foi pedido."""
+    if tarefa is None: return
+    if progresso is not None: tarefa['progresso'] = min(max(float(progresso), 0.0), 1.0)
+    if mensagem is not None: tarefa['mensagem'] = mensagem
+    if parcial is not None: tarefa['parcial'] = parcial
+    if tarefa['cancelar'].is_set(): raise TarefaCancelada()
+
+def obter_tarefa(chave):
+    tid = st.session_state.get('tarefas', {}).get(chave)
+    if tid is None: return None
+    return _registro_tarefas()['tarefas'].get(tid)
+
+def tarefa_em_andamento(chave):
+    tarefa = obter_tarefa(chave)
+    return tarefa is not None and tarefa['fim'] is None
+
+def cancelar_tarefa(chave):
+    tarefa = obter_tarefa(chave)
+    if tarefa is not None: tarefa['cancelar'].set()
+
+def recolher_tarefa(chave):
+    """Devolve a tarefa encerrada (uma única vez) e a desliga da sessão; None se ainda roda."""
+    tarefa = obter_tarefa(chave)
+    if tarefa is None:
+        st.session_state.get('tarefas', {}).pop(chave, None)
+        return None
+    if tarefa['fim'] is None: return None
+    st.session_state['tarefas'].pop(chave, None)
+    with _registro_tarefas()['lock']:
+        _registro_tarefas()['tarefas'].pop(tarefa['id'], None)
+    st.session_state.setdefault('relatorio_memoria', {}).update(tarefa['relatorio_memoria'])
+    return tarefa
+
+@st.fragment(run_every=1.0)
+def painel_tarefa(chave):
+    """Status da tarefa (atualiza sozinho); ao terminar, roda o app inteiro para recolher o resultado."""
+    tarefa = obter_tarefa(chave)
+    if tarefa is None: return
+    if tarefa['fim'] is not None:
+        st.rerun(scope="app")
+    decorrido = time.time() - tarefa['inicio']
+    texto = f"⏳ {tarefa['descricao']} ({tarefa['status']}, {decorrido:.0f}s)"
+    if tarefa['mensagem']: texto += f" — {tarefa['mensagem']}"
+    st.progress(tarefa['progresso'], text=texto)
+    if tarefa['cancelar'].is_set():
+        st.caption("Cancelamento pedido; aguardando a etapa atual terminar...")
+    elif st.button("⛔ Cancelar", key=f"btn_cancelar_{chave}"):
+        cancelar_tarefa(chave)
+
+def executar_em_paralelo(chamadas, max_paralelo=None, pool=None):
+    """Roda [(func, *args), ...] ao mesmo tempo e devolve os resultados na mesma ordem.
+
+    As threads herdam a sessão, a unidade (e a tarefa, se houver) de quem chamou, para os dados,
+    o diagnóstico e o relatório de memória irem para o lugar certo; as leituras/escritas que elas contam somam
+    na etapa em andamento de quem chamou. Com pool, usa esse executor compartilhado (as
+    chamadas não podem agendar mais trabalho nele); sem, cria um só para estas chamadas.
+    Espera todas terminarem antes de repassar o primeiro erro.
+    """
+    if not chamadas: return []
+    herdado = getattr(_contexto_tarefa, 'tarefa', None)
+    contexto = herdado or {'sessao': _id_sessao(), 'relatorio_memoria': {}}
+    filial = unidade_ativa()
+    contadores = [{'docs_lidos': 0, 'docs_escritos': 0, '_pico': 0} for _ in chamadas]
+    def _rodar(func, args, acumulador):
+        anterior = getattr(_contexto_tarefa, 'tarefa', None)
+        _contexto_tarefa.tarefa = contexto
+        _pilha_etapas.lista = [acumulador]
+        try:
+            with usando_unidade(filial): return func(*args)
+        finally:
+            _contexto_tarefa.tarefa = anterior
+            _pilha_etapas.lista = []
+    proprio = pool is None
+    if proprio: pool = ThreadPoolExecutor(max_workers=max_paralelo or len(chamadas), thread_name_prefix='paralelo')
+    try:
+        futuros = [pool.submit(_rodar, c[0], c[1:], acum) for c, acum in zip(chamadas, contadores)]
+        wait(futuros)
+        resultados = [f.result() for f in futuros]
+    finally:
+        if proprio: pool.shutdown(wait=False)
+        contar_leituras(sum(c['docs_lidos'] for c in contadores))
+        contar_escritas(sum(c['docs_escritos'] for c in contadores))
+    if herdado is None and contexto['relatorio_memoria']:
+        st.session_state.setdefault('relatorio_memoria', {}).update(contexto['relatorio_memoria'])
+    return resultados
+
+def mostrar_fim_tarefa(tarefa, msg_cancelada="Tarefa cancelada."):
+    """Mensagens padrão de erro/cancelamento; devolve True se a tarefa concluiu."""
+    if tarefa['status'] == 'erro':
+        st.error(f"❌ {tarefa['descricao']} falhou: {tarefa['erro']}")
+    elif tarefa['status'] == 'cancelada':
+        st.warning(f"⛔ {msg_cancelada}")
+    return tarefa['status'] == 'concluida'
+
 # --- FUNÇÕES UTILITÁRIAS FIREBASE (SUBSTITUINDO SQLITE) ---
 
 def firestore_to_df(collection_name, query_ref=None):
-    """Converte coleção ou query do Firestore para DataFrame."""
+    """Converte coleção ou query do Firestore para DataFrame (aplicando o schema da coleção)."""
     try:
         if query_ref:
-            docs = query_ref.stream()
+            docs = stream_contado(query_ref)
         else:
-            docs = db.collection(collection_name).stream()
-        
+            docs = stream_contado(colecao_db(collection_name))
+
         items = []
         for doc in docs:
             d = doc.to_dict()
             d['firebase_id'] = doc.id # Guarda ID para updates/deletes se precisar
             items.append(d)
-        
-        return pd.DataFrame(items)
+        return docs_para_df(collection_name, items)
     except Exception as e:
         st.error(f"Erro ao ler Firestore ({collection_name}): {e}")
         return pd.DataFrame()
 
+def docs_para_df(collection_name, items):
+    """Lista de dicts (com firebase_id) -> DataFrame com o schema da coleção."""
+    df = pd.DataFrame(items)
+    schema = SCHEMAS_COLECOES.get(collection_name)
+    if schema and not df.empty:
+        antes = memoria_df_mb(df)
+        df = otimizar_tipos_df(df, schema)
+        registrar_memoria_carga(collection_name, len(df), antes, memoria_df_mb(df))
+    return df
+
+# --- LEITURA PARTICIONADA POR DATA ---
+# Um período grande vira várias partições (mês civil, ou N dias) lidas em paralelo por um
+# pool limitado do servidor e juntadas na ordem das datas; o tempo total fica perto da
+# partição mais lenta em vez da soma de todas. Uma falha transitória refaz só a partição
+# que falhou (até TENTATIVAS_LEITURA vezes, com espera crescente).
+LEITURAS_PARALELAS = int(config_app('leituras_paralelas', 8))
+PARTICAO_LEITURA = str(config_app('particao_leitura', 'mensal'))  # 'mensal' ou nº de dias
+TENTATIVAS_LEITURA = int(config_app('tentativas_leitura', 3))
+
+@st.cache_resource
+def _pool_leituras(max_workers):
+    # Só as partições usam este pool (folhas: não agendam mais nada nele)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='leitura')
+
+def dividir_periodo_mensal(dt_ini, dt_fim):
+    """[(ini, fim), ...] em YYYY-MM-DD, um por mês civil (o primeiro e o último podem ser parciais)."""
+    ini, fim = pd.Timestamp(dt_ini).normalize(), pd.Timestamp(dt_fim).normalize()
+    if fim < ini: return []
+    inicios = [ini] + list(pd.date_range(ini + pd.offsets.MonthBegin(1), fim, freq='MS'))
+    fins = [i - pd.Timedelta(days=1) for i in inicios[1:]] + [fim]
+    return [(a.strftime("%Y-%m-%d"), b.strftime("%Y-%m-%d")) for a, b in zip(inicios, fins)]
+
+def dividir_periodo(dt_ini, dt_fim, particao=None):
+    """Partições de leitura conforme PARTICAO_LEITURA ('mensal' ou blocos de N dias)."""
+    particao = str(particao or PARTICAO_LEITURA).strip().lower()
+    if particao == 'mensal' or not particao.isdigit() or int(particao) < 1:
+        return dividir_periodo_mensal(dt_ini, dt_fim)
+    dias = pd.date_range(pd.Timestamp(dt_ini).normalize(), pd.Timestamp(dt_fim).normalize(), freq='D')
+    n = int(particao)
+    return [(dias[i].strftime("%Y-%m-%d"), dias[min(i + n, len(dias)) - 1].strftime("%Y-%m-%d")) for i in range(0, len(dias), n)]
+
+def _aplicar_filtro_banco(query, filtro):
+    """filtro (campo, valores) do planejador vira '==' (um valor) ou 'in' na consulta."""
+    if not filtro: return query
+    campo, valores = filtro
+    return query.where(campo, '==', valores[0]) if len(valores) == 1 else query.where(campo, 'in', list(valores))
+
+def _ler_particao(colecao, col_data, d_ini, d_fim, campos=None, filtro=None):
+    for tentativa in range(1, TENTATIVAS_LEITURA + 1):
+        try:
+            query = colecao_db(colecao).where(col_data, '>=', d_ini).where(col_data, '<=', d_fim)
+            query = _aplicar_filtro_banco(query, filtro)
+            if campos: query = query.select(campos)
+            items = []
+            for doc in stream_contado(query):
+                d = doc.to_dict()
+                d['firebase_id'] = doc.id
+                items.append(d)
+            return items
+        except Exception as e:
+            if tentativa >= TENTATIVAS_LEITURA:
+                raise RuntimeError(f"{colecao} {d_ini}..{d_fim}: falhou após {tentativa} tentativa(s): {e}") from e
+            time.sleep(0.5 * 2 ** (tentativa - 1))
+
+def ler_periodo_paralelo(colecao, col_data, dt_ini, dt_fim, campos=None, filtro=None):
+    """Documentos de [dt_ini, dt_fim] lidos por partição em paralelo, juntados na ordem das datas.
+    filtro=(campo, valores) vai para a consulta (precisa de índice composto campo + data)."""
+    particoes = dividir_periodo(dt_ini, dt_fim)
+    partes = executar_em_paralelo([(_ler_particao, colecao, col_data, a, b, campos, filtro) for a, b in particoes],
+                                  pool=_pool_leituras(LEITURAS_PARALELAS))
+    return [d for parte in partes for d in parte]
+
+def carregar_periodo_df(colecao, col_data, dt_ini, dt_fim, filtro=None):
+    """ler_periodo_paralelo + schema, com o mesmo tratamento de erro de firestore_to_df."""
+    try:
+        return docs_para_df(colecao, ler_periodo_paralelo(colecao, col_data, dt_ini, dt_fim, filtro=filtro))
+    except Exception as e:
+        st.error(f"Erro ao ler Firestore ({colecao}): {e}")
+        return pd.DataFrame()
+
+# --- PLANO DE CONSULTA (ÍNDICES COMPOSTOS) ---
+# Filtro de igualdade/'in' junto com o intervalo de datas só roda no Firestore com um índice
+# composto (campo ASC, data ASC). Os índices existentes estão em firestore.indexes.json
+# (publicar com: firebase deploy --only firestore:indexes); o plano só manda ao banco o filtro
+# que tem índice, cabe num 'in' e deve devolver menos documentos, e aplica o resto em pandas.
+# A seletividade é estimada por nº de valores / valores distintos do campo: os distintos vêm
+# da última leitura sem filtro no banco (ou de CARDINALIDADE_PADRAO, antes da primeira).
+ARQUIVO_INDICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firestore.indexes.json')
+LIMITE_IN_FIRESTORE = 30
+CARDINALIDADE_PADRAO = {
+    'transf_historico': {'numero': 5000, 'produto': 40, 'popular': 150, 'essencia': 150,
+                         'situacao': 3, 'tipo_produto': 2, 'unidade': 3},
+}
+
+def ler_indices_compostos(caminho=ARQUIVO_INDICES):
+    """{coleção: {(campo, campo_data), ...}} a partir do firestore.indexes.json."""
+    try:
+        with open(caminho, encoding='utf-8') as arq: dados = json.load(arq)
+    except (OSError, ValueError):
+        return {}
+    indices = {}
+    for indice in dados.get('indexes', []):
+        campos = tuple(c.get('fieldPath') for c in indice.get('fields', []))
+        if len(campos) == 2: indices.setdefault(indice.get('collectionGroup'), set()).add(campos)
+    return indices
+
+INDICES_COMPOSTOS = ler_indices_compostos()
+
+@st.cache_resource
+def _cardinalidades():
+    return {'lock': threading.Lock(), 'colecoes': {}}
+
+def registrar_cardinalidades(colecao, df):
+    """Guarda os valores distintos por campo de uma leitura sem filtro no banco."""
+    campos = [c for c in CARDINALIDADE_PADRAO.get(colecao, {}) if c in df.columns]
+    if df.empty or not campos: return
+    card = _cardinalidades()
+    with card['lock']:
+        card['colecoes'].setdefault(colecao, {}).update({c: max(int(df[c].nunique()), 1) for c in campos})
+
+def planejar_consulta(colecao, col_data, filtros):
+    """filtros {campo: valores} -> {'banco': (campo, valores) ou None, 'local': {campo: valores}, 'fracao': estimativa}."""
+    observadas = _cardinalidades()['colecoes'].get(colecao, {})
+    candidatos = []
+    for campo, valores in filtros.items():
+        if (campo, col_data) not in INDICES_COMPOSTOS.get(colecao, set()) or len(valores) > LIMITE_IN_FIRESTORE: continue
+        distintos = observadas.get(campo) or CARDINALIDADE_PADRAO.get(colecao, {}).get(campo, 10)
+        candidatos.append((min(len(valores) / distintos, 1.0), campo))
+    if not candidatos or min(candidatos)[0] >= 1.0:
+        return {'banco': None, 'local': dict(filtros), 'fracao': 1.0}
+    fracao, campo = min(candidatos)
+    return {'banco': (campo, list(filtros[campo])), 'local': {c: v for c, v in filtros.items() if c != campo}, 'fracao': fracao}
+
+def descrever_plano(plano):
+    banco = f"{plano['banco'][0]} in {len(plano['banco'][1])} valor(es)" if plano['banco'] else "só data"
+    return f"banco: {banco}; pandas: {', '.join(plano['local']) or '-'}"
+
 def get_max_date_db(collection, col_data):
     """Retorna a data máxima salva no Firestore."""
     try:
         # Firestore ordena string de data YYYY-MM-DD corretamente
-        query = db.collection(collection).order_by(col_data, direction=firestore.Query.DESCENDING).limit(1)
-        docs = list(query.stream())
+        query = colecao_db(collection).order_by(col_data, direction=firestore.Query.DESCENDING).limit(1)
+        docs = list(stream_contado(query))
         if docs:
             val_str = docs[0].to_dict().get(col_data)
             if val_str:
@@ -112,7 +828,55 @@ def update_session_dates(prefix, dt_min, dt_max):
         st.session_state[f'{prefix}_dt_fim'] = dt_max
 
 # --- FUNÇÕES UI (MANTIDAS IDENTICAS AO ORIGINAL) ---
-def render_filtered_table(df, key_prefix, show_total=True):
+def botao_exportar(df, nome_arquivo, key, rotulo="📥 Baixar"):
+    """Download do relatório com escolha de formato; o arquivo só é gerado no clique."""
+    if df is None or df.empty: return
+    opcoes = ['auto'] + exportacao.formatos_disponiveis()
+    c_fmt, c_btn = st.columns([1, 3])
+    pedido = c_fmt.selectbox("Formato", opcoes, key=f"fmt_{key}", label_visibility="collapsed",
+                             format_func=lambda f: "Auto" if f == 'auto' else exportacao.FORMATOS[f]['rotulo'])
+    formato = exportacao.escolher_formato(len(df), pedido, MAX_LINHAS_EXPORT_XLSX)
+    # data como função: o Streamlit só chama no clique, fora do rerun (df capturado sem cópia)
+    c_btn.download_button(f"{rotulo} ({exportacao.FORMATOS[formato]['rotulo']})",
+                          data=lambda: exportacao.exportar_bytes(df, formato),
+                          file_name=f"{nome_arquivo}.{formato}", mime=exportacao.FORMATOS[formato]['mime'],
+                          on_click="ignore", key=f"dl_{key}")
+    if pedido == 'xlsx' and formato != 'xlsx':
+        c_btn.caption(f"{len(df):,} linhas passam do limite do Excel ({MAX_LINHAS_EXPORT_XLSX:,}): exportando em {formato.upper()}.".replace(",", "."))
+
+TERMOS_COLUNA_ID = {'id', 'sku', 'numero', 'número', 'nota', 'serie', 'série', 'codigo', 'código', 'ano', 'firebase'}
+RE_DATA_ISO = r'^\d{4}-\d{2}-\d{2}$'
+
+def eh_coluna_id(col):
+    """Código/ID pela palavra inteira do nome (separada por '_' ou espaço): 'firebase_id' e
+    'Número Nota' são, 'saida' e 'Quantidade' não."""
+    return any(t in TERMOS_COLUNA_ID for t in re.split(r'[_\s]+', str(col).lower()))
+
+def preparar_exibicao(df, formato_numeros=None):
+    """(df_exibicao, column_config) para o st.dataframe sem Styler: a tabela vai em Arrow puro.
+    Datas (datetime ou texto ISO) saem DD/MM/YYYY, códigos/IDs sem separador e os demais números
+    com 4 casas: NumberColumn no modo 'navegador', texto BR pré-formatado no modo 'br'."""
+    formato_numeros = formato_numeros or FORMATO_NUMEROS_TABELA
+    novas, config = {}, {}
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            config[col] = st.column_config.DateColumn(format="DD/MM/YYYY")
+        elif isinstance(serie.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(serie):
+            continue
+        elif pd.api.types.is_numeric_dtype(serie):
+            if eh_coluna_id(col):
+                config[col] = st.column_config.NumberColumn(format="plain")
+            elif formato_numeros == 'br':
+                novas[col] = formatar_br_series(serie, CASAS_TABELA)
+            else:
+                config[col] = st.column_config.NumberColumn(format="localized", step=10 ** -CASAS_TABELA)
+        elif len(serie) and serie.astype(str).str.match(RE_DATA_ISO).all():
+            novas[col] = pd.to_datetime(serie, format="%Y-%m-%d", errors='coerce')
+            config[col] = st.column_config.DateColumn(format="DD/MM/YYYY")
+    return (df.assign(**novas) if novas else df), config
+
+def render_filtered_table(df, key_prefix, show_total=True, export_nome=None):
     if df.empty:
         st.info("Nenhum dado para exibir.")
         return
@@ -124,8 +888,9 @@ def render_filtered_table(df, key_prefix, show_total=True):
     # 2. Filtro Colunas/Categoria
     cols_filter = c2.multiselect("Filtrar por Coluna(s):", df.columns, key=f"cols_{key_prefix}")
     
-    df_view = df.copy()
-    
+    # Sem copy(): filtros geram novos frames e a exibição monta só as colunas que mudam
+    df_view = df
+
     # Aplica busca textual
     if txt_search:
         mask = df_view.astype(str).apply(lambda x: x.str.contains(txt_search, case=False, na=False)).any(axis=1)
@@ -146,63 +911,39 @@ def render_filtered_table(df, key_prefix, show_total=True):
             for col in cols_to_sum:
                 val = df_view[col].sum()
                 if abs(val) > 0.0001:
-                    total_html += f"<div style='background:#e9ecef; padding:5px 10px; border-radius:4px;'><b>{col}:</b> {val:,.4f}".replace(",", "X").replace(".", ",").replace("X", ".") + "</div>"
+                    total_html += f"<div style='background:#e9ecef; padding:5px 10px; border-radius:4px;'><b>{col}:</b> {formatar_br(float(val))}</div>"
             total_html += "</div>"
             st.markdown(total_html, unsafe_allow_html=True)
 
-    # 4. Formatação Visual
-    date_cols = []
-    for col in df_view.columns:
-        if pd.api.types.is_datetime64_any_dtype(df_view[col]):
-            date_cols.append(col)
-            df_view[col] = df_view[col].dt.strftime('%d/%m/%Y')
-        elif df_view[col].astype(str).str.match(r'^\d{4}-\d{2}-\d{2}$').all():
-             try:
-                 df_view[col] = pd.to_datetime(df_view[col]).dt.strftime('%d/%m/%Y')
-                 date_cols.append(col)
-             except: pass
-
-    cols_no_fmt = [c for c in df_view.columns if any(x in c.lower() for x in ['id', 'sku', 'numero', 'nota', 'serie', 'codigo', 'ano', 'firebase'])]
-    
-    def fmt_br(x):
-        if isinstance(x, (float, int)) and not isinstance(x, bool):
-            return f"{x:,.4f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        return str(x)
-
-    def fmt_id(x): return str(x)
-
-    format_dict = {}
-    for c in df_view.columns:
-        if c in cols_no_fmt: format_dict[c] = fmt_id
-        elif pd.api.types.is_numeric_dtype(df_view[c]): format_dict[c] = fmt_br
-        else: format_dict[c] = str
-
-    styler = df_view.style.format(format_dict)
-    if date_cols: styler.set_properties(subset=date_cols, **{'text-align': 'center'})
-    st.dataframe(styler, use_container_width=True, height=500)
+    # 4. Formatação Visual (colunas preparadas uma vez, sem Styler)
+    df_exib, col_config = preparar_exibicao(df_view)
+    st.dataframe(df_exib, use_container_width=True, height=500, column_config=col_config)
+    # Exporta o que está na tela (pesquisa e colunas filtradas)
+    if export_nome: botao_exportar(df_view, export_nome, key_prefix)
 
 def render_plenus_dashboard(df_full, key_prefix="p_dash", allow_save=True):
     min_d, max_d = date.today(), date.today()
+    dt_mov = None
     if 'data_movimento' in df_full.columns:
         try:
-            dates = pd.to_datetime(df_full['data_movimento'], errors='coerce').dropna().dt.date
+            dt_mov = pd.to_datetime(df_full['data_movimento'], errors='coerce')
+            dates = dt_mov.dropna()
             if not dates.empty:
-                min_d, max_d = dates.min(), dates.max()
-        except: pass
+                min_d, max_d = dates.min().date(), dates.max().date()
+        except: dt_mov = None
     
     st.markdown("##### 🗓️ Filtrar Período")
     c_f1, c_f2 = st.columns(2)
     d_ini_f = c_f1.date_input("Filtrar Data De:", value=min_d, key=f"{key_prefix}_filtro_p_ini", format="DD/MM/YYYY", on_change=save_app_state)
     d_fim_f = c_f2.date_input("Filtrar Data Até:", value=max_d, key=f"{key_prefix}_filtro_p_fim", format="DD/MM/YYYY", on_change=save_app_state)
 
-    df_view = df_full.copy()
-    if 'data_movimento' in df_view.columns:
-        df_view['dt_temp'] = pd.to_datetime(df_view['data_movimento'], errors='coerce').dt.date
-        mask = (df_view['dt_temp'].isna()) | ((df_view['dt_temp'] >= d_ini_f) & (df_view['dt_temp'] <= d_fim_f))
-        df_view = df_view[mask].drop(columns=['dt_temp'])
-    
+    df_view = df_full
+    if dt_mov is not None:
+        mask = dt_mov.isna() | ((dt_mov >= pd.Timestamp(d_ini_f)) & (dt_mov <= pd.Timestamp(d_fim_f)))
+        df_view = df_view[mask]
+
     c1, c2, c3 = st.columns(3)
-    cats = sorted(df_view['categoria'].astype(str).unique()) if 'categoria' in df_view.columns else []
+    cats = sorted(df_view['categoria'].dropna().astype(str).unique()) if 'categoria' in df_view.columns else []
     f_cat = c1.multiselect("Categoria:", cats, key=f"{key_prefix}_fp_cat")
     f_txt = c3.text_input("Pesquisar:", key=f"{key_prefix}_fp_txt")
         
@@ -213,13 +954,13 @@ def render_plenus_dashboard(df_full, key_prefix="p_dash", allow_save=True):
     if 'tipo' in df_view.columns:
         vol_total = df_view[df_view['tipo'].isin(['Total', 'TOTAL'])]['saldo'].sum()
         if vol_total == 0 and not df_view.empty and 'sku' in df_view.columns and 'saldo' in df_view.columns:
-            df_calc = df_view.copy()
+            df_calc = df_view
             cols_sort = []
             if 'data_movimento' in df_calc.columns: cols_sort.append('data_movimento')
             # Firestore não tem ID sequencial simples, mas ordenamos por data
             if cols_sort:
                 df_calc = df_calc.sort_values(by=cols_sort, ascending=True)
-            vol_total = df_calc.groupby('sku')['saldo'].last().sum()
+            vol_total = df_calc.groupby('sku', observed=True)['saldo'].last().sum()
 
     st.metric("Saldo Total", formatar_br(vol_total))
     st.caption(f"Exibindo {len(df_view)} registros.")
@@ -227,32 +968,32 @@ def render_plenus_dashboard(df_full, key_prefix="p_dash", allow_save=True):
     cols_table = ['data', 'sku', 'produto', 'categoria', 'tipo', 'entrada', 'saida', 'saldo']
     cols_exist = [c for c in cols_table if c in df_view.columns]
         
-    st.dataframe(
-        df_view[cols_exist].style.format({
-            'entrada': formatar_br, 'saida': formatar_br, 'saldo': formatar_br
-        }), 
-        use_container_width=True, height=600
-    )
+    df_exib, col_config = preparar_exibicao(df_view[cols_exist])
+    st.dataframe(df_exib, use_container_width=True, height=600, column_config=col_config)
+    botao_exportar(df_view[cols_exist], "movimento_plenus", key_prefix)
 
     if allow_save:
         st.divider()
         st.info("Para auditoria, é necessário salvar os movimentos no banco de dados.")
         if st.button("💾 Salvar Filtrados no Firebase", key=f"{key_prefix}_btn_save"):
-            df_save = df_view.copy()
             rename_map = {}
-            if 'tipo' in df_save.columns: rename_map['tipo'] = 'tipo_movimento'
-            if 'saldo' in df_save.columns: rename_map['saldo'] = 'saldo_apos'
-            df_save.rename(columns=rename_map, inplace=True)
+            if 'tipo' in df_view.columns: rename_map['tipo'] = 'tipo_movimento'
+            if 'saldo' in df_view.columns: rename_map['saldo'] = 'saldo_apos'
+            df_save = df_view.rename(columns=rename_map)
             
             if 'data_movimento' in df_save.columns:
                 df_save = df_save[df_save['data_movimento'].notna()]
 
             cols_db_plenus = ['sku', 'produto', 'categoria', 'data_movimento', 'tipo_movimento', 
-                                'entrada', 'saida', 'saldo_apos', 'nota', 'serie', 'arquivo_origem']
+                                'entrada', 'saida', 'saldo_apos', 'nota', 'serie', 'arquivo_origem', 'filial']
             cols_to_save = [c for c in cols_db_plenus if c in df_save.columns]
             df_save = df_save[cols_to_save]
 
-            inseridos, existentes = salvar_lote_smart('plenus_historico', 'data_movimento', df_save)
+            try:
+                inseridos, existentes = salvar_lote_smart('plenus_historico', 'data_movimento', df_save)
+            except ValueError as e:  # período com importação incompleta
+                st.error(str(e))
+                return
             
             dates = pd.to_datetime(df_save['data_movimento']).dt.date
             if not dates.empty:
@@ -274,13 +1015,11 @@ def init_session_vars():
         i, f = get_smart_date_range('transf_historico', 'data_realizacao')
         st.session_state['t_dt_ini'] = i
         st.session_state['t_dt_fim'] = f
-    if 'view_transf' not in st.session_state: st.session_state['view_transf'] = None 
     
     if 'c_dt_ini' not in st.session_state:
         i, f = get_smart_date_range('consumo_historico', 'data_consumo')
         st.session_state['c_dt_ini'] = i
         st.session_state['c_dt_fim'] = f
-    if 'view_consumo' not in st.session_state: st.session_state['view_consumo'] = None 
     
     if 'aud_dt_ini' not in st.session_state:
         d1 = get_max_date_db('plenus_historico', 'data_movimento')
@@ -289,7 +1028,9 @@ def init_session_vars():
         st.session_state['aud_dt_ini'] = date(mx.year, mx.month, 1)
         st.session_state['aud_dt_fim'] = mx
 
-init_session_vars()
+    if 'tend_dt_ini' not in st.session_state:
+        st.session_state['tend_dt_fim'] = st.session_state['aud_dt_fim']
+        st.session_state['tend_dt_ini'] = st.session_state['aud_dt_fim'] - timedelta(days=365)
 
 # --- CSS ---
 st.markdown("""
@@ -322,22 +1063,126 @@ def parse_float_inteligente(valor):
         return float(val_str)
     except: return 0.0
 
+# Número já normalizado (ponto decimal, sem milhar) que o astype(float) converte sem surpresa
+RE_NUMERO_SIMPLES = r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?'
+
+def parse_float_br(valor):
+    """Caminho escalar para parsers em fluxo: (número, válido), com as regras de parse_float_inteligente.
+
+    Sem o except genérico: só texto que não é número cai no ValueError, e volta como inválido (0.0)."""
+    if isinstance(valor, (float, int)): return float(valor), True
+    val_str = str(valor).strip()
+    if not val_str: return 0.0, True
+    if ',' in val_str:
+        if '.' in val_str: val_str = val_str.replace('.', '')
+        val_str = val_str.replace(',', '.')
+    try: return float(val_str), True
+    except ValueError: return 0.0, False
+
+def converter_numeros_br(serie):
+    """parse_float_inteligente em lote. Devolve (valores float64, células inválidas).
+
+    "1.234,5678", "12,5", floats e vazios (0.0) são resolvidos com máscaras de regex e um
+    astype(float) só; o que sobra (nulos, 'nan', '1_000'...) passa por parse_float_br. As
+    inválidas continuam 0.0 nos valores, mas voltam numa Series (índice = linha, valor = texto
+    original) para o chamador avisar em vez de somar zero calado."""
+    if pd.api.types.is_numeric_dtype(serie.dtype):
+        return serie.astype('float64'), serie.iloc[:0]
+    txt = serie.astype(str).str.strip()
+    vazio = txt.eq("").fillna(False).astype(bool)
+    milhar = txt.str.contains(",", regex=False) & txt.str.contains(".", regex=False)
+    norm = txt.mask(milhar.fillna(False).astype(bool), txt.str.replace(".", "", regex=False)).str.replace(",", ".", regex=False)
+    simples = norm.str.fullmatch(RE_NUMERO_SIMPLES).fillna(False).astype(bool)
+    # Cast do Arrow quando o texto já é Arrow (padrão com pyarrow): exato como o float() e ~6x mais
+    # rápido. Nunca pd.to_numeric: o parser dele erra o último dígito de alguns floats.
+    tipo = 'float64[pyarrow]' if isinstance(norm.array, pd.arrays.ArrowStringArray) else 'float64'
+    valores = pd.Series(0.0, index=serie.index)
+    valores[simples] = norm[simples].astype(tipo).astype('float64')
+    resto = ~simples & ~vazio
+    invalidos = serie.iloc[:0]
+    if resto.any():
+        convertidos = [parse_float_br(v) for v in serie[resto]]
+        valores[resto] = [v for v, _ in convertidos]
+        invalidos = serie[resto][[not ok for _, ok in convertidos]]
+    return valores, invalidos
+
 def formatar_br(valor):
     if not isinstance(valor, (float, int)): return str(valor)
     return f"{valor:,.4f}".replace(',', 'X').replace('.', ',').replace('X', '.')
 
+def formatar_br_series(serie, casas=4):
+    """formatar_br em lote para uma coluna numérica: mesmo texto por valor, nulos viram ''.
+    A troca de separadores roda uma vez na coluna inteira (texto em Arrow), não por célula."""
+    nulos = serie.isna().to_numpy()
+    espec = f",.{casas}f"
+    textos = pd.Series([format(v, espec) for v in serie.to_numpy(dtype=float, na_value=0.0)], index=serie.index, dtype='str')
+    textos = textos.str.replace(',', 'X', regex=False).str.replace('.', ',', regex=False).str.replace('X', '.', regex=False)
+    return textos.mask(nulos, "")
+
+# --- REGRAS DE CLASSIFICAÇÃO (DADOS, COM RECARGA) ---
+# Códigos, categorias e termos vêm do documento configuracoes/regras_classificacao do banco
+# ou, sem ele, do arquivo JSON. As fontes são conferidas a cada TTL_REGRAS_S e só recompiladas se mudarem.
+ARQUIVO_REGRAS = config_app('regras_arquivo', regras.ARQUIVO_PADRAO)
+TTL_REGRAS_S = float(config_app('ttl_regras_s', 60))
+COLECAO_CONFIG, DOC_REGRAS = 'configuracoes', 'regras_classificacao'
+
+@st.cache_resource
+def _estado_regras():
+    # cache_resource: um classificador por processo, trocado quando as regras mudam
+    return {'lock': threading.Lock(), 'classificador': None, 'conferido_em': 0.0, 'erro': None}
+
+def _ler_regras():
+    """(dados, fonte): o documento do banco tem prioridade sobre o arquivo."""
+    doc = db.collection(COLECAO_CONFIG).document(DOC_REGRAS).get()
+    contar_leituras()
+    if doc.exists: return doc.to_dict(), 'banco'
+    return regras.ler_arquivo_regras(ARQUIVO_REGRAS), 'arquivo'
+
+def _regras_mudaram():
+    # Leituras de arquivo em cache foram classificadas com as regras antigas
+    extrair_dados_sisflora.clear()
+    extrair_dados_plenus_html.clear()
+
+def obter_regras(forcar=False):
+    """Classificador vigente. Regras novas inválidas não derrubam o app: fica o anterior e o erro é guardado."""
+    estado = _estado_regras()
+    atual = estado['classificador']
+    if atual is not None and not forcar and time.monotonic() - estado['conferido_em'] < TTL_REGRAS_S:
+        return atual
+    with estado['lock']:
+        if not forcar and estado['classificador'] is not None and time.monotonic() - estado['conferido_em'] < TTL_REGRAS_S:
+            return estado['classificador']
+        try:
+            dados, fonte = _ler_regras()
+            if atual is None or fonte != atual.fonte or regras.assinatura_regras(dados) != atual.assinatura:
+                estado['classificador'] = regras.ClassificadorRegras(dados, fonte)
+                if atual is not None: _regras_mudaram()
+            estado['erro'] = None
+        except Exception as e:
+            if atual is None: raise
+            estado['erro'] = f"{type(e).__name__}: {e}"
+        estado['conferido_em'] = time.monotonic()
+        return estado['classificador']
+
+def salvar_regras_db(dados):
+    """Valida e grava as regras no banco (passam a valer para todos na próxima conferência)."""
+    regras.ClassificadorRegras(dados, 'banco')
+    db.collection(COLECAO_CONFIG).document(DOC_REGRAS).set({**dados, 'atualizado_em': datetime.now()})
+    contar_escritas()
+    return obter_regras(forcar=True)
+
+def remover_regras_db():
+    """Apaga o documento do banco: volta a valer o arquivo."""
+    db.collection(COLECAO_CONFIG).document(DOC_REGRAS).delete()
+    contar_escritas()
+    return obter_regras(forcar=True)
+
 def detecting_category(item, origin):
-    cat = "OUTROS"
-    if origin == "SISFLORA":
-        if str(item).startswith("10"): cat = "TORAS"
-        elif str(item).startswith("20") or str(item).startswith("3030"): cat = "SERRADAS"
-        elif str(item).startswith("50"): cat = "BENEFICIADAS"
-    else:
-        txt = str(item).upper()
-        if "BENEF" in txt or "DECK" in txt or "FORRO" in txt or "ASSOALHO" in txt: cat = "BENEFICIADAS"
-        elif "TORA" in txt or "TORO" in txt: cat = "TORAS"
-        elif "SERRAD" in txt or "CAIBRO" in txt or "VIGA" in txt or "PRANCH" in txt or "RIPA" in txt: cat = "SERRADAS"
-    return cat
+    return obter_regras().categoria(item, origin)
+
+def detectar_categorias(itens, origem):
+    """detecting_category em lote: uma regex combinada por valor distinto da coluna."""
+    return obter_regras().categorias(itens, origem)
 
 def detectar_categoria_plenus(item_completo):
     return detecting_category(item_completo, "PLENUS")
@@ -348,7 +1193,8 @@ def sort_key_nomes(item):
     return str(item)
 
 # --- FUNÇÕES AUXILIARES SISTRANSF/EXCEL ---
-def transform_data_sistransf(df, filename="Upload"):
+@instrumentar()
+def transform_data_sistransf(df, filename="Upload", filial=None):
     rows = []
     for idx, row in df.iterrows():
         essencia_origem = str(row.get("Essência Origem", ""))
@@ -407,84 +1253,400 @@ def transform_data_sistransf(df, filename="Upload"):
     df_origem = final_df[mask_origem].drop_duplicates(subset=["numero", "essencia", "volume"], keep="first")
     df_outros = final_df[~mask_origem]
     final_df = pd.concat([df_origem, df_outros], ignore_index=True)
+    final_df["filial"] = filial or unidade_ativa()
     return final_df
 
-def to_excel_autoajustado(df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Relatorio')
-        worksheet = writer.sheets['Relatorio']
-        for i, col in enumerate(df.columns):
-            worksheet.set_column(i, i, 20)
-    return output.getvalue()
-
 # --- ALGORITMO VÍNCULO (Fuzzy) ---
-def limpar_para_comparacao(texto):
-    palavras_lixo = {
-        "MADEIRA", "NATIVA", "SERRADA", "SERRADOS", "SERRADO", "BENEFICIADA", "BENEFICIADO", "BENEFICIADOS", 
-        "TORAS", "TOROS", "TORA", "TORO", "EM", "DE", "DO", "DA", "BRUTO", "APROVEITAMENTO", 
-        "TABUA", "VIGA", "CAIBRO", "PRANCHA", "RIPA", "SARRAFO", "DECK", "ASSOALHO", "FORRO", "-", ".", ",", "(", ")"
-    }
+def limpar_para_comparacao(texto, palavras_lixo=None):
+    if palavras_lixo is None: palavras_lixo = obter_regras().palavras_lixo
     texto_limpo = re.sub(r'[^\w\s]', ' ', texto.upper())
     parts = texto_limpo.split()
     clean_parts = [p for p in parts if p not in palavras_lixo and not p.isdigit()]
     if not clean_parts: return texto.upper()
     return " ".join(clean_parts)
 
-def calcular_similaridade_avancada(nome_plenus, nome_sisflora):
-    essencia_p = limpar_para_comparacao(nome_plenus)
-    essencia_s = limpar_para_comparacao(nome_sisflora)
+def calcular_similaridade_avancada(nome_plenus, nome_sisflora, palavras_lixo=None):
+    if palavras_lixo is None: palavras_lixo = obter_regras().palavras_lixo
+    essencia_p = limpar_para_comparacao(nome_plenus, palavras_lixo)
+    essencia_s = limpar_para_comparacao(nome_sisflora, palavras_lixo)
     ratio_essencia = SequenceMatcher(None, essencia_p, essencia_s).ratio()
     bonus = 0.15 if (len(essencia_p) > 3 and len(essencia_s) > 3) and (essencia_p in essencia_s or essencia_s in essencia_p) else 0
     return min(ratio_essencia + bonus, 1.0)
 
+@instrumentar()
+def sugerir_vinculos_fuzzy(grps_ple, grps_sis, vinculos_atuais, mapa_cat_ple, f_cat_ia="TODAS"):
+    """Para cada grupo Plenus, o grupo Sisflora mais parecido (score > 0.65)."""
+    sugestoes = []
+    palavras_lixo = obter_regras().palavras_lixo  # uma vez: o laço compara todos contra todos
+    for gp in grps_ple:
+        is_vinculado = gp in vinculos_atuais
+        status_vinc = f"✅ Já vinculado a: {vinculos_atuais[gp]}" if is_vinculado else ""
+        cat_p = mapa_cat_ple.get(gp, "OUTROS")
+        if f_cat_ia != "TODAS":
+            cat_normal = cat_p
+            if cat_p in ["TORAS", "TOROS", "TORA"]: cat_normal = "TORAS"
+            elif "SERRADA" in cat_p: cat_normal = "SERRADAS"
+            elif "BENEF" in cat_p: cat_normal = "BENEFICIADAS"
+            if cat_normal != f_cat_ia: continue
+
+        melhor_match = None
+        maior_score = 0.0
+        for gs in grps_sis:
+            score = calcular_similaridade_avancada(gp, gs, palavras_lixo)
+            if score > 0.65 and score > maior_score:
+                maior_score = score
+                melhor_match = gs
+        if melhor_match:
+            sugestoes.append({
+                "Plenus": gp,
+                "Sisflora (Sugerido)": melhor_match,
+                "Categoria": cat_p,
+                "Status": status_vinc,
+                "Confiança": f"{maior_score:.0%}",
+                "Aceitar": False,
+                "is_locked": is_vinculado
+            })
+    return sugestoes
+
+def extrair_nome_bruto(item, origem, classificador):
+    """Parte do nome que descreve a essência: 'código - produto - essência' (Sisflora) ou 'sku - nome (cat)' (Plenus)."""
+    if origem == "SISFLORA":
+        parts = item.split(' - ')
+        candidatos = [p.strip() for p in parts if not re.match(r'^\d+$', p.strip()) and p.strip().upper() not in classificador.termos_genericos]
+        return candidatos[-1] if candidatos else parts[-1]
+    s_clean = item.split(' (')[0]
+    return s_clean.split(' - ', 1)[1].strip() if ' - ' in s_clean else s_clean.strip()
+
 def gerar_sugestao_nome_primeiro(itens_selecionados, categoria_filtro, origem="SISFLORA"):
     if not itens_selecionados: return ""
     primeiro_item = itens_selecionados[0]
-    nome_bruto = ""
-    cat_detectada = ""
-    s_upper = primeiro_item.upper()
+    classificador = obter_regras()
+    cat_detectada = classificador.categoria(primeiro_item, origem)
+    nome_bruto = extrair_nome_bruto(primeiro_item, origem, classificador)
 
-    if origem == "SISFLORA":
-        parts = primeiro_item.split(' - ')
-        candidatos = [p.strip() for p in parts if not re.match(r'^\d+$', p.strip()) and p.strip().upper() not in TERMOS_GENERICOS]
-        nome_bruto = candidatos[-1] if candidatos else parts[-1]
-        if primeiro_item.startswith("10"): cat_detectada = "TORAS"
-        elif primeiro_item.startswith("20") or primeiro_item.startswith("3030"): cat_detectada = "SERRADAS"
-        elif primeiro_item.startswith("50"): cat_detectada = "BENEFICIADAS"
-    else: 
-        s_clean = primeiro_item.split(' (')[0]
-        nome_bruto = s_clean.split(' - ', 1)[1].strip() if ' - ' in s_clean else s_clean.strip()
-        if "BENEF" in s_upper or "DECK" in s_upper: cat_detectada = "BENEFICIADAS"
-        elif "TORA" in s_upper or "TORO" in s_upper: cat_detectada = "TORAS"
-        elif "SERRAD" in s_upper or "CAIBRO" in s_upper or "VIGA" in s_upper: cat_detectada = "SERRADAS"
-
-    TERMOS_LIMPEZA = ["SERRADA", "BENEFICIADA", "TORAS", "TOROS", "TORA", "DE", "DO", "BRUTO", "APROVEITAMENTO"]
     palavras = nome_bruto.upper().replace(".", " ").replace("-", " ").split()
-    essencia_parts = [p for p in palavras if p not in TERMOS_LIMPEZA and not p.isdigit()]
+    essencia_parts = [p for p in palavras if p not in classificador.termos_limpeza_nome and not p.isdigit()]
     essencia_final = " ".join(essencia_parts)
     
     cat_final = categoria_filtro if categoria_filtro else cat_detectada
-    if cat_final == "OUTROS": cat_final = ""
+    if cat_final == classificador.categoria_padrao: cat_final = ""
     
     if cat_final and cat_final not in essencia_final:
         return f"{essencia_final} {cat_final}"
     return essencia_final
 
+# --- AGRUPAMENTO AUTOMÁTICO (PENDENTES) ---
+# Itens pendentes viram propostas de grupo em duas etapas, sem comparar todos contra todos:
+# 1) mesma categoria + mesma chave de essência (nome sem código, medidas, acentos e termos de produto) = mesmo grupo;
+# 2) chaves diferentes só são comparadas dentro do bloco (categoria, primeiras letras da chave) e as que
+#    passam do limiar de similaridade são unidas.
+LIMIAR_AGRUPAMENTO_AUTO = float(config_app('limiar_agrupamento_auto', 0.9))
+PREFIXO_BLOCO_AUTO = 3
+
+def chave_essencia(item, origem, classificador=None):
+    classificador = classificador or obter_regras()
+    nome = unicodedata.normalize('NFKD', extrair_nome_bruto(str(item), origem, classificador)).encode('ascii', 'ignore').decode()
+    palavras = re.sub(r'[^\w\s]', ' ', nome.upper()).split()
+    # Medidas e números (6X12, 2,5M) não separam essências
+    partes = [p for p in palavras if p not in classificador.palavras_lixo and not any(ch.isdigit() for ch in p)]
+    return " ".join(partes) or nome.upper().strip()
+
+def _unir_chaves_parecidas(chaves, limiar):
+    """Union-find das chaves de um bloco com similaridade >= limiar; devolve chave -> representante."""
+    pai = {c: c for c in chaves}
+    def raiz(c):
+        while pai[c] != c:
+            pai[c] = pai[pai[c]]
+            c = pai[c]
+        return c
+    for i, a in enumerate(chaves):
+        for b in chaves[i + 1:]:
+            sm = SequenceMatcher(None, a, b)
+            if sm.real_quick_ratio() >= limiar and sm.quick_ratio() >= limiar and sm.ratio() >= limiar:
+                ra, rb = raiz(a), raiz(b)
+                if ra != rb: pai[rb] = ra
+    return {c: raiz(c) for c in chaves}
+
+@instrumentar()
+def propor_agrupamentos(df_itens, origem, limiar=LIMIAR_AGRUPAMENTO_AUTO, grupos_existentes=()):
+    """df_itens: colunas Item_Completo e Categoria (um item pendente por linha).
+    Devolve um DataFrame de propostas (maiores primeiro) com nome sugerido e a lista de itens."""
+    colunas = ["Aceitar", "Nome do Grupo", "Categoria", "Qtd Itens", "Já existe", "Itens"]
+    if df_itens.empty: return pd.DataFrame(columns=colunas)
+    classificador = obter_regras()
+    df = df_itens.drop_duplicates('Item_Completo').astype({'Item_Completo': str})
+    df['Categoria'] = df['Categoria'].astype(object).fillna("").astype(str)
+    df['chave'] = [chave_essencia(it, origem, classificador) for it in df['Item_Completo']]
+
+    # Etapa 2 só olha as chaves distintas, bloco a bloco
+    df['bloco'] = df['Categoria'] + "|" + df['chave'].str[:PREFIXO_BLOCO_AUTO]
+    representante = {}
+    for (bloco, cat), chaves in df.groupby(['bloco', 'Categoria'], sort=False)['chave']:
+        unicas = sorted(chaves.unique())
+        uniao = _unir_chaves_parecidas(unicas, limiar) if len(unicas) > 1 else {unicas[0]: unicas[0]}
+        representante.update({(cat, c): r for c, r in uniao.items()})
+    df['cluster'] = [representante[(c, k)] for c, k in zip(df['Categoria'], df['chave'])]
+
+    existentes = set(grupos_existentes)
+    propostas = []
+    for (cat, _), grupo in df.groupby(['Categoria', 'cluster'], sort=False):
+        # A variante mais comum da chave vem primeiro: é dela que sai o nome sugerido
+        freq = grupo['chave'].map(grupo['chave'].value_counts())
+        itens = [it for _, it in sorted(zip(-freq, grupo['Item_Completo']), key=lambda x: (x[0], sort_key_nomes(x[1])))]
+        cat_nome = "" if cat == classificador.categoria_padrao else cat
+        nome = gerar_sugestao_nome_primeiro(itens, cat_nome, origem).upper()
+        propostas.append({"Aceitar": True, "Nome do Grupo": nome, "Categoria": cat_nome, "Qtd Itens": len(itens),
+                          "Já existe": nome in existentes, "Itens": itens})
+    return pd.DataFrame(propostas, columns=colunas).sort_values(["Qtd Itens", "Nome do Grupo"], ascending=[False, True], ignore_index=True)
+
+# --- ÍNDICE DE PENDENTES (RADAR DO ADMIN) ---
+# Montado uma vez por carga (df_sisflora / df_plenus): itens distintos com chave de ordenação e
+# categoria. O radar (pendentes fora da cesta) fica em listas ordenadas por categoria e é
+# atualizado item a item quando itens entram/saem da cesta ou viram grupo.
+def chaves_ordenacao(itens):
+    """sort_key_nomes em lote: o que vem depois do primeiro ' - ' (ou o item inteiro)."""
+    partes = itens.str.partition(' - ')
+    return partes[2].str.strip().where(partes[1] != "", itens)
+
+def _montar_indice_pendentes(df, origem, col_cat, mapa, cesta, versao):
+    cats = df[col_cat] if col_cat in df.columns else detectar_categorias(df['Item_Completo'], origem)
+    base = pd.DataFrame({'item': df['Item_Completo'], 'cat': cats}).dropna(subset=['item'])
+    base = base.astype({'item': 'str'}).drop_duplicates('item')
+    base['cat'] = base['cat'].astype(object).fillna("").astype(str)
+    itens, ordens, categorias = base['item'].tolist(), chaves_ordenacao(base['item']).tolist(), base['cat'].tolist()
+    indice = {
+        'versao': versao, 'col_cat': col_cat, 'mapa': mapa, 'cesta': set(cesta),
+        'ordem': dict(zip(itens, ordens)), 'cat': dict(zip(itens, categorias)),
+        'categorias': sorted({c for c in categorias if c}),
+    }
+    indice['pendentes'] = {it for it in itens if it not in mapa}
+    indice['radar_todos'] = sorted((o, it) for o, it in zip(ordens, itens) if it in indice['pendentes'] and it not in indice['cesta'])
+    indice['radar'] = {}
+    for par in indice['radar_todos']:
+        indice['radar'].setdefault(indice['cat'][par[1]], []).append(par)
+    return indice
+
+def _radar_tirar(indice, itens):
+    for it in itens:
+        if it not in indice['ordem']: continue
+        par = (indice['ordem'][it], it)
+        for lista in (indice['radar_todos'], indice['radar'].get(indice['cat'][it], [])):
+            pos = bisect.bisect_left(lista, par)
+            if pos < len(lista) and lista[pos] == par: del lista[pos]
+
+def _radar_voltar(indice, itens):
+    for it in itens:
+        if it not in indice['pendentes'] or it in indice['cesta']: continue
+        par = (indice['ordem'][it], it)
+        for lista in (indice['radar_todos'], indice['radar'].setdefault(indice['cat'][it], [])):
+            pos = bisect.bisect_left(lista, par)
+            if pos == len(lista) or lista[pos] != par: lista.insert(pos, par)
+
+def registrar_agrupados_indice(indice, itens, mapa_novo):
+    """Itens que acabaram de virar grupo: saem dos pendentes sem recomparar o mapa inteiro."""
+    if indice is None: return
+    itens = [it for it in itens if it in indice['pendentes']]
+    _radar_tirar(indice, itens)
+    indice['pendentes'].difference_update(itens)
+    indice['mapa'] = mapa_novo
+
+def indice_pendentes(origem, df, col_cat):
+    """Índice da origem em dia com a carga, o mapa de agrupamentos e a cesta da sessão."""
+    sufixo = origem[:3].lower()
+    chave_idx, mapa, cesta = f'indice_pend_{sufixo}', st.session_state[f'agrup_{sufixo}'], st.session_state[f'cesta_{sufixo}']
+    versao = versao_df_sessao('df_sisflora' if origem == "SISFLORA" else 'df_plenus')
+    indice = st.session_state.get(chave_idx)
+    if indice is None or indice['versao'] != versao or indice['col_cat'] != col_cat:
+        indice = st.session_state[chave_idx] = _montar_indice_pendentes(df, origem, col_cat, mapa, cesta, versao)
+        return indice
+    if indice['mapa'] is not mapa:
+        # Mapa recarregado por outro caminho (exclusão de grupo, recarga): aplica só a diferença
+        antes, depois = set(indice['mapa']), set(mapa)
+        novos = [it for it in depois - antes if it in indice['pendentes']]
+        voltam = [it for it in antes - depois if it in indice['ordem']]
+        registrar_agrupados_indice(indice, novos, mapa)
+        indice['pendentes'].update(voltam)
+        _radar_voltar(indice, voltam)
+    cesta_atual = set(cesta)
+    if cesta_atual != indice['cesta']:
+        entraram, sairam = cesta_atual - indice['cesta'], indice['cesta'] - cesta_atual
+        indice['cesta'] = cesta_atual
+        _radar_tirar(indice, entraram)
+        _radar_voltar(indice, sairam)
+    return indice
+
+def radar_pendentes(indice, categoria="", texto=""):
+    """Itens do radar já ordenados (filtro de categoria pelo balde; texto por busca simples)."""
+    pares = indice['radar'].get(categoria, []) if categoria else indice['radar_todos']
+    if texto:
+        texto = texto.lower()
+        return [it for _, it in pares if texto in it.lower()]
+    return [it for _, it in pares]
+
 # --- PERSISTENCIA DE ESTADO (FIREBASE) ---
+# Preferências por usuário num documento de 'user_prefs' (id = e-mail do login do Streamlit, ou o
+# id anônimo guardado na URL como ?u=): menu, unidade e, por unidade, períodos, filtros e as
+# referências dos últimos dados carregados. Esses dados ficam também em arquivo local por usuário
+# (DIR_CACHE_USUARIOS); uma sessão nova (recarregar a página, reconexão) retoma tudo sem voltar ao
+# banco enquanto o arquivo tiver menos de TTL_CACHE_USUARIO_H. Em outro servidor, sem o arquivo,
+# só os períodos e filtros voltam. save_app_state roda no fim de cada execução e só grava o que mudou.
+# O id anônimo vai junto quando o link é compartilhado: quem abre o link passa a ler e gravar as
+# mesmas preferências. Por isso os dados carregados só são guardados e retomados para usuário
+# logado (st.login), a não ser que retomar_dados_anonimos = 1 (ex.: servidor de um usuário só).
+COLECAO_PREFS = 'user_prefs'
+DIR_CACHE_USUARIOS = config_app('dir_cache_usuarios', os.path.join(tempfile.gettempdir(), 'estoque_usuarios'))
+TTL_CACHE_USUARIO_H = float(config_app('ttl_cache_usuario_h', 12))
+RETOMAR_DADOS_ANONIMOS = str(config_app('retomar_dados_anonimos', '0')).lower() not in ('0', 'false', 'nao', 'não')
+CHAVES_ESTADO_USUARIO = (
+    'p_dt_ini', 'p_dt_fim', 't_dt_ini', 't_dt_fim', 'c_dt_ini', 'c_dt_fim', 'aud_dt_ini', 'aud_dt_fim',
+    'tend_dt_ini', 'tend_dt_fim', 'filtros_ativos_transf',
+)
+# Frames retomáveis -> valores da sessão que dizem de onde vieram (exibição depende deles)
+DADOS_RETOMAVEIS = {
+    'df_sisflora': ('sis_source', 'sis_volumes_invalidos'),
+    'df_plenus': ('ple_source', 'lista_erro_plenus'),
+    'view_transf': ('plano_transf',),
+    'view_consumo': (),
+    'df_auditoria': ('auditoria_periodo',),
+    'df_tendencia': ('tendencia_periodo',),
+}
+
+def usuario_logado():
+    """E-mail do login (se o app usa st.login), pronto para id de documento; None sem login."""
+    try:
+        if st.user.is_logged_in and st.user.email: return re.sub(r'[^\w@.-]', '_', str(st.user.email))
+    except Exception:
+        pass  # sem autenticação configurada
+    return None
+
+def guarda_dados_usuario():
+    """Frames carregados vão para o cache do usuário? Só com login (o id anônimo vai junto no link)."""
+    return usuario_logado() is not None or RETOMAR_DADOS_ANONIMOS
+
+def usuario_atual():
+    """Dono das preferências: e-mail do login (se o app usa st.login) ou id anônimo da URL."""
+    logado = usuario_logado()
+    if logado: return logado
+    anonimo = st.query_params.get('u')
+    if not anonimo or not re.fullmatch(r'[0-9a-f]{12}', anonimo):
+        anonimo = uuid.uuid4().hex[:12]
+        st.query_params['u'] = anonimo
+    return anonimo
+
+def _valor_para_prefs(valor):
+    """Valores da sessão -> JSON do documento (datas marcadas para voltar como date)."""
+    if isinstance(valor, (datetime, date)): return {'__data__': valor.isoformat()}
+    if isinstance(valor, (list, tuple)): return [_valor_para_prefs(v) for v in valor]
+    if isinstance(valor, dict): return {str(k): _valor_para_prefs(v) for k, v in valor.items()}
+    if valor is None or isinstance(valor, (str, bool, int, float)): return valor
+    return str(valor)
+
+def _valor_de_prefs(valor):
+    if isinstance(valor, dict) and set(valor) == {'__data__'}:
+        txt = valor['__data__']
+        return datetime.fromisoformat(txt) if 'T' in txt else date.fromisoformat(txt)
+    if isinstance(valor, list): return [_valor_de_prefs(v) for v in valor]
+    if isinstance(valor, dict): return {k: _valor_de_prefs(v) for k, v in valor.items()}
+    return valor
+
+def _arquivo_cache_usuario(usuario, filial, chave):
+    return os.path.join(DIR_CACHE_USUARIOS, usuario, filial, f"{chave}.parquet")
+
+@instrumentar()
+def ler_prefs_usuario(usuario):
+    try:
+        doc = db.collection(COLECAO_PREFS).document(usuario).get()
+        contar_leituras()
+        return (doc.to_dict() or {}) if doc.exists else {}
+    except Exception:
+        return {}
+
+def retomar_dados_usuario(refs):
+    """Recoloca na sessão os frames do cache local do usuário (os vencidos ou sumidos são esquecidos)."""
+    versoes = st.session_state.setdefault('versoes_dados_usuario', {})
+    filial = unidade_ativa()
+    for chave, ref in list(refs.items()):
+        if chave not in DADOS_RETOMAVEIS: continue
+        if tem_df_sessao(chave):
+            # Frame ainda no armazém (volta de outra unidade): só o estado que a troca apagou
+            for k, v in ref.get('estado', {}).items(): st.session_state.setdefault(k, _valor_de_prefs(v))
+            continue
+        idade_h = (time.time() - ref.get('salvo_em', 0)) / 3600
+        try:
+            if idade_h > TTL_CACHE_USUARIO_H: raise FileNotFoundError(ref.get('arquivo'))
+            df = ler_frame(ref['arquivo'], ref.get('formato'))
+        except Exception:
+            refs.pop(chave)
+            continue
+        guardar_df_sessao(chave, df)
+        versoes[(filial, chave)] = versao_df_sessao(chave)
+        for k, v in ref.get('estado', {}).items(): st.session_state[k] = _valor_de_prefs(v)
+        st.session_state.setdefault('dados_retomados', []).append((chave, ref['salvo_em']))
+
 def load_app_state():
-    """Carrega estado de navegação do Firebase (Simulado ou Real)."""
-    # Em Web App multi-usuário, o 'estado' geralmente é da sessão (cookie).
-    # Aqui vamos usar apenas st.session_state que já persiste enquanto a aba está aberta.
-    # Se quiser salvar preferências de usuário no DB, usaria uma coleção 'user_prefs'.
+    """Na 1ª execução da sessão lê as preferências do usuário; a cada troca de unidade aplica as dela."""
     if 'menu_sel_idx' not in st.session_state: st.session_state['menu_sel_idx'] = 0
+    if 'prefs' not in st.session_state:
+        prefs = ler_prefs_usuario(usuario_atual())
+        prefs.pop('atualizado_em', None)
+        st.session_state['prefs'] = prefs
+        st.session_state['prefs_gravadas'] = json.dumps(prefs, sort_keys=True, default=str)
+        if isinstance(prefs.get('menu_sel_idx'), int): st.session_state['menu_sel_idx'] = prefs['menu_sel_idx']
+        if prefs.get('filial') in UNIDADES and 'filial' not in st.session_state: st.session_state['filial'] = prefs['filial']
+    filial = unidade_ativa()
+    if st.session_state.get('prefs_unidade') == filial: return
+    st.session_state['prefs_unidade'] = filial
+    bloco = st.session_state['prefs'].setdefault('unidades', {}).setdefault(filial, {})
+    for chave, valor in bloco.get('estado', {}).items():
+        if chave in CHAVES_ESTADO_USUARIO and chave not in st.session_state: st.session_state[chave] = _valor_de_prefs(valor)
+    if guarda_dados_usuario(): retomar_dados_usuario(bloco.setdefault('dados', {}))
+
+def _atualizar_cache_usuario(bloco):
+    """Grava em arquivo os frames retomáveis que mudaram nesta execução (e esquece os removidos)."""
+    versoes = st.session_state.setdefault('versoes_dados_usuario', {})
+    filial, refs = unidade_ativa(), bloco.setdefault('dados', {})
+    for chave, companheiros in DADOS_RETOMAVEIS.items():
+        versao = versao_df_sessao(chave)
+        if versao == versoes.get((filial, chave)): continue
+        versoes[(filial, chave)] = versao
+        arquivo = _arquivo_cache_usuario(usuario_atual(), filial, chave)
+        if versao is None:
+            refs.pop(chave, None)
+            for arq in (arquivo, arquivo + '.pkl'):
+                if os.path.exists(arq): os.remove(arq)
+            continue
+        df = obter_df_sessao(chave)
+        try:
+            formato = gravar_frame(df, arquivo)
+        except Exception:
+            refs.pop(chave, None)
+            continue
+        refs[chave] = {'arquivo': arquivo, 'formato': formato, 'salvo_em': time.time(), 'linhas': len(df),
+                       'estado': {k: _valor_para_prefs(st.session_state.get(k)) for k in companheiros}}
 
 def save_app_state():
-    """Salva apenas na sessão local por enquanto."""
-    pass
+    """Grava as preferências do usuário em 'user_prefs' quando algo mudou desde a última gravação."""
+    if 'prefs' not in st.session_state: return
+    prefs = st.session_state['prefs']
+    prefs['menu_sel_idx'] = st.session_state.get('menu_sel_idx', 0)
+    prefs['filial'] = unidade_ativa()
+    bloco = prefs.setdefault('unidades', {}).setdefault(unidade_ativa(), {})
+    bloco['estado'] = {c: _valor_para_prefs(st.session_state[c]) for c in CHAVES_ESTADO_USUARIO if c in st.session_state}
+    if guarda_dados_usuario(): _atualizar_cache_usuario(bloco)
+    else: bloco.pop('dados', None)  # não deixa referências de dados num id que pode estar num link
+    assinatura = json.dumps(prefs, sort_keys=True, default=str)
+    if assinatura == st.session_state.get('prefs_gravadas'): return
+    try:
+        db.collection(COLECAO_PREFS).document(usuario_atual()).set({**prefs, 'atualizado_em': datetime.now().isoformat(timespec='seconds')})
+        contar_escritas()
+        st.session_state['prefs_gravadas'] = assinatura
+    except Exception as e:
+        # Tenta de novo na próxima execução (a assinatura gravada não mudou)
+        st.sidebar.warning(f"⚠️ Preferências não gravadas: {e}")
 
 # --- FUNÇÕES DB (AGRUPAMENTOS / VINCULOS) ---
 @st.cache_data(ttl="1h")
+@instrumentar()
 def carregar_agrupamentos_db(origem):
     # Collection: agrupamentos
     query = db.collection('agrupamentos').where('origem', '==', origem)
@@ -503,37 +1665,48 @@ def get_categorias_dos_grupos(origem):
     # Mode logic
     return df.groupby('nome_grupo')['categoria'].agg(lambda x: x.mode()[0] if not x.mode().empty else "OUTROS").to_dict()
 
-def salvar_agrupamento_db(itens, nome_grupo, origem, categoria_detectada):
-    batch = db.batch()
+def salvar_agrupamentos_lote(grupos, origem):
+    """Grava vários grupos [(nome_grupo, itens, categoria)] numa passada de lotes. Devolve o nº de itens."""
     coll = db.collection('agrupamentos')
-    
+    batch, count, total = db.batch(), 0, 0
     try:
-        for it in itens:
-            # Cria ID único composto para evitar duplicatas: ORIGEM_ITEM
-            safe_item = re.sub(r'[^a-zA-Z0-9]', '', it)[:100]
-            doc_id = f"{origem}_{safe_item}"
-            doc_ref = coll.document(doc_id)
-            batch.set(doc_ref, {
-                'item_original': it,
-                'nome_grupo': nome_grupo,
-                'origem': origem,
-                'categoria': categoria_detectada
-            })
-        batch.commit()
-        st.toast(f"✅ Grupo Salvo: {nome_grupo}", icon="💾")
+        for nome_grupo, itens, categoria in grupos:
+            for it in itens:
+                # Cria ID único composto para evitar duplicatas: ORIGEM_ITEM
+                safe_item = re.sub(r'[^a-zA-Z0-9]', '', it)[:100]
+                batch.set(coll.document(f"{origem}_{safe_item}"), {
+                    'item_original': it,
+                    'nome_grupo': nome_grupo,
+                    'origem': origem,
+                    'categoria': categoria
+                })
+                count += 1
+                if count >= 450:
+                    commit_lote(batch, count)
+                    batch, total, count = db.batch(), total + count, 0
+        if count > 0:
+            commit_lote(batch, count)
+            total += count
+    finally:
         carregar_agrupamentos_db.clear()
+    return total
+
+def salvar_agrupamento_db(itens, nome_grupo, origem, categoria_detectada):
+    try:
+        salvar_agrupamentos_lote([(nome_grupo, itens, categoria_detectada)], origem)
+        st.toast(f"✅ Grupo Salvo: {nome_grupo}", icon="💾")
     except Exception as e: st.error(f"Erro Firebase: {e}")
 
 def excluir_grupo_db(nome_grupo, origem):
     # Query docs to delete
-    docs = db.collection('agrupamentos').where('nome_grupo', '==', nome_grupo).where('origem', '==', origem).stream()
+    docs = stream_contado(db.collection('agrupamentos').where('nome_grupo', '==', nome_grupo).where('origem', '==', origem))
     batch = db.batch()
     count = 0
     for doc in docs:
         batch.delete(doc.reference)
         count += 1
     if count > 0:
-        batch.commit()
+        commit_lote(batch, count)
     carregar_agrupamentos_db.clear()
 
 def carregar_vinculos_db():
@@ -557,7 +1730,7 @@ def salvar_vinculo_db(grupos_plenus_lista, grupo_sisflora):
             'grupo_plenus': gp,
             'grupo_sisflora': grupo_sisflora
         })
-    batch.commit()
+    commit_lote(batch, len(grupos_plenus_lista))
     st.toast("🔗 Vínculo criado!", icon="🔗")
 
 def excluir_vinculo_db(grupo_plenus):
@@ -575,27 +1748,155 @@ def check_dates_exist(collection, col_data, datas_lista):
     d_min = min(datas_lista).strftime("%Y-%m-%d")
     d_max = max(datas_lista).strftime("%Y-%m-%d")
     
-    # Pega todos docs nesse range de datas
-    docs = db.collection(collection)\
-             .where(col_data, '>=', d_min)\
-             .where(col_data, '<=', d_max)\
-             .select([col_data]).stream() # Seleciona só o campo data para economizar
+    # Pega todos docs nesse range de datas (partições em paralelo)
+    docs = ler_periodo_paralelo(collection, col_data, d_min, d_max, campos=[col_data]) # Seleciona só o campo data para economizar
              
     found = set()
     for d in docs:
-        val = d.to_dict().get(col_data)
+        val = d.get(col_data)
         if val: found.add(val)
     
     return found
 
-def salvar_lote_smart(collection, col_data, df):
-    """Salva dados no Firebase filtrando datas já existentes."""
+# --- IMPORTAÇÕES (DIÁRIO + PUBLICAÇÃO EM LOTES) ---
+# Uma gravação de histórico vira uma importação: as linhas a gravar vão primeiro para um diário
+# local (DIR_IMPORTACOES/{filial}/{id}.parquet) e o registro em 'importacoes' (da unidade) guarda
+# coleção, período, linhas e quantas já foram publicadas. A publicação grava em lotes com ids
+# fixos {id}_{seq}, e cada lote atualiza 'publicadas' no mesmo commit: depois de uma falha ou
+# cancelamento, retomar continua do primeiro lote que faltou (regravar um id não duplica) e
+# desfazer apaga exatamente os ids publicados, sem consultar datas. O diário é apagado quando
+# a importação termina; para retomar, o diário tem que estar no servidor que a começou.
+COLECAO_IMPORTACOES = 'importacoes'
+DIR_IMPORTACOES = config_app('dir_importacoes', os.path.join(tempfile.gettempdir(), 'estoque_importacoes'))
+LOTE_PUBLICACAO = 450
+STATUS_PUBLICAVEL = ('preparada', 'publicando')
+# Interrompidas: bloqueiam novas gravações no período
+STATUS_IMPORTACAO_ABERTA = STATUS_PUBLICAVEL + ('desfazendo',)
+
+def _arquivo_diario(filial, import_id):
+    return os.path.join(DIR_IMPORTACOES, filial, f"{import_id}.parquet")
+
+def ler_importacao(import_id):
+    doc = colecao_db(COLECAO_IMPORTACOES).document(import_id).get()
+    contar_leituras()
+    return doc.to_dict() if doc.exists else None
+
+@instrumentar()
+def listar_importacoes(limite=200):
+    """Importações da unidade ativa, mais recentes primeiro."""
+    query = colecao_db(COLECAO_IMPORTACOES).order_by('criada_em', direction=firestore.Query.DESCENDING).limit(limite)
+    return [d.to_dict() for d in stream_contado(query)]
+
+def importacoes_abertas(collection, d_min, d_max):
+    """Importações não concluídas da coleção que cobrem algum dia de [d_min, d_max]. O status vai
+    na consulta (índice colecao+status em firestore.indexes.json): as concluídas, que se acumulam
+    a cada importação, não são lidas."""
+    query = (colecao_db(COLECAO_IMPORTACOES).where('colecao', '==', collection)
+             .where('status', 'in', list(STATUS_IMPORTACAO_ABERTA)))
+    return [m for m in (d.to_dict() for d in stream_contado(query)) if m['dt_min'] <= d_max and m['dt_max'] >= d_min]
+
+def preparar_importacao(collection, col_data, df_to_save, existentes=0):
+    """Grava o diário e o registro da importação ('preparada'); devolve o id."""
+    filial = unidade_ativa()
+    import_id = f"{datetime.now():%Y%m%d%H%M%S}_{uuid.uuid4().hex[:6]}"
+    arquivo = _arquivo_diario(filial, import_id)
+    formato = gravar_frame(df_to_save.reset_index(drop=True), arquivo)
+    origens = sorted(df_to_save['arquivo_origem'].dropna().astype(str).unique()) if 'arquivo_origem' in df_to_save.columns else []
+    meta = {
+        'id': import_id, 'colecao': collection, 'col_data': col_data, 'filial': filial, 'status': 'preparada',
+        'linhas': len(df_to_save), 'publicadas': 0, 'existentes': existentes,
+        'dt_min': str(df_to_save[col_data].min()), 'dt_max': str(df_to_save[col_data].max()),
+        'origem': ", ".join(origens)[:500], 'arquivo': arquivo, 'formato': formato,
+        'criada_em': datetime.now().isoformat(timespec='seconds'), 'concluida_em': None, 'erro': None,
+    }
+    colecao_db(COLECAO_IMPORTACOES).document(import_id).set(meta)
+    contar_escritas()
+    return import_id
+
+@instrumentar()
+def publicar_importacao(import_id, _tarefa=None):
+    """Publica (ou retoma) a importação a partir do primeiro lote ainda não gravado; devolve as linhas gravadas agora."""
+    meta = ler_importacao(import_id)
+    if meta is None: raise ValueError(f"Importação {import_id} não encontrada nesta unidade.")
+    if meta['status'] not in STATUS_PUBLICAVEL: raise ValueError(f"Importação {import_id} está {meta['status']}.")
+    if not os.path.exists(meta['arquivo']) and not os.path.exists(meta['arquivo'] + '.pkl'):
+        raise FileNotFoundError(f"Diário da importação {import_id} não está neste servidor: desfaça e importe de novo.")
+    records = ler_frame(meta['arquivo'], meta.get('formato')).to_dict(orient='records')
+    coll, ref_meta = colecao_db(meta['colecao'], meta['filial']), colecao_db(COLECAO_IMPORTACOES).document(import_id)
+    inicio = publicadas = meta['publicadas']
+    try:
+        while publicadas < len(records):
+            lote = records[publicadas:publicadas + LOTE_PUBLICACAO]
+            batch = db.batch()
+            for seq, rec in enumerate(lote, start=publicadas):
+                batch.set(coll.document(f"{import_id}_{seq:06d}"), rec)
+            fim = publicadas + len(lote)
+            batch.set(ref_meta, {**meta, 'status': 'publicando', 'publicadas': fim})
+            commit_lote(batch, len(lote) + 1)
+            # Só depois do commit: se ele falhar, o registro fica com o último lote que entrou
+            publicadas = fim
+            # Entre lotes: o que já foi gravado fica gravado (e registrado) se a tarefa for cancelada
+            atualizar_tarefa(_tarefa, progresso=publicadas / len(records),
+                             mensagem=f"{publicadas}/{len(records)} gravados", parcial=publicadas - inicio)
+        ref_meta.set({**meta, 'status': 'publicada', 'publicadas': publicadas, 'concluida_em': datetime.now().isoformat(timespec='seconds')})
+        contar_escritas()
+        for arq in (meta['arquivo'], meta['arquivo'] + '.pkl'):
+            if os.path.exists(arq): os.remove(arq)
+    except TarefaCancelada:
+        raise
+    except Exception as e:
+        ref_meta.set({**meta, 'status': 'publicando', 'publicadas': publicadas, 'erro': f"{type(e).__name__}: {e}"})
+        raise
+    finally:
+        invalidar_espelho(meta['colecao'], meta['dt_min'], meta['dt_max'])
+    return publicadas - inicio
+
+@instrumentar()
+def desfazer_importacao(import_id, _tarefa=None):
+    """Apaga os documentos publicados pela importação (pelos ids) e a marca como desfeita."""
+    meta = ler_importacao(import_id)
+    if meta is None: raise ValueError(f"Importação {import_id} não encontrada nesta unidade.")
+    if meta['status'] == 'desfeita': return 0
+    coll, ref_meta = colecao_db(meta['colecao'], meta['filial']), colecao_db(COLECAO_IMPORTACOES).document(import_id)
+    restantes = meta['publicadas']
+    try:
+        while restantes > 0:
+            # Do fim para o começo: uma interrupção deixa 'publicadas' certo para retomar o desfazer
+            ini = max(restantes - LOTE_PUBLICACAO, 0)
+            batch = db.batch()
+            for seq in range(ini, restantes): batch.delete(coll.document(f"{import_id}_{seq:06d}"))
+            batch.set(ref_meta, {**meta, 'status': 'desfazendo', 'publicadas': ini})
+            commit_lote(batch, restantes - ini + 1)
+            restantes = ini
+            atualizar_tarefa(_tarefa, progresso=1 - restantes / max(meta['publicadas'], 1), mensagem=f"{restantes} ainda publicados")
+        ref_meta.set({**meta, 'status': 'desfeita', 'publicadas': 0, 'concluida_em': datetime.now().isoformat(timespec='seconds')})
+        contar_escritas()
+    finally:
+        invalidar_espelho(meta['colecao'], meta['dt_min'], meta['dt_max'])
+    for arq in (meta['arquivo'], meta['arquivo'] + '.pkl'):
+        if os.path.exists(arq): os.remove(arq)
+    return meta['publicadas']
+
+@instrumentar()
+def salvar_lote_smart(collection, col_data, df, _tarefa=None):
+    """Salva dados no Firebase (na unidade ativa) filtrando datas já existentes, como importação
+    (diário + publicação em lotes). Devolve (gravados, datas que já existiam)."""
     if df.empty: return 0, 0
+    filial = unidade_ativa()
+    conferir_unidade_df(df, filial)
     
     # Converte coluna de data para string YYYY-MM-DD
     df_check = df.copy()
     if pd.api.types.is_datetime64_any_dtype(df_check[col_data]):
         df_check[col_data] = df_check[col_data].dt.strftime("%Y-%m-%d")
+    df_check['filial'] = filial
+    
+    # Dias de uma importação interrompida parecem "já existentes": retome ou desfaça antes
+    d_min, d_max = str(df_check[col_data].min()), str(df_check[col_data].max())
+    abertas = importacoes_abertas(collection, d_min, d_max)
+    if abertas:
+        raise ValueError(f"Importação {abertas[0]['id']} ({abertas[0]['publicadas']}/{abertas[0]['linhas']} linhas) ficou incompleta "
+                         f"neste período: retome ou desfaça em Gestão > Importações antes de gravar de novo.")
     
     dates_unique = [datetime.strptime(d, "%Y-%m-%d").date() for d in df_check[col_data].unique()]
     existing = check_dates_exist(collection, col_data, dates_unique)
@@ -605,104 +1906,440 @@ def salvar_lote_smart(collection, col_data, df):
     if df_to_save.empty:
         return 0, len(existing)
     
-    # Batch writes (limit 500 ops per batch)
-    records = df_to_save.to_dict(orient='records')
-    batch = db.batch()
-    count = 0
-    total_saved = 0
-    
-    for rec in records:
-        doc_ref = db.collection(collection).document() # Auto ID
-        batch.set(doc_ref, rec)
-        count += 1
-        if count >= 450:
-            batch.commit()
-            batch = db.batch()
-            total_saved += count
-            count = 0
-    
-    if count > 0:
-        batch.commit()
-        total_saved += count
-        
-    return total_saved, len(existing)
+    import_id = preparar_importacao(collection, col_data, df_to_save, len(existing))
+    return publicar_importacao(import_id, _tarefa=_tarefa), len(existing)
 
+@instrumentar()
 def excluir_periodo_tabela(collection, col_data, dt_ini, dt_fim):
     d_i = dt_ini.strftime("%Y-%m-%d")
     d_f = dt_fim.strftime("%Y-%m-%d")
     
-    docs = db.collection(collection).where(col_data, '>=', d_i).where(col_data, '<=', d_f).stream()
+    # Para apagar basta o id: lê só o campo de data, em partições paralelas
+    docs = ler_periodo_paralelo(collection, col_data, d_i, d_f, campos=[col_data])
+    coll = colecao_db(collection)
     
     count = 0
     batch = db.batch()
     for doc in docs:
-        batch.delete(doc.reference)
+        batch.delete(coll.document(doc['firebase_id']))
         count += 1
         if count % 450 == 0:
-            batch.commit()
+            commit_lote(batch, 450)
             batch = db.batch()
     
     if count % 450 != 0:
-        batch.commit()
+        commit_lote(batch, count % 450)
+    invalidar_espelho(collection, d_i, d_f)
     return count
 
+@instrumentar()
+def migrar_raiz_para_unidade(filial, colecoes=COLECOES_POR_UNIDADE, _tarefa=None):
+    """Copia o histórico das coleções da raiz (anterior às unidades) para unidades/{filial}/..., com os
+    mesmos ids e o campo 'filial'. Não apaga a raiz: depois de conferir, desligue unidade_padrao_na_raiz."""
+    copiados = {}
+    for i, nome in enumerate(colecoes):
+        destino = db.collection(f"unidades/{filial}/{nome}")
+        atualizar_tarefa(_tarefa, progresso=i / len(colecoes), mensagem=f"copiando {nome}")
+        count = 0
+        batch = db.batch()
+        for doc in stream_contado(db.collection(nome)):
+            batch.set(destino.document(doc.id), {**doc.to_dict(), 'filial': filial})
+            count += 1
+            if count % 450 == 0:
+                commit_lote(batch, 450)
+                batch = db.batch()
+                atualizar_tarefa(_tarefa, mensagem=f"copiando {nome}: {count} documentos")
+        if count % 450 != 0:
+            commit_lote(batch, count % 450)
+        copiados[nome] = count
+    espelho = obter_espelho()
+    if espelho is not None: espelho.invalidar(filial=filial)
+    return copiados
+
+# --- ESPELHO LOCAL: SINCRONIZAÇÃO E LEITURA ---
+@instrumentar()
+def sincronizar_espelho(colecao, dt_ini, dt_fim, forcar=False):
+    """Traz do banco só os dias do período que o espelho ainda não tem (ou que venceram)."""
+    espelho = obter_espelho()
+    if espelho is None: return 0
+    filial = unidade_ativa()
+    if forcar: espelho.invalidar(colecao, dt_ini, dt_fim, filial=filial)
+    col_data = analitico.COLECOES_ESPELHO[colecao]['data']
+    def _sincronizar_particao(d_i, d_f):
+        items = _ler_particao(colecao, col_data, d_i, d_f)
+        # Cada partição é gravada assim que chega: se outra falhar, esta não precisa ser relida
+        espelho.gravar_periodo(colecao, pd.DataFrame(items), d_i, d_f, filial=filial)
+        return len(items)
+    pendentes = espelho.dias_pendentes(colecao, dt_ini, dt_fim, TTL_ESPELHO_MIN, filial=filial)
+    particoes = [p for d_i, d_f in analitico.agrupar_dias_contiguos(pendentes)
+                 for p in dividir_periodo(d_i, d_f)]
+    return sum(executar_em_paralelo([(_sincronizar_particao, a, b) for a, b in particoes], pool=_pool_leituras(LEITURAS_PARALELAS)))
+
+def carregar_do_espelho(colecao, dt_ini, dt_fim, filtros=None):
+    """Período (com filtros {coluna: valores} em SQL) lido do espelho, já com o schema da coleção."""
+    sincronizar_espelho(colecao, dt_ini, dt_fim)
+    df = obter_espelho().consultar(colecao, dt_ini, dt_fim, filtros, filial=unidade_ativa())
+    schema = SCHEMAS_COLECOES.get(colecao)
+    if schema and not df.empty:
+        antes = memoria_df_mb(df)
+        df = otimizar_tipos_df(df, schema)
+        registrar_memoria_carga(f"{colecao} (espelho)", len(df), antes, memoria_df_mb(df))
+    return df
+
+def invalidar_espelho(colecao, dt_ini=None, dt_fim=None):
+    espelho = obter_espelho()
+    if espelho is not None and colecao in analitico.COLECOES_ESPELHO:
+        espelho.invalidar(colecao, dt_ini, dt_fim, filial=unidade_ativa())
+
 # --- FUNÇÕES DE LEITURA ESPECÍFICAS ---
+MAPA_FILTROS_TRANSF = {
+    "Número": "numero", "Situação": "situacao",
+    "PRODUTO": "tipo_produto", "Produto": "produto", "Popular": "popular",
+    "Essência": "essencia", "Unidade": "unidade"
+}
+
+def combinar_filtros_transf(lista_filtros):
+    """{coluna do banco: valores}; filtros repetidos na mesma coluna se combinam (interseção
+    dos valores). None quando a interseção fica vazia (nada pode casar)."""
+    filtros = {}
+    for f in lista_filtros or []:
+        col_db = MAPA_FILTROS_TRANSF.get(f['col'])
+        if col_db and f['vals']:
+            atuais = filtros.get(col_db)
+            filtros[col_db] = [v for v in f['vals'] if v in atuais] if atuais is not None else list(f['vals'])
+            if not filtros[col_db]: return None
+    return filtros
+
+def filtrar_transf_local(df, filtros):
+    """Mesmos filtros em pandas (documentos que chegam pelo ouvinte da consulta)."""
+    for col_db, valores in filtros.items():
+        if col_db in df.columns: df = df[df[col_db].astype(str).isin([str(v) for v in valores])]
+    return df
+
+@instrumentar()
 def carregar_transf_filtrado_db(dt_ini, dt_fim, lista_filtros=None):
-    # Firestore Filter
-    query = db.collection('transf_historico')\
-              .where('data_realizacao', '>=', dt_ini.strftime("%Y-%m-%d"))\
-              .where('data_realizacao', '<=', dt_fim.strftime("%Y-%m-%d"))
-    
-    df = firestore_to_df('transf_historico', query)
-    
-    if df.empty: return df
-    
-    # Aplica filtros extras via Pandas (Firestore tem limitações com múltiplos filtros 'in')
-    mapa_cols = {
-        "Número": "numero", "Situação": "situacao",
-        "PRODUTO": "tipo_produto", "Produto": "produto", "Popular": "popular",
-        "Essência": "essencia", "Unidade": "unidade"
-    }
-    
-    if lista_filtros:
-        for f in lista_filtros:
-            col_db = mapa_cols.get(f['col'])
-            valores = f['vals']
-            if col_db and valores and col_db in df.columns:
-                df = df[df[col_db].isin(valores)]
-                
+    filtros = combinar_filtros_transf(lista_filtros)
+    if filtros is None: return pd.DataFrame()
+
+    # O filtro mais seletivo com índice vai na consulta do Firestore (e na do ouvinte, via attrs)
+    plano = planejar_consulta('transf_historico', 'data_realizacao', filtros)
+    if obter_espelho() is not None:
+        # Espelho local: os filtros vão para o WHERE em vez de filtrar depois em pandas
+        df = carregar_do_espelho('transf_historico', dt_ini, dt_fim, filtros)
+        df.attrs['plano_banco'] = plano
+        return df
+
+    # Firestore: sub-consultas mensais em paralelo
+    with medir_etapa('consulta_transf_planejada', plano=descrever_plano(plano), fracao_estimada=round(plano['fracao'], 3)) as etapa:
+        df = carregar_periodo_df('transf_historico', 'data_realizacao', dt_ini, dt_fim, filtro=plano['banco'])
+        if plano['banco'] is None: registrar_cardinalidades('transf_historico', df)
+        for col_db, valores in plano['local'].items():
+            if col_db in df.columns: df = df[df[col_db].isin(valores)]
+        etapa['linhas'] = len(df)
+    df.attrs['plano_consulta'] = f"{descrever_plano(plano)} · {etapa['docs_lidos']} documentos lidos, {len(df)} devolvidos"
+    df.attrs['plano_banco'] = plano
     return df
 
+@instrumentar()
 def carregar_plenus_movimento_db(dt_ini, dt_fim):
-    query = db.collection('plenus_historico')\
-              .where('data_movimento', '>=', dt_ini.strftime("%Y-%m-%d"))\
-              .where('data_movimento', '<=', dt_fim.strftime("%Y-%m-%d"))
-    return firestore_to_df('plenus_historico', query)
-
+    if obter_espelho() is not None:
+        return carregar_do_espelho('plenus_historico', dt_ini, dt_fim)
+    return carregar_periodo_df('plenus_historico', 'data_movimento', dt_ini, dt_fim)
+
+def preparar_plenus_historico(df_hist):
+    """Movimentos do banco no formato da tela do Plenus (nomes do relatório, data BR, item e categoria)."""
+    df_hist = df_hist.rename(columns={'tipo_movimento': 'tipo', 'saldo_apos': 'saldo'})
+    df_hist['data'] = pd.to_datetime(df_hist['data_movimento']).dt.strftime("%d/%m/%Y")
+    if 'categoria' not in df_hist.columns: df_hist['categoria'] = ""
+    df_hist["Item_Completo"] = montar_item_plenus(df_hist)
+    df_hist["Cat_Auto"] = detectar_categorias(df_hist["Item_Completo"], "PLENUS")
+    return df_hist
+
+@instrumentar()
 def carregar_consumo_filtrado_db(dt_ini, dt_fim):
-    query = db.collection('consumo_historico')\
-              .where('data_consumo', '>=', dt_ini.strftime("%Y-%m-%d"))\
-              .where('data_consumo', '<=', dt_fim.strftime("%Y-%m-%d"))
-    df = firestore_to_df('consumo_historico', query)
-    
+    if obter_espelho() is not None:
+        df = carregar_do_espelho('consumo_historico', dt_ini, dt_fim)
+    else:
+        df = carregar_periodo_df('consumo_historico', 'data_consumo', dt_ini, dt_fim)
+    return expandir_json_consumo(df)
+
+def expandir_json_consumo(df):
+    """Linhas originais do relatório (dados_json) como colunas; mantém o firebase_id de cada uma."""
     # Expand JSON logic
     if not df.empty and 'dados_json' in df.columns:
         try:
             # Dropna and iterate
-            json_series = df['dados_json'].dropna()
+            json_series = df['dados_json'].dropna().astype(str)
+            json_series = json_series[json_series != ""]
             if not json_series.empty:
-                list_of_dicts = [json.loads(x) for x in json_series if x]
-                df_expanded = pd.json_normalize(list_of_dicts)
-                # Merge logic needs simple concat if index aligns, or just return expanded
-                # Simpler: return fields that matter
+                with medir_etapa('consumo_expandir_json') as etapa:
+                    list_of_dicts = [json.loads(x) for x in json_series]
+                    df_expanded = pd.json_normalize(list_of_dicts)
+                    etapa['linhas'] = len(df_expanded)
+                # Simpler: return fields that matter (e o id, para a atualização ao vivo)
+                if 'firebase_id' in df.columns:
+                    df_expanded['firebase_id'] = df.loc[json_series.index, 'firebase_id'].to_numpy()
+                antes = memoria_df_mb(df_expanded)
+                df_expanded = otimizar_tipos_df(df_expanded, {'Data': 'datetime'}, auto_categoria=True)
+                registrar_memoria_carga('consumo_historico (json)', len(df_expanded), antes, memoria_df_mb(df_expanded))
                 return df_expanded
         except: pass
     return df
 
+# --- ATUALIZAÇÃO AO VIVO (OUVINTES) ---
+# Frames carregados do histórico (df_plenus, view_transf, view_consumo) ganham um on_snapshot
+# restrito ao período carregado. O callback (thread do Firestore) só enfileira as mudanças por
+# documento; vigiar_alteracoes, um fragmento na sidebar, aplica a fila no frame da sessão (tira
+# os ids removidos ou alterados, junta os novos) e roda o app de novo. No Firestore o primeiro
+# snapshot lê o período uma vez: é comparado com o frame pelos ids (inclusões e remoções) e pelo
+# update_time (edições desde o início da carga); depois só chegam os documentos alterados.
+# Ouvintes de sessões que pararam de olhar são desligados.
+ATUALIZACAO_AO_VIVO = str(config_app('atualizacao_ao_vivo', '1')).lower() not in ('0', 'false', 'nao', 'não')
+INTERVALO_AO_VIVO_S = float(config_app('intervalo_ao_vivo_s', 5))
+TTL_OUVINTE_MIN = float(config_app('ttl_ouvinte_min', 10))
+MAX_OUVINTES = int(config_app('max_ouvintes', 60))
+# Folga para relógio do servidor adiantado em relação ao update_time do banco
+FOLGA_RELOGIO_S = 60
+NOMES_AO_VIVO = {'df_plenus': 'Plenus', 'view_transf': 'Transformação', 'view_consumo': 'Consumo'}
+
+@st.cache_resource
+def _registro_ouvintes():
+    return {'lock': threading.Lock(), 'ouvintes': {}}
+
+def _enfileirar_snapshot(entrada, docs, mudancas, read_time):
+    """Callback do on_snapshot: enfileira (id, dados), com dados None para documento removido."""
+    ids_carregados = entrada.pop('ids_carregados', None)
+    if ids_carregados is not None:
+        # Primeiro snapshot: o frame já tem o período; entra só o que mudou entre a carga e o ouvinte
+        # (documento novo, ou já carregado mas gravado depois do início da carga)
+        limite = entrada['lido_em'] - timedelta(seconds=FOLGA_RELOGIO_S)
+        atuais = set()
+        for doc in docs:
+            atuais.add(doc.id)
+            alterado = getattr(doc, 'update_time', None) is None or doc.update_time >= limite
+            if doc.id not in ids_carregados or alterado: entrada['fila'].append((doc.id, doc.to_dict()))
+        for doc_id in ids_carregados - atuais: entrada['fila'].append((doc_id, None))
+        return
+    for m in mudancas:
+        entrada['fila'].append((m.document.id, None if m.type.name == 'REMOVED' else m.document.to_dict()))
+
+def parar_ouvinte(chave):
+    reg = _registro_ouvintes()
+    with reg['lock']:
+        entrada = reg['ouvintes'].pop(_chave_armazem(chave), None)
+    if entrada: entrada['watch'].unsubscribe()
+
+def ouvir_periodo(chave, colecao, col_data, dt_ini, dt_fim, lido_em, preparar=None, ordem=None, filtro=None):
+    """Liga (ou troca) o ouvinte do frame da sessão ao período carregado. lido_em é a hora (UTC)
+    em que a carga começou; preparar converte os documentos novos para o formato do frame;
+    ordem são as colunas de ordenação da tela; filtro é o (campo, valores) do planejador."""
+    parar_ouvinte(chave)
+    df = obter_df_sessao(chave)
+    if not ATUALIZACAO_AO_VIVO or df is None or 'firebase_id' not in df.columns: return False
+    reg = _registro_ouvintes()
+    limite = time.time() - TTL_OUVINTE_MIN * 60
+    with reg['lock']:
+        abandonados = [reg['ouvintes'].pop(k) for k, e in list(reg['ouvintes'].items()) if e['visto'] < limite]
+        lotado = len(reg['ouvintes']) >= MAX_OUVINTES
+    for e in abandonados: e['watch'].unsubscribe()
+    if lotado: return False
+    d_i, d_f = pd.Timestamp(dt_ini).strftime("%Y-%m-%d"), pd.Timestamp(dt_fim).strftime("%Y-%m-%d")
+    entrada = {'colecao': colecao, 'periodo': (d_i, d_f), 'preparar': preparar, 'ordem': ordem or [],
+               'fila': deque(), 'ids_carregados': set(df['firebase_id'].astype(str)), 'lido_em': lido_em,
+               'visto': time.time(), 'aplicadas': 0}
+    query = _aplicar_filtro_banco(colecao_db(colecao).where(col_data, '>=', d_i).where(col_data, '<=', d_f), filtro)
+    entrada['watch'] = query.on_snapshot(functools.partial(_enfileirar_snapshot, entrada))
+    with reg['lock']:
+        reg['ouvintes'][_chave_armazem(chave)] = entrada
+    return True
+
+def aplicar_fila_ouvinte(chave, entrada):
+    """Aplica as mudanças enfileiradas no frame da sessão; devolve quantos documentos mudaram."""
+    mudancas = {}
+    while entrada['fila']:
+        doc_id, dados = entrada['fila'].popleft()
+        mudancas[doc_id] = dados  # vale a última mudança de cada documento
+    if not mudancas: return 0
+    df = obter_df_sessao(chave)
+    if df is None: return 0
+    with medir_etapa('aplicar_ao_vivo', frame=chave) as etapa:
+        base = df[~df['firebase_id'].astype(str).isin(list(mudancas))]
+        novos = [{**dados, 'firebase_id': doc_id} for doc_id, dados in mudancas.items() if dados is not None]
+        if novos:
+            df_novos = otimizar_tipos_df(pd.DataFrame(novos), SCHEMAS_COLECOES.get(entrada['colecao']))
+            if entrada['preparar']: df_novos = entrada['preparar'](df_novos)
+            base = pd.concat([base, df_novos], ignore_index=True) if not base.empty else df_novos
+            # Categorias diferentes viram object no concat: volta aos tipos do frame
+            cats = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype) and c in base.columns]
+            if cats: base = base.assign(**{c: base[c].astype('category') for c in cats})
+        ordem = [c for c in entrada['ordem'] if c in base.columns]
+        if ordem: base = base.sort_values(ordem, kind='stable', ignore_index=True)
+        etapa['linhas'] = len(mudancas)
+    guardar_df_sessao(chave, base)
+    entrada['aplicadas'] += len(mudancas)
+    return len(mudancas)
+
+def ouvintes_da_sessao():
+    sessao, unidade, _ = _chave_armazem(None)
+    reg = _registro_ouvintes()
+    with reg['lock']:
+        return {k[2]: e for k, e in reg['ouvintes'].items() if k[:2] == (sessao, unidade)}
+
+@st.fragment(run_every=INTERVALO_AO_VIVO_S)
+def vigiar_alteracoes():
+    """Sidebar: aplica o que os ouvintes da sessão receberam e, se algo mudou, redesenha o app."""
+    ouvintes = ouvintes_da_sessao()
+    if not ouvintes: return
+    aplicadas = {}
+    for chave, entrada in ouvintes.items():
+        entrada['visto'] = time.time()
+        if not tem_df_sessao(chave):
+            parar_ouvinte(chave)
+            continue
+        n = aplicar_fila_ouvinte(chave, entrada)
+        if n: aplicadas[chave] = n
+    periodo = lambda e: " a ".join(pd.Timestamp(d).strftime("%d/%m/%Y") for d in e['periodo'])
+    st.caption("🔴 Ao vivo: " + "; ".join(
+        f"{NOMES_AO_VIVO.get(c, c)} ({periodo(e)}, {e['aplicadas']} alterações)" for c, e in ouvintes.items()))
+    if aplicadas:
+        st.session_state['alteracoes_ao_vivo'] = aplicadas
+        st.rerun(scope="app")
+
 # --- SISFLORA DB SPECIFIC ---
+# Cada saldo (data_referencia) tem um metadado em 'sisflora_snapshots' (id = data) e as linhas em
+# 'sisflora_historico'. Saldo 'completo' grava todas as linhas; saldo 'delta' grava só as linhas
+# novas/alteradas (op='set') e removidas (op='del') em relação ao saldo 'base' (o anterior). A cada
+# SISFLORA_CHECKPOINT saldos na cadeia sai um completo, então reconstruir uma data lê no máximo um
+# completo + (N-1) deltas. Datas gravadas antes dos deltas (sem metadado) contam como completas.
+SISFLORA_CHECKPOINT = int(config_app('sisflora_checkpoint', 7))
+SISFLORA_DELTA_MAX = 0.5  # delta com mais mudanças que isso (fração das linhas) não compensa: grava completo
+COLS_SISFLORA_DB = ["produto", "essencia", "unidade", "volume_disponivel", "codigo", "cat_auto"]
+META_SISFLORA_LEGADO = '_legado'  # marca que as datas antigas já foram catalogadas
+
+def _txt_col(df, col):
+    if col not in df.columns: return pd.Series("", index=df.index)
+    return df[col].astype(object).where(df[col].notna(), "").astype(str)
+
+def chaves_linhas_sisflora(df):
+    """Chave estável de cada linha: código/produto/essência/unidade (repetidas ganham #1, #2...)."""
+    base = _txt_col(df, 'codigo') + "|" + _txt_col(df, 'produto') + "|" + _txt_col(df, 'essencia') + "|" + _txt_col(df, 'unidade')
+    return base + "#" + base.groupby(base).cumcount().astype(str)
+
+def _assinatura_linhas_sisflora(df):
+    volume = pd.to_numeric(df['volume_disponivel'], errors='coerce').round(6).astype(str)
+    return _txt_col(df, 'cat_auto') + "|" + volume
+
+def _catalogar_sisflora_legado(metas):
+    """Datas gravadas antes dos deltas viram saldos completos (varre as linhas uma única vez)."""
+    datas = {d.to_dict().get('data_referencia') for d in stream_contado(colecao_db('sisflora_historico').select(['data_referencia']))}
+    novos = {d: {'data_referencia': d, 'tipo': 'completo', 'base': None, 'profundidade': 0, 'legado': True}
+             for d in datas if d and d not in metas}
+    novos[META_SISFLORA_LEGADO] = {'catalogado_em': datetime.now().isoformat(timespec='seconds'), 'datas': len(novos)}
+    coll = colecao_db('sisflora_snapshots')
+    batch, count = db.batch(), 0
+    for doc_id, meta in novos.items():
+        batch.set(coll.document(doc_id), meta)
+        count += 1
+        if count >= 450:
+            commit_lote(batch, count)
+            batch, count = db.batch(), 0
+    if count > 0: commit_lote(batch, count)
+    return novos
+
+def _metas_sisflora():
+    """{data: metadado} de todos os saldos gravados."""
+    metas = {d.id: d.to_dict() for d in stream_contado(colecao_db('sisflora_snapshots'))}
+    if META_SISFLORA_LEGADO not in metas: metas.update(_catalogar_sisflora_legado(metas))
+    metas.pop(META_SISFLORA_LEGADO, None)
+    return metas
+
+def _cadeia_sisflora(d_str, metas):
+    """Datas a aplicar para montar d_str: do completo mais próximo até ela."""
+    cadeia, atual = [], d_str
+    while atual:
+        if atual not in metas: raise ValueError(f"Saldo Sisflora de {atual} não encontrado (base de {cadeia[-1] if cadeia else d_str}).")
+        cadeia.append(atual)
+        atual = metas[atual].get('base') if metas[atual].get('tipo') == 'delta' else None
+    return cadeia[::-1]
+
+def _ler_linhas_sisflora(d_str):
+    return firestore_to_df('sisflora_historico', colecao_db('sisflora_historico').where('data_referencia', '==', d_str))
+
+def _reconstruir_sisflora(d_str, metas):
+    """Linhas do saldo d_str (colunas do banco): o completo da cadeia com os deltas aplicados em ordem."""
+    cadeia = _cadeia_sisflora(d_str, metas)
+    partes = executar_em_paralelo([(_ler_linhas_sisflora, d) for d in cadeia])
+    frames = []
+    for ordem, df in enumerate(partes):
+        if df.empty: continue
+        extras = {'_ordem': ordem}
+        if 'op' not in df.columns: extras['op'] = 'set'
+        if 'linha' not in df.columns: extras['linha'] = range(len(df))
+        # Linhas antigas não têm chave: calcula igual à gravação
+        if 'chave' not in df.columns or df['chave'].isna().all(): extras['chave'] = chaves_linhas_sisflora(df)
+        frames.append(df.assign(**extras))
+    cols = COLS_SISFLORA_DB + ['chave', 'linha']
+    if not frames: return pd.DataFrame(columns=cols)
+    todas = pd.concat([f.reindex(columns=cols + ['op', '_ordem']) for f in frames], ignore_index=True)
+    # A última operação de cada chave vale; 'del' tira a linha do saldo
+    finais = todas.drop_duplicates('chave', keep='last')
+    finais = finais[finais['op'] != 'del'].sort_values('linha', kind='stable')
+    return finais[cols].reset_index(drop=True)
+
+def _gravar_linhas_sisflora(registros, meta):
+    """Grava as linhas e, junto com o último lote, o metadado (o saldo só aparece depois dele; se um
+    lote falhar, as linhas já gravadas ficam sem metadado e a próxima gravação da data as apaga)."""
+    coll = colecao_db('sisflora_historico')
+    batch, count = db.batch(), 0
+    for rec in registros:
+        batch.set(coll.document(), rec)
+        count += 1
+        if count >= 450:
+            commit_lote(batch, count)
+            batch, count = db.batch(), 0
+    batch.set(colecao_db('sisflora_snapshots').document(meta['data_referencia']), meta)
+    commit_lote(batch, count + 1)
+
+def _apagar_linhas_sisflora(d_str):
+    docs = stream_contado(colecao_db('sisflora_historico').where('data_referencia', '==', d_str).select(['data_referencia']))
+    batch = db.batch()
+    c = 0
+    for doc in docs:
+        batch.delete(doc.reference)
+        c += 1
+        if c >= 450:
+            commit_lote(batch, c)
+            batch = db.batch()
+            c = 0
+    if c > 0: commit_lote(batch, c)
+
+def _registros_sisflora(df, d_str, arquivo):
+    return df.assign(data_referencia=d_str, arquivo_origem=arquivo, op='set', filial=unidade_ativa()).to_dict(orient='records')
+
+def _remover_saldo_sisflora(d_str, metas):
+    """Apaga o saldo d_str. Os deltas que usam ele como base são materializados (viram completos) antes."""
+    dependentes = sorted(d for d, m in metas.items() if m.get('tipo') == 'delta' and m.get('base') == d_str)
+    for dep in dependentes:
+        df_dep = _reconstruir_sisflora(dep, metas)
+        _apagar_linhas_sisflora(dep)
+        metas[dep] = {**metas[dep], 'tipo': 'completo', 'base': None, 'profundidade': 0}
+        _gravar_linhas_sisflora(_registros_sisflora(df_dep, dep, metas[dep].get('arquivo_origem', "")), metas[dep])
+    _apagar_linhas_sisflora(d_str)
+    colecao_db('sisflora_snapshots').document(d_str).delete()
+    contar_escritas()
+    metas.pop(d_str, None)
+
+@instrumentar()
 def salvar_lote_sisflora_db(df, data_ref, nome_arquivo):
-    # 1. Deleta existente nessa data
-    excluir_sisflora_por_data(data_ref)
+    """Grava o saldo da data como delta do saldo anterior (ou completo). Devolve o metadado gravado."""
+    d_str = data_ref.strftime("%Y-%m-%d")
+    conferir_unidade_df(df, unidade_ativa())
+    metas = _metas_sisflora()
+    # 1. Regravação: substitui o saldo existente (dependentes materializados antes). Sem metadado,
+    # apaga as linhas da data mesmo assim: uma gravação que falhou antes do último lote deixa
+    # linhas órfãs, que seriam lidas de volta junto com as novas
+    if d_str in metas: _remover_saldo_sisflora(d_str, metas)
+    else: _apagar_linhas_sisflora(d_str)
     
     # 2. Prepara dados
     df_save = df.copy()
@@ -711,81 +2348,85 @@ def salvar_lote_sisflora_db(df, data_ref, nome_arquivo):
         "Volume Disponivel": "volume_disponivel", "Codigo": "codigo", "Cat_Auto": "cat_auto"
     }
     df_save.rename(columns=rename_map, inplace=True)
-    cols_db = ["produto", "essencia", "unidade", "volume_disponivel", "codigo", "cat_auto"]
-    for c in cols_db:
+    for c in COLS_SISFLORA_DB:
         if c not in df_save.columns: df_save[c] = ""
     
-    df_save = df_save[cols_db].copy()
-    df_save["data_referencia"] = data_ref.strftime("%Y-%m-%d")
-    df_save["arquivo_origem"] = nome_arquivo
-    
-    # 3. Salva Lote
-    records = df_save.to_dict(orient='records')
-    batch = db.batch()
-    count = 0
-    for rec in records:
-        doc_ref = db.collection('sisflora_historico').document()
-        batch.set(doc_ref, rec)
-        count += 1
-        if count >= 450:
-            batch.commit()
-            batch = db.batch()
-            count = 0
-    if count > 0: batch.commit()
-    return True
-
+    df_save = df_save[COLS_SISFLORA_DB].reset_index(drop=True)
+    df_save["chave"] = chaves_linhas_sisflora(df_save)
+    df_save["linha"] = range(len(df_save))
+
+    meta = {'data_referencia': d_str, 'arquivo_origem': nome_arquivo, 'linhas': len(df_save),
+            'volume_total': float(pd.to_numeric(df_save['volume_disponivel'], errors='coerce').sum()),
+            'salvo_em': datetime.now().isoformat(timespec='seconds'), 'filial': unidade_ativa(),
+            'tipo': 'completo', 'base': None, 'profundidade': 0}
+    registros = None
+
+    # 3. Delta contra o saldo anterior, se a cadeia ainda não pede um completo
+    anteriores = sorted(d for d in metas if d < d_str)
+    if anteriores:
+        base = anteriores[-1]
+        profundidade = int(metas[base].get('profundidade') or 0) + 1
+        if profundidade < SISFLORA_CHECKPOINT:
+            df_base = _reconstruir_sisflora(base, metas)
+            assinatura_base = pd.Series(_assinatura_linhas_sisflora(df_base).values, index=df_base['chave'])
+            mudou = df_save['chave'].map(assinatura_base).ne(_assinatura_linhas_sisflora(df_save))
+            removidas = df_base.loc[~df_base['chave'].isin(df_save['chave']), 'chave']
+            if mudou.sum() + len(removidas) <= SISFLORA_DELTA_MAX * max(len(df_save), 1):
+                registros = _registros_sisflora(df_save[mudou], d_str, nome_arquivo)
+                registros += [{'data_referencia': d_str, 'chave': k, 'op': 'del', 'filial': unidade_ativa()} for k in removidas]
+                meta.update(tipo='delta', base=base, profundidade=profundidade,
+                            alteradas=int(mudou.sum()), removidas=len(removidas))
+    if registros is None:
+        registros = _registros_sisflora(df_save, d_str, nome_arquivo)
+
+    # 4. Salva Lote
+    _gravar_linhas_sisflora(registros, meta)
+    return meta
+
+@instrumentar()
 def carregar_sisflora_data_db(data_ref):
-    query = db.collection('sisflora_historico').where('data_referencia', '==', data_ref.strftime("%Y-%m-%d"))
-    df = firestore_to_df('sisflora_historico', query)
-    if not df.empty:
-        df.rename(columns={
-            "produto": "Produto", "essencia": "Essencia", "unidade": "Unidade",
-            "volume_disponivel": "Volume Disponivel", "codigo": "Codigo", "cat_auto": "Cat_Auto"
-        }, inplace=True)
-        df["Item_Completo"] = df.apply(lambda x: f"{x['Produto']} - {x['Essencia']}" if x['Essencia'] else x['Produto'], axis=1)
+    d_str = data_ref.strftime("%Y-%m-%d")
+    metas = _metas_sisflora()
+    if d_str not in metas: return pd.DataFrame()
+    df = _reconstruir_sisflora(d_str, metas).drop(columns=['chave', 'linha'])
+    if df.empty: return df
+    df = otimizar_tipos_df(df.assign(data_referencia=d_str, arquivo_origem=metas[d_str].get('arquivo_origem', "")),
+                           SCHEMAS_COLECOES['sisflora_historico'])
+    df.rename(columns={
+        "produto": "Produto", "essencia": "Essencia", "unidade": "Unidade",
+        "volume_disponivel": "Volume Disponivel", "codigo": "Codigo", "cat_auto": "Cat_Auto"
+    }, inplace=True)
+    df["Item_Completo"] = montar_item_completo(df["Produto"], df["Essencia"])
     return df
 
 def get_datas_sisflora_disponiveis():
-    # Firestore nao tem SELECT DISTINCT. Tem que puxar tudo (leve se for so metadados, mas aqui nao temos tabela separada)
-    # Solucao: Criar uma coleção 'meta_sisflora_dates' seria o ideal.
-    # Por agora, scan all (cuidado com custo).
-    # ALTERNATIVA: Limite
-    docs = db.collection('sisflora_historico').select(['data_referencia']).stream()
-    datas = set()
-    for d in docs:
-        val = d.to_dict().get('data_referencia')
-        if val: datas.add(val)
-    
-    dt_objs = [datetime.strptime(d, "%Y-%m-%d").date() for d in datas]
+    # Lê só os metadados (um documento por data), não as linhas
+    dt_objs = [datetime.strptime(d, "%Y-%m-%d").date() for d in _metas_sisflora()]
     return sorted(dt_objs, reverse=True)
 
 def excluir_sisflora_por_data(data_ref):
     d_str = data_ref.strftime("%Y-%m-%d")
-    docs = db.collection('sisflora_historico').where('data_referencia', '==', d_str).stream()
-    batch = db.batch()
-    c = 0
-    for doc in docs:
-        batch.delete(doc.reference)
-        c += 1
-        if c >= 450:
-            batch.commit()
-            batch = db.batch()
-            c = 0
-    if c > 0: batch.commit()
+    metas = _metas_sisflora()
+    if d_str in metas: _remover_saldo_sisflora(d_str, metas)
+    else: _apagar_linhas_sisflora(d_str)
     return True
 
 # --- LEITURA SISFLORA (PDF) ---
 @st.cache_data(show_spinner=False)
-def extrair_dados_sisflora(arquivo):
+@instrumentar()
+def extrair_dados_sisflora(arquivo, filial=None, _tarefa=None):
     dados_brutos = []
     with pdfplumber.open(arquivo) as pdf:
-        for page in pdf.pages:
+        n_paginas = len(pdf.pages)
+        for i, page in enumerate(pdf.pages):
             tabela = page.extract_table()
             if tabela:
                 for linha in tabela:
                     txt = "".join([str(c) for c in linha if c]).lower()
                     if "governo" in txt or "sisflora" in txt or "página" in txt: continue
                     dados_brutos.append(linha)
+            atualizar_tarefa(_tarefa, progresso=0.9 * (i + 1) / n_paginas,
+                             mensagem=f"página {i + 1}/{n_paginas}", parcial=len(dados_brutos))
     
     linhas_corrigidas = []
     linha_anterior = None
@@ -827,34 +2468,29 @@ def extrair_dados_sisflora(arquivo):
     if "Unidade" not in df.columns: df["Unidade"] = ""
     if "Volume Disponivel" not in df.columns: df["Volume Disponivel"] = "0"
     
-    def extrair_codigo(val):
-        match = re.match(r'^(\d+)', str(val).strip())
-        return match.group(1) if match else None
-    
-    df['Codigo'] = df['Produto'].apply(extrair_codigo)
-    df = df[df['Codigo'].isin(CODIGOS_ACEITOS)].copy()
-    
-    def limpa_prod(texto):
-        match = re.match(r'^(\d+)', str(texto).strip())
-        if match and match.group(1) in MAPA_CORRECAO_PRODUTOS:
-             return MAPA_CORRECAO_PRODUTOS[match.group(1)]
-        return str(texto).strip()
+    classificador = obter_regras()
+    df['Codigo'] = classificador.codigos_produto(df['Produto'])
+    df = df[df['Codigo'].isin(classificador.codigos_aceitos)].copy()
     
     def limpa_ess(texto):
         t = str(texto).replace('\n', ' ').strip()
         t = re.sub(r'(CCSEMA\s*[-–]?\s*\d+|PMFS|AUTEX|PEF|\d{3,}/\d{4}|GERAL\s*ST\s*[\d,.-]+)', '', t, flags=re.IGNORECASE)
         return re.sub(r'^[-–\s]+|[-–\s]+$', '', t).strip()
 
-    df["Volume Disponivel"] = df["Volume Disponivel"].apply(parse_float_inteligente)
-    df["Produto"] = df["Produto"].apply(limpa_prod)
+    df["Volume Disponivel"], invalidos = converter_numeros_br(df["Volume Disponivel"])
+    df["Produto"] = classificador.corrigir_produtos(df["Produto"])
     df["Essencia"] = df["Essencia"].apply(limpa_ess)
-    df["Item_Completo"] = df.apply(lambda x: f"{x['Produto']} - {x['Essencia']}" if x['Essencia'] else x['Produto'], axis=1)
-    df["Cat_Auto"] = df["Item_Completo"].apply(lambda x: detecting_category(x, "SISFLORA"))
+    df["Item_Completo"] = montar_item_completo(df["Produto"], df["Essencia"])
+    df["Cat_Auto"] = detectar_categorias(df["Item_Completo"], "SISFLORA")
+    # Volumes ilegíveis entram como 0: a tela avisa quais foram
+    df["filial"] = filial or unidade_ativa()
+    df.attrs['volumes_invalidos'] = [{"Item": df.at[i, "Item_Completo"], "Volume lido": str(v)} for i, v in invalidos.items()]
     return df
 
 # --- LEITURA SISCONSUMO ---
 @st.cache_data(show_spinner=False)
-def load_data_consumo_excel(file):
+@instrumentar()
+def load_data_consumo_excel(file, filial=None):
     try:
         df = pd.read_excel(file, header=1)
     except Exception:
@@ -865,19 +2501,100 @@ def load_data_consumo_excel(file):
         df['Quantidade'] = pd.to_numeric(df['Quantidade'], errors='coerce').fillna(0)
     if 'Data' in df.columns:
         df['Data'] = pd.to_datetime(df['Data'], errors='coerce')
+    df['filial'] = filial or unidade_ativa()
     return df
 
 # --- LEITURA PLENUS (HTML) ---
+# Diferença aceita entre o saldo do relatório e o recalculado (valores vêm com 4 casas)
+TOLERANCIA_SALDO_PLENUS = float(config_app('tolerancia_saldo_plenus', 0.01))
+COLUNAS_VALIDACAO_PLENUS = ["SKU", "Produto", "Anterior", "Entradas", "Saídas", "Saldo Calculado", "Total",
+                            "Diferença", "Movimentos", "Linhas Divergentes", "1ª Divergência", "Status"]
+# Importação incremental: o que o arquivo traz dos dias que já estão no banco
+COLUNAS_SOBREPOSICAO_PLENUS = ["Desde", "Mov. Já no Banco", "Entradas Já no Banco", "Saídas Já no Banco", "Saldo no Corte"]
+
+def _nova_conta_sku(produto):
+    return {'produto': produto, 'anterior': 0.0, 'entradas': 0.0, 'saidas': 0.0, 'corrente': 0.0, 'total': None,
+            'movimentos': 0, 'divergentes': 0, 'primeira': None, 'aberto': False,
+            'desde': None, 'sobre_mov': 0, 'sobre_ent': 0.0, 'sobre_sai': 0.0, 'saldo_corte': 0.0}
+
+def _conferir_linha_plenus(conta, tipo_up, data_raw, ent, sai, sal, coberto=False):
+    """Acumula uma linha na conta do SKU: Anterior abre o saldo, Total fecha, o resto encadeia
+    saldo anterior + entrada - saída e confere com o saldo da linha. Linhas de dias já gravados
+    (coberto) somam também na sobreposição."""
+    if tipo_up in ('ANTERIOR', 'ANTERIOR:'):
+        conta['anterior'] = conta['corrente'] = conta['saldo_corte'] = sal
+    elif tipo_up in ('TOTAL', 'TOTAL:'):
+        conta['total'] = sal
+    else:
+        conta['movimentos'] += 1
+        conta['entradas'] += ent
+        conta['saidas'] += sai
+        if abs(conta['corrente'] + ent - sai - sal) > TOLERANCIA_SALDO_PLENUS:
+            conta['divergentes'] += 1
+            if conta['primeira'] is None: conta['primeira'] = f"{data_raw or '?'} ({conta['movimentos']}º mov.)"
+        # Segue pelo saldo impresso: uma linha errada não contamina as seguintes
+        conta['corrente'] = sal
+        if coberto:
+            conta['desde'] = conta['desde'] or data_raw
+            conta['sobre_mov'] += 1
+            conta['sobre_ent'] += ent
+            conta['sobre_sai'] += sai
+            conta['saldo_corte'] = sal
+
+def _tabela_validacao_plenus(contas, incremental=False):
+    """(tabela por SKU, erros no formato da lista de erros de leitura)."""
+    linhas, erros = [], []
+    for sku, c in contas.items():
+        calculado = c['anterior'] + c['entradas'] - c['saidas']
+        diferenca = None if c['total'] is None else c['total'] - calculado
+        if c['total'] is None:
+            status, erro = "Sem Total", "Sem Total"
+        elif abs(diferenca) > TOLERANCIA_SALDO_PLENUS:
+            status, erro = "Total divergente", f"Total {formatar_br(c['total'])} ≠ calculado {formatar_br(calculado)}"
+        elif c['divergentes']:
+            status, erro = "Saldo divergente", f"Saldo não fecha em {c['divergentes']} linha(s), 1ª em {c['primeira']}"
+        else:
+            status, erro = "OK", None
+        linhas.append([sku, c['produto'], c['anterior'], c['entradas'], c['saidas'], calculado, c['total'],
+                       diferenca, c['movimentos'], c['divergentes'], c['primeira'], status]
+                      + ([c['desde'], c['sobre_mov'], c['sobre_ent'], c['sobre_sai'], c['saldo_corte']] if incremental else []))
+        if erro: erros.append({"SKU": sku, "Produto": c['produto'], "Erro": erro})
+    colunas = COLUNAS_VALIDACAO_PLENUS + (COLUNAS_SOBREPOSICAO_PLENUS if incremental else [])
+    return pd.DataFrame(linhas, columns=colunas), erros
+
 @st.cache_data(show_spinner=False)
-def extrair_dados_plenus_html(arquivo_html, nome_arquivo="Upload"):
+@instrumentar()
+def extrair_dados_plenus_html(arquivo_html, nome_arquivo="Upload", corte=None, filial=None):
+    """Lê o relatório de movimentação. Devolve (df, erros, validacao): erros é a lista de
+    problemas para exibir (sem Total, valores inválidos, saldos que não fecham) e validacao a
+    tabela por SKU (Anterior + Σentrada - Σsaída contra o Total e o saldo de cada linha),
+    conferida na mesma passada da leitura.
+
+    Com corte (YYYY-MM-DD, último dia já gravado) a leitura é incremental: os dias até o corte
+    entram só na conferência e nas colunas de sobreposição da validacao; o df traz os dias
+    novos, abertos por um Anterior com o saldo do SKU no corte."""
     soup = BeautifulSoup(arquivo_html, 'html.parser')
     dados_extraidos = []
-    skus_vistos = set()
-    skus_com_total = set()
+    contas = {}
+    celulas_invalidas = []
     state = {'categoria': None, 'sku': None, 'produto': None}
     
     def safe_txt(c): return c.get_text(strip=True) if c else ''
     
+    def registro(data_raw, data_db, tipo, ent, sai, sal):
+        return {
+            "sku": state['sku'],
+            "produto": state['produto'],
+            "categoria": state['categoria'],
+            "data": data_raw,
+            "data_movimento": data_db,
+            "tipo": tipo,
+            "entrada": ent,
+            "saida": sai,
+            "saldo": sal,
+            "arquivo_origem": nome_arquivo
+        }
+    
     rows = soup.find_all('tr')
     for tr in rows:
         cols = tr.find_all('td')
@@ -896,23 +2613,28 @@ def extrair_dados_plenus_html(arquivo_html, nome_arquivo="Upload"):
                 if new_sku != state['sku']:
                     state['sku'] = new_sku
                     state['produto'] = new_prod
-                    if state['sku']: skus_vistos.add(state['sku'])
+                    if state['sku'] and state['sku'] not in contas: contas[state['sku']] = _nova_conta_sku(new_prod)
             continue
         if state['sku']:
             tipo_cell = tr.find('td', class_=['s14', 's25'])
             if not tipo_cell: continue
             tipo = safe_txt(tipo_cell)
             
-            ent = parse_float_inteligente(safe_txt(tr.find('td', class_='s15') or tr.find('td', class_='s21')))
-            sai = parse_float_inteligente(safe_txt(tr.find('td', class_='s16') or tr.find('td', class_='s22')))
-            sal = parse_float_inteligente(safe_txt(tr.find('td', class_='s17') or tr.find('td', class_='s23')))
+            valores = {}
+            for campo, classes in (("entrada", ('s15', 's21')), ("saida", ('s16', 's22')), ("saldo", ('s17', 's23'))):
+                txt_valor = safe_txt(tr.find('td', class_=classes[0]) or tr.find('td', class_=classes[1]))
+                valores[campo], valido = parse_float_br(txt_valor)
+                if not valido:
+                    celulas_invalidas.append({"SKU": state['sku'], "Produto": state['produto'],
+                                              "Erro": f"Valor inválido em {campo} ({tipo}): '{txt_valor}'"})
+            ent, sai, sal = valores["entrada"], valores["saida"], valores["saldo"]
             
             data_raw = safe_txt(tr.find('td', class_='s13'))
+            tipo_up = tipo.upper()
             
-            if tipo.upper() in ['TOTAL', 'TOTAL:']:
-                skus_com_total.add(state['sku'])
+            if tipo_up in ['TOTAL', 'TOTAL:']:
                 data_raw = "Total"
-            elif tipo.upper() in ['ANTERIOR', 'ANTERIOR:']:
+            elif tipo_up in ['ANTERIOR', 'ANTERIOR:']:
                 data_raw = "Anterior"
             
             data_db = None
@@ -920,37 +2642,290 @@ def extrair_dados_plenus_html(arquivo_html, nome_arquivo="Upload"):
                 try: data_db = datetime.strptime(data_raw, "%d/%m/%Y").strftime("%Y-%m-%d")
                 except: pass
             
-            dados_extraidos.append({
-                "sku": state['sku'],
-                "produto": state['produto'],
-                "categoria": state['categoria'],
-                "data": data_raw,
-                "data_movimento": data_db,
-                "tipo": tipo,
-                "entrada": ent,
-                "saida": sai,
-                "saldo": sal,
-                "arquivo_origem": nome_arquivo
-            })
+            conta = contas[state['sku']]
+            abertura = conta['corrente']
+            coberto = corte is not None and data_db is not None and data_db <= corte
+            _conferir_linha_plenus(conta, tipo_up, data_raw, ent, sai, sal, coberto)
+            
+            if corte is not None:
+                # Dia já gravado (ou o Anterior do arquivo): só conferência, não vira registro
+                if coberto or data_raw == "Anterior": continue
+                if not conta['aberto']:
+                    conta['aberto'] = True
+                    dados_extraidos.append(registro("Anterior", None, "Anterior:", 0.0, 0.0, abertura))
+            
+            dados_extraidos.append(registro(data_raw, data_db, tipo, ent, sai, sal))
     
-    lista_erros_skus = list(skus_vistos - skus_com_total)
-    lista_erros_detalhada = []
+    validacao, erros_saldo = _tabela_validacao_plenus(contas, incremental=corte is not None)
+    lista_erros_detalhada = celulas_invalidas + erros_saldo
     
     df_temp = pd.DataFrame(dados_extraidos)
     if not df_temp.empty:
-        df_temp["Item_Completo"] = df_temp["produto"] + " (" + df_temp["categoria"].fillna("") + ")"
-        df_temp["Cat_Auto"] = df_temp["Item_Completo"].apply(detectar_categoria_plenus)
-        
-        for sku_erro in lista_erros_skus:
-            prod_nome = "Desconhecido"
-            matches = df_temp[df_temp['sku'] == sku_erro]
-            if not matches.empty:
-                prod_nome = matches.iloc[0]['produto']
-            lista_erros_detalhada.append({"SKU": sku_erro, "Produto": prod_nome, "Erro": "Sem Total"})
+        df_temp["Item_Completo"] = montar_item_plenus(df_temp)
+        df_temp["Cat_Auto"] = detectar_categorias(df_temp["Item_Completo"], "PLENUS")
+        df_temp["filial"] = filial or unidade_ativa()
     else:
-        df_temp = pd.DataFrame(columns=["sku", "produto", "categoria", "saldo", "tipo", "Item_Completo", "Cat_Auto", "data", "data_movimento", "entrada", "saida", "arquivo_origem"])
-
-    return df_temp, lista_erros_detalhada
+        df_temp = pd.DataFrame(columns=["sku", "produto", "categoria", "saldo", "tipo", "Item_Completo", "Cat_Auto", "data", "data_movimento", "entrada", "saida", "arquivo_origem", "filial"])
+
+    return df_temp, lista_erros_detalhada, validacao
+
+@instrumentar()
+def conciliar_sobreposicao_plenus(validacao, corte):
+    """Importação incremental: os dias do arquivo que já estão no banco (do primeiro dia da
+    sobreposição até o corte) conferidos contra o plenus_historico. Por SKU, nº de movimentos,
+    Σentrada e Σsaída têm que bater (a ordem dentro do dia não fica gravada, então o saldo de
+    cada linha não entra). Devolve uma linha por SKU com o Status da conciliação."""
+    colunas = ["SKU", "Produto", "Mov. Arquivo", "Mov. Banco", "Entradas Arquivo", "Entradas Banco",
+               "Saídas Arquivo", "Saídas Banco", "Status"]
+    arq = validacao[validacao['Mov. Já no Banco'] > 0]
+    if arq.empty: return pd.DataFrame(columns=colunas)
+    # 'Desde' é DD/MM/YYYY: o mínimo em texto não é a data mínima
+    ini = min(datetime.strptime(d, "%d/%m/%Y").date() for d in arq['Desde'].unique())
+    df_db = carregar_plenus_movimento_db(ini, datetime.strptime(corte, "%Y-%m-%d").date())
+
+    lado_arq = pd.DataFrame({'SKU': arq['SKU'].astype(str), 'Produto': arq['Produto'], 'Mov. Arquivo': arq['Mov. Já no Banco'],
+                             'Entradas Arquivo': arq['Entradas Já no Banco'], 'Saídas Arquivo': arq['Saídas Já no Banco']})
+    if df_db.empty:
+        lado_db = pd.DataFrame(columns=['SKU', 'Mov. Banco', 'Entradas Banco', 'Saídas Banco'])
+    else:
+        lado_db = (df_db.assign(SKU=df_db['sku'].astype(str),
+                                entrada=pd.to_numeric(df_db['entrada'], errors='coerce').fillna(0),
+                                saida=pd.to_numeric(df_db['saida'], errors='coerce').fillna(0))
+                   .groupby('SKU').agg(**{'Mov. Banco': ('entrada', 'size'), 'Entradas Banco': ('entrada', 'sum'),
+                                          'Saídas Banco': ('saida', 'sum')}).reset_index())
+    res = lado_arq.merge(lado_db, on='SKU', how='outer')
+    for col in ['Mov. Arquivo', 'Mov. Banco']: res[col] = res[col].fillna(0).astype(int)
+    for col in ['Entradas Arquivo', 'Entradas Banco', 'Saídas Arquivo', 'Saídas Banco']: res[col] = res[col].fillna(0.0)
+
+    status = pd.Series("OK", index=res.index)
+    somas = ((res['Entradas Arquivo'] - res['Entradas Banco']).abs() > TOLERANCIA_SALDO_PLENUS) | \
+            ((res['Saídas Arquivo'] - res['Saídas Banco']).abs() > TOLERANCIA_SALDO_PLENUS)
+    status = status.mask(somas, "Somas diferentes").mask(res['Mov. Arquivo'] != res['Mov. Banco'], "Movimentos diferentes")
+    status = status.mask(res['Mov. Banco'] == 0, "Só no arquivo").mask(res['Mov. Arquivo'] == 0, "Só no banco")
+    res['Status'] = status
+    return res[colunas].sort_values(['Status', 'SKU'], ignore_index=True)
+
+# --- CONFERÊNCIA / AUDITORIA (CÁLCULO) ---
+@instrumentar()
+def calcular_conferencia_saldo(df_s, df_p, agrup_sis, agrup_ple, vinculos):
+    """Saldo estático por grupo: Sisflora (PDF/histórico) x último saldo de cada SKU no Plenus."""
+    df_s = df_s.assign(Grupo=df_s['Item_Completo'].map(agrup_sis))
+    res_s = df_s.dropna(subset=['Grupo']).groupby('Grupo')['Volume Disponivel'].sum().reset_index()
+
+    if 'Item_Completo' not in df_p.columns:
+         df_p = df_p.assign(Item_Completo=montar_item_plenus(df_p))
+
+    df_p_last = df_p.sort_values(by=['data_movimento'] if 'data_movimento' in df_p.columns else ['sku']).drop_duplicates(subset=['sku'], keep='last').copy()
+    df_p_last['Grupo_Inter'] = df_p_last['Item_Completo'].map(agrup_ple)
+    df_p_last['Grupo_Calc'] = df_p_last['Grupo_Inter'].map(vinculos).fillna(df_p_last['Grupo_Inter'])
+
+    col_saldo = 'saldo_apos' if 'saldo_apos' in df_p_last.columns else 'saldo'
+    if col_saldo in df_p_last.columns: df_p_last[col_saldo] = pd.to_numeric(df_p_last[col_saldo], errors='coerce').fillna(0)
+    res_p = df_p_last.dropna(subset=['Grupo_Calc']).groupby('Grupo_Calc')[col_saldo].sum().reset_index()
+
+    res_s.columns = ['Grupo', 'Vol_Sis']
+    res_p.columns = ['Grupo', 'Vol_Ple']
+    df_final = pd.merge(res_s, res_p, on='Grupo', how='outer').fillna(0)
+    df_final['Diferenca'] = df_final['Vol_Sis'] - df_final['Vol_Ple']
+    return df_final
+
+@instrumentar()
+def calcular_auditoria_fluxo(df_transf, df_consumo, df_plenus_mov, agrup_sis, agrup_ple, vinculos):
+    """Fluxo por grupo no período: Sisflora (gerado - origem - consumo) x Plenus (entrada - saída)."""
+    saldo_aud_sis = {}
+    with medir_etapa('auditoria_fluxo_sisflora') as etapa:
+        etapa['linhas'] = len(df_transf) + len(df_consumo)
+        if not df_transf.empty:
+            gerados = df_transf[df_transf['tipo_produto'] == 'PRODUTO GERADO'].copy()
+            if not gerados.empty:
+                gerados['Item_Check'] = montar_item_completo(gerados['produto'], gerados['essencia'])
+                gerados['Grupo'] = gerados['Item_Check'].map(agrup_sis).fillna(gerados['Item_Check'])
+                for _, r in gerados.iterrows():
+                     if pd.notnull(r['Grupo']):
+                         if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
+                         saldo_aud_sis[r['Grupo']]['Entrada'] += r['volume']
+
+            origens = df_transf[df_transf['tipo_produto'] == 'PRODUTO DE ORIGEM'].copy()
+            if not origens.empty:
+                origens['Item_Check'] = montar_item_completo(origens['produto'], origens['essencia'])
+                origens['Grupo'] = origens['Item_Check'].map(agrup_sis).fillna(origens['Item_Check'])
+                for _, r in origens.iterrows():
+                     if pd.notnull(r['Grupo']):
+                         if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
+                         saldo_aud_sis[r['Grupo']]['Saida'] += r['volume']
+
+        if not df_consumo.empty:
+            # carregar_consumo_filtrado_db devolve o JSON expandido (colunas da planilha)
+            df_consumo = df_consumo.rename(columns={'Nome Popular': 'produto', 'Quantidade': 'volume'}) if 'produto' not in df_consumo.columns else df_consumo.copy()
+            vazio = pd.Series("", index=df_consumo.index)
+            df_consumo['Item_Check'] = montar_item_completo(df_consumo.get('produto', vazio).astype(object).fillna(""), df_consumo.get('essencia', vazio))
+            df_consumo['Grupo'] = df_consumo['Item_Check'].map(agrup_sis).fillna(df_consumo['Item_Check'])
+            for _, r in df_consumo.iterrows():
+                if pd.notnull(r['Grupo']):
+                     if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
+                     saldo_aud_sis[r['Grupo']]['Saida'] += float(r.get('volume', 0))
+
+    saldo_aud_ple = {}
+    with medir_etapa('auditoria_fluxo_plenus') as etapa:
+        etapa['linhas'] = len(df_plenus_mov)
+        if not df_plenus_mov.empty:
+            df_plenus_mov = df_plenus_mov.copy()
+            df_plenus_mov['Item_Completo'] = montar_item_plenus(df_plenus_mov)
+            df_plenus_mov['Grupo_Inter'] = df_plenus_mov['Item_Completo'].map(agrup_ple)
+            df_plenus_mov['Grupo_Calc'] = df_plenus_mov['Grupo_Inter'].map(vinculos).fillna(df_plenus_mov['Grupo_Inter'])
+            for _, r in df_plenus_mov.iterrows():
+                if pd.notnull(r['Grupo_Calc']):
+                    grp = r['Grupo_Calc']
+                    if grp not in saldo_aud_ple: saldo_aud_ple[grp] = {'Entrada': 0, 'Saida': 0}
+                    saldo_aud_ple[grp]['Entrada'] += r['entrada']
+                    saldo_aud_ple[grp]['Saida'] += r['saida']
+
+    todos_grupos = set(saldo_aud_sis.keys()) | set(saldo_aud_ple.keys())
+    relatorio = []
+    for g in todos_grupos:
+        s = saldo_aud_sis.get(g, {'Entrada': 0, 'Saida': 0})
+        p = saldo_aud_ple.get(g, {'Entrada': 0, 'Saida': 0})
+        s_liq = s['Entrada'] - s['Saida']
+        p_liq = p['Entrada'] - p['Saida']
+        diff = s_liq - p_liq
+
+        if any(abs(x) > 0.0001 for x in [s['Entrada'], s['Saida'], s_liq, p['Entrada'], p['Saida'], p_liq]):
+            relatorio.append({
+                "Grupo": g,
+                "Sis_Ent": s['Entrada'], "Sis_Sai": s['Saida'], "Sis_Liq": s_liq,
+                "Ple_Ent": p['Entrada'], "Ple_Sai": p['Saida'], "Ple_Liq": p_liq,
+                "Diferenca": diff
+            })
+    return pd.DataFrame(relatorio)
+
+COLS_SERIE_FLUXO = ['Periodo', 'Grupo', 'Sis_Ent', 'Sis_Sai', 'Ple_Ent', 'Ple_Sai']
+
+def calcular_serie_fluxo(df_transf, df_consumo, df_plenus_mov, agrup_sis, agrup_ple, vinculos):
+    """Entrada/saída por dia e grupo, Sisflora x Plenus, com as regras de calcular_auditoria_fluxo
+    (caminho sem espelho; com ele a série sai de agregados_diarios)."""
+    partes = []
+    if not df_transf.empty:
+        t = df_transf[df_transf['tipo_produto'].isin(['PRODUTO GERADO', 'PRODUTO DE ORIGEM'])]
+        item = montar_item_completo(t['produto'], t['essencia'])
+        gerado = t['tipo_produto'] == 'PRODUTO GERADO'
+        partes.append(pd.DataFrame({'Periodo': t['data_realizacao'], 'Grupo': item.map(agrup_sis).fillna(item),
+                                    'Sis_Ent': t['volume'].where(gerado, 0.0), 'Sis_Sai': t['volume'].where(~gerado, 0.0)}))
+    if not df_consumo.empty:
+        c = df_consumo.rename(columns={'Nome Popular': 'produto', 'Quantidade': 'volume'}) if 'produto' not in df_consumo.columns else df_consumo
+        vazio = pd.Series("", index=c.index)
+        item = montar_item_completo(c.get('produto', vazio).astype(object).fillna(""), c.get('essencia', vazio))
+        col_data = 'data_consumo' if 'data_consumo' in c.columns else 'Data'
+        partes.append(pd.DataFrame({'Periodo': c[col_data], 'Grupo': item.map(agrup_sis).fillna(item), 'Sis_Ent': 0.0,
+                                    'Sis_Sai': pd.to_numeric(c.get('volume', vazio), errors='coerce').fillna(0.0)}))
+    if not df_plenus_mov.empty:
+        grupo_inter = montar_item_plenus(df_plenus_mov).map(agrup_ple)
+        partes.append(pd.DataFrame({'Periodo': df_plenus_mov['data_movimento'], 'Grupo': grupo_inter.map(vinculos).fillna(grupo_inter),
+                                    'Ple_Ent': df_plenus_mov['entrada'], 'Ple_Sai': df_plenus_mov['saida']}))
+    if not partes: return pd.DataFrame(columns=COLS_SERIE_FLUXO)
+    df = pd.concat(partes, ignore_index=True).dropna(subset=['Grupo'])
+    df['Periodo'] = pd.to_datetime(df['Periodo']).dt.normalize()
+    df[COLS_SERIE_FLUXO[2:]] = df.reindex(columns=COLS_SERIE_FLUXO[2:]).astype(float).fillna(0.0)
+    return df.groupby(['Periodo', 'Grupo'], as_index=False)[COLS_SERIE_FLUXO[2:]].sum()
+
+@instrumentar()
+def calcular_auditoria_fluxo_sql(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync=False, _tarefa=None):
+    """calcular_auditoria_fluxo em SQL (DuckDB) sobre o espelho local, sincronizando o período antes."""
+    atualizar_tarefa(_tarefa, progresso=0.0, mensagem="sincronizando transf/consumo/plenus em paralelo")
+    executar_em_paralelo([(sincronizar_espelho, colecao, dt_ini, dt_fim, forcar_sync) for colecao in analitico.COLECOES_ESPELHO])
+    atualizar_tarefa(_tarefa, progresso=0.8, mensagem="calculando")
+    return obter_espelho().auditoria_fluxo(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, filial=unidade_ativa())
+
+@instrumentar()
+def carregar_dados_auditoria(dt_ini, dt_fim):
+    """As três leituras da auditoria ao mesmo tempo: (transf, consumo, plenus)."""
+    return tuple(executar_em_paralelo([
+        (carregar_transf_filtrado_db, dt_ini, dt_fim),
+        (carregar_consumo_filtrado_db, dt_ini, dt_fim),
+        (carregar_plenus_movimento_db, dt_ini, dt_fim),
+    ]))
+
+def _auditoria_unidade(tarefa, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync=False):
+    """Auditoria da unidade ativa (espelho DuckDB se disponível, senão banco + pandas)."""
+    if obter_espelho() is not None:
+        return calcular_auditoria_fluxo_sql(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync, _tarefa=tarefa)
+    atualizar_tarefa(tarefa, progresso=0.0, mensagem="lendo transf/consumo/plenus em paralelo")
+    df_transf, df_consumo, df_plenus_mov = carregar_dados_auditoria(dt_ini, dt_fim)
+    atualizar_tarefa(tarefa, progresso=0.75, mensagem="calculando",
+                     parcial={'transf': len(df_transf), 'consumo': len(df_consumo), 'plenus': len(df_plenus_mov)})
+    return calcular_auditoria_fluxo(df_transf, df_consumo, df_plenus_mov, agrup_sis, agrup_ple, vinculos)
+
+def tarefa_auditoria_fluxo(tarefa, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync=False, unidades=None):
+    """Processar Auditoria em segundo plano. Com várias unidades, cada uma é auditada só com os
+    próprios dados, em paralelo, e o resultado ganha a coluna Filial."""
+    if not unidades or len(unidades) < 2:
+        filial = unidades[0] if unidades else unidade_ativa()
+        return com_unidade(filial, _auditoria_unidade, tarefa, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync)
+    atualizar_tarefa(tarefa, progresso=0.0, mensagem=f"auditando {len(unidades)} unidades em paralelo")
+    # Sem a tarefa nas chamadas: o progresso de uma unidade apagaria o das outras
+    resultados = executar_em_paralelo([
+        (com_unidade, u, _auditoria_unidade, None, dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, forcar_sync)
+        for u in unidades])
+    atualizar_tarefa(tarefa, progresso=1.0, mensagem="juntando unidades")
+    partes = [df.assign(Filial=u) for u, df in zip(unidades, resultados) if df is not None and not df.empty]
+    if not partes: return pd.DataFrame()
+    df = pd.concat(partes, ignore_index=True)
+    return df[['Filial'] + [c for c in df.columns if c != 'Filial']]
+
+# --- TENDÊNCIAS (GRÁFICOS) ---
+# A série vem pronta por dia e grupo (agregados_diarios do espelho, ou calculada uma vez das
+# movimentações sem ele) e fica na sessão; cada gráfico só reagrupa a série dos grupos escolhidos
+# no grão (dia, semana, mês) em que cabe em PONTOS_MAX_GRAFICO pontos.
+PONTOS_MAX_GRAFICO = int(config_app('pontos_max_grafico', 3000))
+GRAOS_TENDENCIA = {'D': 'Dia', 'W': 'Semana', 'M': 'Mês'}
+
+@instrumentar()
+def carregar_serie_fluxo(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, _tarefa=None):
+    """Série diária Sisflora x Plenus por grupo da unidade ativa."""
+    if obter_espelho() is not None:
+        atualizar_tarefa(_tarefa, progresso=0.0, mensagem="sincronizando transf/consumo/plenus em paralelo")
+        executar_em_paralelo([(sincronizar_espelho, colecao, dt_ini, dt_fim) for colecao in analitico.COLECOES_ESPELHO])
+        atualizar_tarefa(_tarefa, progresso=0.8, mensagem="agrupando por dia")
+        df = obter_espelho().serie_fluxo(dt_ini, dt_fim, agrup_sis, agrup_ple, vinculos, filial=unidade_ativa())
+        return df.assign(Periodo=pd.to_datetime(df['Periodo']))
+    atualizar_tarefa(_tarefa, progresso=0.0, mensagem="lendo transf/consumo/plenus em paralelo")
+    dados = carregar_dados_auditoria(dt_ini, dt_fim)
+    atualizar_tarefa(_tarefa, progresso=0.75, mensagem="agrupando por dia")
+    return calcular_serie_fluxo(*dados, agrup_sis, agrup_ple, vinculos)
+
+def escolher_grao(dt_ini, dt_fim, n_linhas):
+    """Grão mais fino ('D', 'W', 'M') em que n_linhas séries cabem em PONTOS_MAX_GRAFICO pontos."""
+    dias = (pd.Timestamp(dt_fim) - pd.Timestamp(dt_ini)).days + 1
+    for grao, dias_periodo in (('D', 1), ('W', 7)):
+        if dias / dias_periodo * max(n_linhas, 1) <= PONTOS_MAX_GRAFICO: return grao
+    return 'M'
+
+def reamostrar_serie(df, grao):
+    """Série diária -> semanal/mensal (soma dos fluxos; o período começa no 1º dia)."""
+    if grao == 'D' or df.empty: return df
+    periodo = df['Periodo'].dt.to_period(grao).dt.start_time
+    return df.assign(Periodo=periodo).groupby(['Periodo', 'Grupo'], as_index=False)[COLS_SERIE_FLUXO[2:]].sum()
+
+def graficos_tendencia(df_serie, grupos, grao):
+    """(saldo acumulado, diferença acumulada, fluxo do período) em plotly para os grupos escolhidos."""
+    df = reamostrar_serie(df_serie[df_serie['Grupo'].isin(grupos)], grao).sort_values('Periodo')
+    acum = pd.concat([
+        df[['Periodo', 'Grupo']].assign(Fonte='Sisflora', Liquido=df['Sis_Ent'] - df['Sis_Sai']),
+        df[['Periodo', 'Grupo']].assign(Fonte='Plenus', Liquido=df['Ple_Ent'] - df['Ple_Sai'])], ignore_index=True)
+    acum['Acumulado'] = acum.groupby(['Grupo', 'Fonte'])['Liquido'].cumsum()
+    fig_saldo = px.line(acum, x='Periodo', y='Acumulado', color='Grupo', line_dash='Fonte', markers=grao != 'D',
+                        labels={'Periodo': GRAOS_TENDENCIA[grao], 'Acumulado': 'Variação do saldo (m³)'})
+    dif = df[['Periodo', 'Grupo']].assign(Diferenca=(df['Sis_Ent'] - df['Sis_Sai']) - (df['Ple_Ent'] - df['Ple_Sai']))
+    dif['Diferenca'] = dif.groupby('Grupo')['Diferenca'].cumsum()
+    fig_dif = px.line(dif, x='Periodo', y='Diferenca', color='Grupo',
+                      labels={'Periodo': GRAOS_TENDENCIA[grao], 'Diferenca': 'Sisflora - Plenus acumulado (m³)'})
+    fig_dif.add_hline(y=0, line_dash='dot', line_color='gray')
+    fluxo = df.groupby('Periodo', as_index=False)[COLS_SERIE_FLUXO[2:]].sum().melt(
+        id_vars='Periodo', var_name='Série', value_name='Volume')
+    fluxo['Série'] = fluxo['Série'].map({'Sis_Ent': 'Sisflora entrada', 'Sis_Sai': 'Sisflora saída',
+                                         'Ple_Ent': 'Plenus entrada', 'Ple_Sai': 'Plenus saída'})
+    fig_fluxo = px.bar(fluxo, x='Periodo', y='Volume', color='Série', barmode='group',
+                       labels={'Periodo': GRAOS_TENDENCIA[grao], 'Volume': 'Volume (m³)'})
+    return fig_saldo, fig_dif, fig_fluxo
 
 # --- CALLBACKS ADMIN ---
 def salvar_sis_click():
@@ -958,6 +2933,7 @@ def salvar_sis_click():
         cat = st.session_state.get('s_cat_adm', '')
         salvar_agrupamento_db(st.session_state['cesta_sis'], st.session_state['input_sis_name'].upper(), "SISFLORA", cat)
         st.session_state['agrup_sis'] = carregar_agrupamentos_db("SISFLORA")
+        registrar_agrupados_indice(st.session_state.get('indice_pend_sis'), st.session_state['cesta_sis'], st.session_state['agrup_sis'])
         st.session_state['cesta_sis'] = []
         st.session_state['input_sis_name'] = ""
 def limpar_sis_click():
@@ -968,14 +2944,67 @@ def salvar_ple_click():
         cat = st.session_state.get('p_cat_adm', '')
         salvar_agrupamento_db(st.session_state['cesta_ple'], st.session_state['input_ple_name'].upper(), "PLENUS", cat)
         st.session_state['agrup_ple'] = carregar_agrupamentos_db("PLENUS")
+        registrar_agrupados_indice(st.session_state.get('indice_pend_ple'), st.session_state['cesta_ple'], st.session_state['agrup_ple'])
         st.session_state['cesta_ple'] = []
         st.session_state['input_ple_name'] = ""
 def limpar_ple_click():
     st.session_state['cesta_ple'] = []
     st.session_state['input_ple_name'] = ""
 
+def painel_agrupamento_auto(indice, origem):
+    """Propostas automáticas de grupo para os itens do radar (pendentes fora da cesta), aceitas em lote."""
+    sufixo = origem[:3].lower()
+    chave_agrup, chave_prop = f'agrup_{sufixo}', f'propostas_auto_{sufixo}'
+    with st.expander("🤖 Agrupamento Automático (propostas em lote)", expanded=False):
+        c1, c2 = st.columns([2, 1])
+        limiar = c1.slider("Similaridade mínima entre nomes:", 0.70, 1.0, LIMIAR_AGRUPAMENTO_AUTO, 0.01, key=f"limiar_auto_{sufixo}")
+        if c2.button("🔎 Gerar Propostas", key=f"btn_propor_{sufixo}"):
+            itens = radar_pendentes(indice)
+            df_itens = pd.DataFrame({'Item_Completo': itens, 'Categoria': [indice['cat'][it] for it in itens]})
+            grupos_existentes = set(st.session_state[chave_agrup].values())
+            guardar_df_sessao(chave_prop, propor_agrupamentos(df_itens, origem, limiar, grupos_existentes))
+        df_prop = obter_df_sessao(chave_prop)
+        if df_prop is None: return
+        if df_prop.empty:
+            st.info("Nenhum item pendente para agrupar.")
+            return
+        st.caption(f"{len(df_prop)} grupos propostos para {int(df_prop['Qtd Itens'].sum())} itens. "
+                   "Ajuste os nomes, desmarque o que não quiser e salve tudo de uma vez.")
+        editado = st.data_editor(
+            df_prop, key=f"ed_propostas_{sufixo}", hide_index=True, use_container_width=True, height=400,
+            column_config={
+                "Aceitar": st.column_config.CheckboxColumn("Aceitar?"),
+                "Já existe": st.column_config.CheckboxColumn("Grupo já existe", help="Os itens entram no grupo existente"),
+                "Itens": st.column_config.ListColumn("Itens", width="large"),
+            },
+            disabled=["Categoria", "Qtd Itens", "Já existe", "Itens"])
+        aceitas = editado[editado['Aceitar'] & (editado['Nome do Grupo'].astype(str).str.strip() != "")]
+        if st.button(f"✅ Salvar {len(aceitas)} Grupos Aceitos ({int(aceitas['Qtd Itens'].sum())} itens)", type="primary",
+                     disabled=aceitas.empty, key=f"btn_salvar_propostas_{sufixo}"):
+            grupos = [(str(r['Nome do Grupo']).strip().upper(), list(r['Itens']), r['Categoria']) for r in aceitas.to_dict('records')]
+            try:
+                n = salvar_agrupamentos_lote(grupos, origem)
+                st.session_state[chave_agrup] = carregar_agrupamentos_db(origem)
+                registrar_agrupados_indice(indice, [it for _, itens, _ in grupos for it in itens], st.session_state[chave_agrup])
+                st.toast(f"✅ {len(grupos)} grupos salvos ({n} itens)", icon="💾")
+                remover_df_sessao(chave_prop)
+                st.rerun()
+            except Exception as e:
+                # Gravação parcial: o índice acerta a diferença pelo mapa recarregado
+                st.session_state[chave_agrup] = carregar_agrupamentos_db(origem)
+                st.error(f"Erro Firebase: {e}")
+
 # --- INIT SESSION STATE ---
 load_app_state()
+init_session_vars()  # depois das preferências: só calcula os períodos que o usuário não tinha salvo
+# Regras mudaram desde a última execução: reclassifica (Cat_Auto) as cargas da sessão
+regras_vigentes = obter_regras()
+if st.session_state.get('assinatura_regras', regras_vigentes.assinatura) != regras_vigentes.assinatura:
+    for chave_df, origem_df in (('df_sisflora', 'SISFLORA'), ('df_plenus', 'PLENUS')):
+        df_sessao = obter_df_sessao(chave_df)
+        if df_sessao is not None and 'Item_Completo' in df_sessao.columns:
+            guardar_df_sessao(chave_df, df_sessao.assign(Cat_Auto=detectar_categorias(df_sessao['Item_Completo'], origem_df)))
+st.session_state['assinatura_regras'] = regras_vigentes.assinatura
 if 'agrup_sis' not in st.session_state: st.session_state['agrup_sis'] = carregar_agrupamentos_db("SISFLORA")
 if 'agrup_ple' not in st.session_state: st.session_state['agrup_ple'] = carregar_agrupamentos_db("PLENUS")
 if 'vinculos' not in st.session_state: st.session_state['vinculos'] = carregar_vinculos_db()
@@ -985,7 +3014,6 @@ if 'input_sis_name' not in st.session_state: st.session_state['input_sis_name']
 if 'input_ple_name' not in st.session_state: st.session_state['input_ple_name'] = ""
 if 'cnt_sis' not in st.session_state: st.session_state['cnt_sis'] = 0
 if 'cnt_ple' not in st.session_state: st.session_state['cnt_ple'] = 0
-if 'st_df_transf_preview' not in st.session_state: st.session_state['st_df_transf_preview'] = None
 if 'filtros_ativos_transf' not in st.session_state: st.session_state['filtros_ativos_transf'] = []
 
 # --- MENU FLUXO DE TRABALHO ---
@@ -1010,9 +3038,44 @@ def on_menu_change():
         st.session_state['menu_sel_idx'] = ordem_menu.index(sel)
     save_app_state()
 
+# Ao trocar de unidade, esquece períodos e resultados da anterior (load_app_state aplica os salvos da
+# nova e init_session_vars calcula os que faltarem).
+# Os DataFrames da sessão já são guardados por unidade e voltam ao retornar a ela.
+CHAVES_POR_UNIDADE = (
+    'p_dt_ini', 'p_dt_fim', 't_dt_ini', 't_dt_fim', 'c_dt_ini', 'c_dt_fim', 'aud_dt_ini', 'aud_dt_fim',
+    'hist_p_ini', 'hist_p_fim', 't_dt_ini_w', 't_dt_fim_w', 'c_dt_ini_w', 'c_dt_fim_w', 'aud_i', 'aud_f',
+    'view_plenus', 'lista_erro_plenus', 'validacao_plenus', 'conciliacao_plenus', 'corte_plenus',
+    'import_ple_chave', 'ple_source', 'auditoria_periodo', 'plano_transf',
+    'tend_dt_ini', 'tend_dt_fim', 'tend_i', 'tend_f', 'tend_grupos', 'tendencia_periodo',
+)
+
+def trocar_unidade():
+    # Sem save_app_state aqui: a unidade nova já está ativa e ainda não recebeu as preferências dela
+    for chave in CHAVES_POR_UNIDADE: st.session_state.pop(chave, None)
+
+if len(UNIDADES) > 1:
+    st.sidebar.selectbox("🏭 Unidade", list(UNIDADES), key="filial", format_func=lambda u: f"{u} - {UNIDADES[u]}" if UNIDADES[u] != u else u,
+                         on_change=trocar_unidade, help="Histórico, importações e auditoria valem só para a unidade escolhida.",
+                         disabled=any(tarefa_em_andamento(c) for c in list(st.session_state.get('tarefas', {}))))
 menu_sel = st.sidebar.radio("Fluxo de Trabalho", ordem_menu, index=idx_inicial, key="menu_main_nav", on_change=on_menu_change)
 st.sidebar.divider()
-st.sidebar.info("💡 Versão Web com Firebase.")
+if BACKEND_DADOS in armazenamento.BACKENDS_LOCAIS:
+    st.sidebar.warning(f"🧪 Banco local ({BACKEND_DADOS}): dados não vão para o Firebase.")
+else:
+    st.sidebar.info("💡 Versão Web com Firebase.")
+alteracoes_ao_vivo = st.session_state.pop('alteracoes_ao_vivo', None)
+if alteracoes_ao_vivo:
+    st.toast("Atualizado ao vivo: " + ", ".join(f"{NOMES_AO_VIVO.get(c, c)} ({n})" for c, n in alteracoes_ao_vivo.items()), icon="🔴")
+if ouvintes_da_sessao():
+    with st.sidebar: vigiar_alteracoes()
+df_uso_sessao, uso_global_mb = resumo_dados_sessao()
+if st.session_state.get('relatorio_memoria') or not df_uso_sessao.empty:
+    with st.sidebar.expander("🧠 Memória das Cargas", expanded=False):
+        if st.session_state.get('relatorio_memoria'):
+            st.dataframe(pd.DataFrame(st.session_state['relatorio_memoria']).T, use_container_width=True)
+        if not df_uso_sessao.empty:
+            st.caption(f"Dados da sessão (limite {LIMITE_SESSAO_MB:.0f} MB) • servidor: {uso_global_mb:,.1f} de {LIMITE_GLOBAL_MB:.0f} MB")
+            st.dataframe(df_uso_sessao, use_container_width=True, hide_index=True)
 
 # --- 1. SALDO SISFLORA ---
 if menu_sel == "1. SALDO SISFLORA":
@@ -1023,20 +3086,37 @@ if menu_sel == "1. SALDO SISFLORA":
     
     if op_sis == "Ler PDF (Upload)":
         f = st.file_uploader("PDF Sisflora (Saldo Atual)", type="pdf", key="up_sisflora")
-        if f:
-            with st.spinner("Lendo PDF..."):
-                st.session_state['df_sisflora'] = extrair_dados_sisflora(f)
+        # Leitura em segundo plano: uma vez por arquivo enviado (reruns não recomeçam a leitura)
+        if f and st.session_state.get('sis_pdf_lido') != (unidade_ativa(), f.file_id) and not tarefa_em_andamento('pdf_sisflora'):
+            st.session_state['sis_pdf_lido'] = (unidade_ativa(), f.file_id)
+            iniciar_tarefa('pdf_sisflora', f"Leitura do PDF {f.name}",
+                           lambda tarefa, arq: extrair_dados_sisflora(arq, unidade_ativa(), _tarefa=tarefa), io.BytesIO(f.getvalue()))
+        
+        tarefa_pdf = recolher_tarefa('pdf_sisflora')
+        if tarefa_pdf:
+            if mostrar_fim_tarefa(tarefa_pdf, "Leitura do PDF cancelada. Envie o arquivo novamente para reler."):
+                guardar_df_sessao('df_sisflora', tarefa_pdf['resultado'])
                 st.session_state['sis_source'] = 'upload'
+                st.session_state['sis_volumes_invalidos'] = tarefa_pdf['resultado'].attrs.get('volumes_invalidos', [])
+        if tarefa_em_andamento('pdf_sisflora'):
+            painel_tarefa('pdf_sisflora')
         
-        if 'df_sisflora' in st.session_state and not st.session_state['df_sisflora'].empty and st.session_state.get('sis_source') == 'upload':
-            df_s = st.session_state['df_sisflora']
+        df_s = obter_df_sessao('df_sisflora')
+        if df_s is not None and not df_s.empty and st.session_state.get('sis_source') == 'upload':
             st.metric("Volume Total (PDF)", formatar_br(df_s['Volume Disponivel'].sum()))
+            if st.session_state.get('sis_volumes_invalidos'):
+                with st.expander(f"⚠️ {len(st.session_state['sis_volumes_invalidos'])} volume(s) ilegível(is) entraram como 0", expanded=False):
+                    st.dataframe(pd.DataFrame(st.session_state['sis_volumes_invalidos']), use_container_width=True, hide_index=True)
             
             with st.expander("💾 Salvar este Saldo no Banco", expanded=True):
                 data_ref = st.date_input("Data de Referência:", value=date.today(), format="DD/MM/YYYY")
                 if st.button("Confirmar Salvamento no DB"):
-                    if salvar_lote_sisflora_db(df_s, data_ref, f.name if f else "Upload"):
+                    meta = salvar_lote_sisflora_db(df_s, data_ref, f.name if f else "Upload")
+                    if meta:
                         st.success(f"Saldo de {data_ref.strftime('%d/%m/%Y')} salvo!")
+                        if meta['tipo'] == 'delta':
+                            st.caption(f"Gravado como diferença do saldo de {datetime.strptime(meta['base'], '%Y-%m-%d').strftime('%d/%m/%Y')}: "
+                                       f"{meta['alteradas']} linhas novas/alteradas, {meta['removidas']} removidas.")
             
             cols_show = [c for c in ['Codigo', 'Produto', 'Essencia', 'Unidade', 'Volume Disponivel', 'Cat_Auto'] if c in df_s.columns]
             render_filtered_table(df_s[cols_show], "sis_upload")
@@ -1046,13 +3126,14 @@ if menu_sel == "1. SALDO SISFLORA":
         if datas_disp:
             sel_data = st.selectbox("Escolha uma data salva:", datas_disp, format_func=lambda x: x.strftime("%d/%m/%Y"))
             if st.button("Carregar Saldo desta Data"):
-                st.session_state['df_sisflora'] = carregar_sisflora_data_db(sel_data)
+                guardar_df_sessao('df_sisflora', carregar_sisflora_data_db(sel_data))
                 st.session_state['sis_source'] = 'history'
                 st.success(f"Carregado!")
             
-            if 'df_sisflora' in st.session_state and not st.session_state['df_sisflora'].empty:
+            df_s = obter_df_sessao('df_sisflora')
+            if df_s is not None and not df_s.empty:
                  st.divider()
-                 render_filtered_table(st.session_state['df_sisflora'], "sis_db")
+                 render_filtered_table(df_s, "sis_db")
         else:
             st.warning("Nenhum histórico salvo.")
 
@@ -1076,25 +3157,66 @@ elif menu_sel == "2. SALDO PLENUS":
 
     if op_ple == "Ler HTML / Importar":
         f_plenus = st.file_uploader("Importar HTML Plenus", type=["html", "htm"], key="up_plenus")
-        if f_plenus:
+        incremental = st.toggle("Importação incremental (só os dias depois do último já salvo no banco)", key="tg_ple_incremental",
+                                help="Os dias já gravados entram só na conferência: são comparados com o banco e não são salvos de novo.")
+        # Processa uma vez por arquivo/modo: o corte (1 leitura) e a conciliação não se repetem a cada rerun
+        chave_import = (f_plenus.file_id, incremental, unidade_ativa()) if f_plenus else None
+        if f_plenus and st.session_state.get('import_ple_chave') != chave_import:
             with st.spinner("Processando..."):
-                df, erros = extrair_dados_plenus_html(f_plenus.getvalue().decode('utf-8', errors='ignore'), f_plenus.name)
-                st.session_state['df_plenus'] = df
+                ultimo_dia = get_max_date_db('plenus_historico', 'data_movimento') if incremental else None
+                corte = ultimo_dia.strftime("%Y-%m-%d") if ultimo_dia else None
+                df, erros, validacao = extrair_dados_plenus_html(f_plenus.getvalue().decode('utf-8', errors='ignore'), f_plenus.name, corte, unidade_ativa())
+                guardar_df_sessao('df_plenus', df)
+                parar_ouvinte('df_plenus')
                 st.session_state['lista_erro_plenus'] = erros
+                st.session_state['validacao_plenus'] = validacao
+                st.session_state['corte_plenus'] = ultimo_dia
+                st.session_state['conciliacao_plenus'] = conciliar_sobreposicao_plenus(validacao, corte) if corte else None
                 st.session_state['ple_source'] = 'upload'
+                st.session_state['import_ple_chave'] = chave_import
 
-        if 'df_plenus' in st.session_state and not st.session_state['df_plenus'].empty and st.session_state.get('ple_source') == 'upload':
+        df_ple = obter_df_sessao('df_plenus')
+        if df_ple is not None and not df_ple.empty and st.session_state.get('ple_source') == 'upload':
             c_btn, c_rest = st.columns([1, 4])
             with c_btn:
                 if st.button("Limpar Plenus", type="primary"): 
-                    del st.session_state['df_plenus']
+                    remover_df_sessao('df_plenus')
+                    st.session_state.pop('import_ple_chave', None)
                     st.rerun()
             
+            ultimo_dia = st.session_state.get('corte_plenus')
+            if incremental and ultimo_dia:
+                n_novos = int(df_ple['data_movimento'].notna().sum()) if 'data_movimento' in df_ple.columns else 0
+                msg = f"Incremental: até {ultimo_dia.strftime('%d/%m/%Y')} já está no banco."
+                if n_novos: st.info(f"{msg} {n_novos} movimentos novos para salvar.")
+                else: st.info(f"{msg} O arquivo não traz dias novos.")
+                conciliacao = st.session_state.get('conciliacao_plenus')
+                if conciliacao is not None and not conciliacao.empty:
+                    ruins = conciliacao[conciliacao['Status'] != "OK"]
+                    titulo = (f"🔁 Conciliação dos dias já gravados: {len(ruins)} de {len(conciliacao)} SKUs divergem do banco" if len(ruins)
+                              else f"🔁 Conciliação dos dias já gravados: {len(conciliacao)} SKUs conferem com o banco")
+                    with st.expander(titulo, expanded=bool(len(ruins))):
+                        df_exib, col_config = preparar_exibicao(ruins if len(ruins) else conciliacao)
+                        st.dataframe(df_exib, column_config=col_config, hide_index=True, use_container_width=True)
+            elif incremental:
+                st.info("Incremental: nada salvo no banco ainda, o arquivo entra inteiro.")
+            
             if st.session_state.get('lista_erro_plenus'):
-                 with st.expander("⚠️ Ver Erros de Leitura (Sem Total)", expanded=False):
+                 with st.expander("⚠️ Ver Erros de Leitura (Sem Total / Valores Inválidos / Saldos)", expanded=False):
                      st.dataframe(pd.DataFrame(st.session_state['lista_erro_plenus']))
 
-            render_plenus_dashboard(st.session_state['df_plenus'], key_prefix="upload", allow_save=True)
+            validacao = st.session_state.get('validacao_plenus')
+            if validacao is not None and not validacao.empty:
+                n_ruins = int((validacao['Status'] != "OK").sum())
+                titulo = f"🧮 Conferência de Saldos por SKU: {n_ruins} de {len(validacao)} com problema" if n_ruins else f"🧮 Conferência de Saldos por SKU: {len(validacao)} OK"
+                with st.expander(titulo, expanded=False):
+                    st.caption(f"Anterior + Σ entradas − Σ saídas contra o Total e o saldo de cada linha (tolerância {formatar_br(TOLERANCIA_SALDO_PLENUS)}).")
+                    so_problemas = st.checkbox("Só SKUs com problema", value=bool(n_ruins), key="chk_valid_ple")
+                    df_valid = validacao[validacao['Status'] != "OK"] if so_problemas else validacao
+                    df_exib, col_config = preparar_exibicao(df_valid)
+                    st.dataframe(df_exib, column_config=col_config, hide_index=True, use_container_width=True)
+
+            render_plenus_dashboard(df_ple, key_prefix="upload", allow_save=True)
 
     elif op_ple == "Carregar do Histórico":
         st.markdown("### 📂 Carregar Movimentos do DB")
@@ -1105,25 +3227,25 @@ elif menu_sel == "2. SALDO PLENUS":
         st.session_state['p_dt_fim'] = d_fim_h
 
         if st.button("Carregar do Histórico", key="btn_load_hist_p"):
+            lido_em = datetime.now(timezone.utc)
             df_hist = carregar_plenus_movimento_db(d_ini_h, d_fim_h)
             if not df_hist.empty:
-                df_hist.rename(columns={'tipo_movimento': 'tipo', 'saldo_apos': 'saldo'}, inplace=True)
-                df_hist['data'] = pd.to_datetime(df_hist['data_movimento']).dt.strftime("%d/%m/%Y")
-                if 'categoria' not in df_hist.columns: df_hist['categoria'] = ""
-                df_hist["Item_Completo"] = df_hist["produto"] + " (" + df_hist["categoria"].fillna("") + ")" 
-                df_hist["Cat_Auto"] = df_hist["Item_Completo"].apply(detectar_categoria_plenus)
-                
-                st.session_state['df_plenus'] = df_hist
+                df_hist = preparar_plenus_historico(df_hist)
+                guardar_df_sessao('df_plenus', df_hist)
+                ouvir_periodo('df_plenus', 'plenus_historico', 'data_movimento', d_ini_h, d_fim_h, lido_em,
+                              preparar=preparar_plenus_historico, ordem=['data_movimento'])
                 st.session_state['lista_erro_plenus'] = []
+                st.session_state['validacao_plenus'] = None
                 st.session_state['ple_source'] = 'history'
                 st.success(f"Carregado {len(df_hist)} registros.")
                 st.rerun()
             else:
                 st.warning("Nenhum dado encontrado.")
         
-        if 'df_plenus' in st.session_state and not st.session_state['df_plenus'].empty and st.session_state.get('ple_source') == 'history':
+        df_ple = obter_df_sessao('df_plenus')
+        if df_ple is not None and not df_ple.empty and st.session_state.get('ple_source') == 'history':
             st.divider()
-            render_plenus_dashboard(st.session_state['df_plenus'], key_prefix="history", allow_save=False)
+            render_plenus_dashboard(df_ple, key_prefix="history", allow_save=False)
     
     elif op_ple == "Gerenciar / Excluir":
         st.markdown("### 🗑️ Excluir Movimentos")
@@ -1138,7 +3260,8 @@ elif menu_sel == "2. SALDO PLENUS":
 elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
     st.header("🔄 HISTÓRICO TRANSFORMAÇÃO")
     
-    if st.session_state['view_transf'] is not None and not st.session_state['view_transf'].empty:
+    view_transf = obter_df_sessao('view_transf')
+    if view_transf is not None and not view_transf.empty:
         tab_query, tab_import, tab_manage = st.tabs(["📊 Consultar DB (Ativo)", "📥 Importar Excel", "🗑️ Limpar Período"])
     else:
         tab_import, tab_query, tab_manage = st.tabs(["📥 Importar Excel", "📊 Consultar DB", "🗑️ Limpar Período"])
@@ -1147,7 +3270,7 @@ elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
         uploaded_files = st.file_uploader("Carregar Excel (Transf)", type=["xlsx", "xls"], accept_multiple_files=True, key="up_transf")
         if uploaded_files:
             current_file_names = sorted([f.name for f in uploaded_files])
-            if st.session_state['st_df_transf_preview'] is None or st.session_state.get('last_files_transf') != current_file_names:
+            if not tem_df_sessao('st_df_transf_preview') or st.session_state.get('last_files_transf') != current_file_names:
                 all_dfs = []
                 with st.spinner(f"Processando {len(uploaded_files)} arquivos..."):
                     for file in uploaded_files:
@@ -1157,7 +3280,7 @@ elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
                                 df_raw["Volume Origem"] = df_raw["Volume Origem"].str.replace(",", ".").astype(float)
                             if "Volume Gerado" in df_raw.columns:
                                 df_raw["Volume Gerado"] = df_raw["Volume Gerado"].str.replace(",", ".").astype(float)
-                            df_transformed = transform_data_sistransf(df_raw, filename=file.name)
+                            df_transformed = transform_data_sistransf(df_raw, filename=file.name, filial=unidade_ativa())
                             all_dfs.append(df_transformed)
                         except Exception as e:
                             st.error(f"Erro {file.name}: {e}")
@@ -1168,18 +3291,31 @@ elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
                         min_d, max_d = df_datas.min().date(), df_datas.max().date()
                         update_session_dates('t', min_d, max_d)
                     
-                    st.session_state['st_df_transf_preview'] = final_df
+                    guardar_df_sessao('st_df_transf_preview', final_df)
                     st.session_state['last_files_transf'] = current_file_names
                     st.success(f"Processado! {len(final_df)} linhas.")
 
-        if st.session_state['st_df_transf_preview'] is not None:
-            render_filtered_table(st.session_state['st_df_transf_preview'], "transf_preview")
-            if st.button("💾 Salvar Transformações no DB", key="btn_save_transf"):
-                ins, ext = salvar_lote_smart('transf_historico', 'data_realizacao', st.session_state['st_df_transf_preview'])
-                if ins > 0: st.success(f"✅ {ins} salvos.")
-                if ext > 0: st.warning(f"⚠️ {ext} já existiam.")
-                st.session_state['st_df_transf_preview'] = None
+        df_preview = obter_df_sessao('st_df_transf_preview')
+        if df_preview is not None:
+            render_filtered_table(df_preview, "transf_preview")
+            if st.button("💾 Salvar Transformações no DB", key="btn_save_transf", disabled=tarefa_em_andamento('salvar_transf')):
+                iniciar_tarefa('salvar_transf', "Gravação das transformações",
+                               lambda tarefa, df: salvar_lote_smart('transf_historico', 'data_realizacao', df, _tarefa=tarefa), df_preview)
+
+        tarefa_save = recolher_tarefa('salvar_transf')
+        if tarefa_save:
+            parcial = tarefa_save['parcial'] or 0
+            if mostrar_fim_tarefa(tarefa_save, f"Gravação cancelada: {parcial} registros já tinham sido gravados."):
+                ins, ext = tarefa_save['resultado']
+                st.session_state['msg_save_transf'] = (ins, ext)
+                remover_df_sessao('st_df_transf_preview')
                 st.rerun()
+        if tarefa_em_andamento('salvar_transf'):
+            painel_tarefa('salvar_transf')
+        if 'msg_save_transf' in st.session_state:
+            ins, ext = st.session_state.pop('msg_save_transf')
+            if ins > 0: st.success(f"✅ {ins} salvos.")
+            if ext > 0: st.warning(f"⚠️ {ext} já existiam.")
 
     with tab_query:
         c_dt1, c_dt2 = st.columns(2)
@@ -1188,15 +3324,38 @@ elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
         st.session_state['t_dt_ini'] = dt_ini
         st.session_state['t_dt_fim'] = dt_fim
         
+        with st.expander(f"🔎 Filtros da consulta ({len(st.session_state['filtros_ativos_transf'])} ativos)", expanded=False):
+            c_f1, c_f2, c_f3 = st.columns([1, 3, 1])
+            col_filtro = c_f1.selectbox("Coluna:", list(MAPA_FILTROS_TRANSF), key="filtro_transf_col")
+            col_db_filtro = MAPA_FILTROS_TRANSF[col_filtro]
+            # Sugestões vêm da última consulta; valores digitados também valem
+            opcoes_filtro = sorted(view_transf[col_db_filtro].dropna().astype(str).unique()) if view_transf is not None and col_db_filtro in view_transf.columns else []
+            vals_filtro = c_f2.multiselect("Valores:", opcoes_filtro, key="filtro_transf_vals", accept_new_options=True)
+            if c_f3.button("➕ Adicionar", key="btn_add_filtro_transf", disabled=not vals_filtro):
+                st.session_state['filtros_ativos_transf'].append({'col': col_filtro, 'vals': list(vals_filtro)})
+                st.rerun()
+            for f in st.session_state['filtros_ativos_transf']:
+                st.caption(f"{f['col']}: {', '.join(map(str, f['vals']))}")
+            if st.session_state['filtros_ativos_transf'] and st.button("Limpar filtros", key="btn_limpar_filtros_transf"):
+                st.session_state['filtros_ativos_transf'] = []
+                st.rerun()
+
         if st.button("Consultar", key="btn_search_transf"):
+            lido_em = datetime.now(timezone.utc)
             df_banco = carregar_transf_filtrado_db(dt_ini, dt_fim, st.session_state['filtros_ativos_transf'])
+            st.session_state['plano_transf'] = df_banco.attrs.get('plano_consulta', '')
+            plano = df_banco.attrs.get('plano_banco') or {'banco': None, 'local': {}}
             if not df_banco.empty and 'numero' in df_banco.columns and 'data_realizacao' in df_banco.columns:
                 df_banco = df_banco.sort_values(by=['numero', 'data_realizacao'])
-            st.session_state['view_transf'] = df_banco
+            guardar_df_sessao('view_transf', df_banco)
+            ouvir_periodo('view_transf', 'transf_historico', 'data_realizacao', dt_ini, dt_fim, lido_em,
+                          preparar=functools.partial(filtrar_transf_local, filtros=plano['local']),
+                          ordem=['numero', 'data_realizacao'], filtro=plano['banco'])
             st.rerun()
         
-        if st.session_state['view_transf'] is not None:
-            render_filtered_table(st.session_state['view_transf'], "transf_view")
+        if st.session_state.get('plano_transf'): st.caption(f"Consulta: {st.session_state['plano_transf']}")
+        if view_transf is not None:
+            render_filtered_table(view_transf, "transf_view", export_nome="historico_transformacao")
 
     with tab_manage:
         c_del1, c_del2 = st.columns(2)
@@ -1210,7 +3369,8 @@ elif menu_sel == "3. HISTORICO TRANSFORMAÇÃO":
 elif menu_sel == "4. DEBITO CONSUMO":
     st.header("🚚 DEBITO CONSUMO")
     
-    if st.session_state['view_consumo'] is not None and not st.session_state['view_consumo'].empty:
+    view_consumo = obter_df_sessao('view_consumo')
+    if view_consumo is not None and not view_consumo.empty:
         tab_c_view, tab_c_import, tab_c_del = st.tabs(["📊 Consultar DB (Ativo)", "📥 Importar Excel", "🗑️ Limpar Período"])
     else:
         tab_c_import, tab_c_view, tab_c_del = st.tabs(["📥 Importar Excel", "📊 Consultar DB", "🗑️ Limpar Período"])
@@ -1223,7 +3383,7 @@ elif menu_sel == "4. DEBITO CONSUMO":
                 all_dataframes = []
                 with st.spinner("Lendo..."):
                     for file in uploaded_files:
-                        df_temp = load_data_consumo_excel(file)
+                        df_temp = load_data_consumo_excel(file, unidade_ativa())
                         df_temp['_arquivo_origem_temp'] = file.name
                         all_dataframes.append(df_temp)
                 
@@ -1270,12 +3430,14 @@ elif menu_sel == "4. DEBITO CONSUMO":
         st.session_state['c_dt_fim'] = d_fim_c
         
         if st.button("Consultar Consumo", key="btn_search_consumo"):
+            lido_em = datetime.now(timezone.utc)
             df_c_res = carregar_consumo_filtrado_db(d_ini_c, d_fim_c)
-            st.session_state['view_consumo'] = df_c_res
+            guardar_df_sessao('view_consumo', df_c_res)
+            ouvir_periodo('view_consumo', 'consumo_historico', 'data_consumo', d_ini_c, d_fim_c, lido_em, preparar=expandir_json_consumo)
             st.rerun()
         
-        if st.session_state['view_consumo'] is not None:
-            render_filtered_table(st.session_state['view_consumo'], "cons_view")
+        if view_consumo is not None:
+            render_filtered_table(view_consumo, "cons_view", export_nome="historico_consumo")
 
     with tab_c_del:
         del_ini_c = st.date_input("Início:", key="deli_c", format="DD/MM/YYYY")
@@ -1291,14 +3453,18 @@ elif menu_sel == "5. Gestão: Vínculos (Admin)":
     pend_sis_count = 0
     pend_ple_count = 0
     pend_vinc_count = 0
-    if 'df_sisflora' in st.session_state:
-        lista_agrupados = list(st.session_state['agrup_sis'].keys())
-        pend_sis_count = st.session_state['df_sisflora'][~st.session_state['df_sisflora']['Item_Completo'].isin(lista_agrupados)]['Item_Completo'].nunique()
-    if 'df_plenus' in st.session_state:
-        lista_agrupados_p = list(st.session_state['agrup_ple'].keys())
-        if 'Item_Completo' not in st.session_state['df_plenus'].columns:
-             st.session_state['df_plenus']['Item_Completo'] = st.session_state['df_plenus']["produto"] + " (" + st.session_state['df_plenus']["categoria"].fillna("") + ")"
-        pend_ple_count = st.session_state['df_plenus'][~st.session_state['df_plenus']['Item_Completo'].isin(lista_agrupados_p)]['Item_Completo'].nunique()
+    df_sis_adm = obter_df_sessao('df_sisflora')
+    df_ple_adm = obter_df_sessao('df_plenus')
+    if df_ple_adm is not None and 'Item_Completo' not in df_ple_adm.columns:
+        df_ple_adm = df_ple_adm.assign(Item_Completo=montar_item_plenus(df_ple_adm))
+        guardar_df_sessao('df_plenus', df_ple_adm)
+    idx_sis = idx_ple = None
+    if df_sis_adm is not None:
+        idx_sis = indice_pendentes("SISFLORA", df_sis_adm, 'Cat_Auto')
+        pend_sis_count = len(idx_sis['pendentes'])
+    if df_ple_adm is not None:
+        idx_ple = indice_pendentes("PLENUS", df_ple_adm, 'categoria')
+        pend_ple_count = len(idx_ple['pendentes'])
         
     grps_sis = carregar_lista_grupos_db("SISFLORA")
     grps_vinc = carregar_vinculos_db().values()
@@ -1310,20 +3476,15 @@ elif menu_sel == "5. Gestão: Vínculos (Admin)":
     col_c.metric("Sem Vínculo", pend_vinc_count)
     st.divider()
 
-    admin_mode = st.radio("Ação:", ["Agrupar Sisflora", "Agrupar Plenus", "Vincular (IA)", "Vínculo Manual", "Gerenciar Grupos"], horizontal=True)
+    admin_mode = st.radio("Ação:", ["Agrupar Sisflora", "Agrupar Plenus", "Vincular (IA)", "Vínculo Manual", "Gerenciar Grupos", "Regras de Classificação", "Unidades (Filiais)", "Importações"], horizontal=True)
     
     if admin_mode == "Agrupar Sisflora":
-        if 'df_sisflora' in st.session_state:
+        if df_sis_adm is not None:
+            painel_agrupamento_auto(idx_sis, "SISFLORA")
             c1, c2 = st.columns([2, 1])
-            cat_sel = c1.selectbox("Categoria:", [""] + sorted(st.session_state['df_sisflora']['Cat_Auto'].unique()), key="s_cat_adm")
+            cat_sel = c1.selectbox("Categoria:", [""] + idx_sis['categorias'], key="s_cat_adm")
             txt_sel = c2.text_input("Pesquisar Nome:", key="s_txt_adm")
-            lista_agrupados = list(st.session_state['agrup_sis'].keys())
-            mask_pend = ~st.session_state['df_sisflora']['Item_Completo'].isin(lista_agrupados)
-            mask_cesta = ~st.session_state['df_sisflora']['Item_Completo'].isin(st.session_state['cesta_sis'])
-            df_pend = st.session_state['df_sisflora'][mask_pend & mask_cesta].copy()
-            if cat_sel: df_pend = df_pend[df_pend['Cat_Auto'] == cat_sel]
-            if txt_sel: df_pend = df_pend[df_pend['Item_Completo'].str.contains(txt_sel, case=False, na=False)]
-            lista_filtrada = sorted(df_pend['Item_Completo'].unique(), key=sort_key_nomes)
+            lista_filtrada = radar_pendentes(idx_sis, cat_sel, txt_sel)
             c_esq, c_dir = st.columns([1, 1])
             with c_esq:
                 st.markdown(f"#### 📡 Radar ({len(lista_filtrada)})")
@@ -1346,20 +3507,12 @@ elif menu_sel == "5. Gestão: Vínculos (Admin)":
                 st.button("💾 SALVAR GRUPO", key="sav_sis", type="primary", on_click=salvar_sis_click)
     
     elif admin_mode == "Agrupar Plenus":
-        if 'df_plenus' in st.session_state:
-            if 'Item_Completo' not in st.session_state['df_plenus'].columns:
-                 st.session_state['df_plenus']['Item_Completo'] = st.session_state['df_plenus']["produto"] + " (" + st.session_state['df_plenus']["categoria"].fillna("") + ")"
+        if df_ple_adm is not None:
+            painel_agrupamento_auto(idx_ple, "PLENUS")
             c1, c2 = st.columns([2, 1])
-            cats_p = sorted(st.session_state['df_plenus']['categoria'].fillna("").unique()) if 'categoria' in st.session_state['df_plenus'].columns else []
-            cat_sel_p = c1.selectbox("Categoria:", [""] + cats_p, key="p_cat_adm")
+            cat_sel_p = c1.selectbox("Categoria:", [""] + idx_ple['categorias'], key="p_cat_adm")
             txt_sel_p = c2.text_input("Pesquisar Nome:", key="p_txt_adm")
-            lista_agrupados_p = list(st.session_state['agrup_ple'].keys())
-            mask_pend_p = ~st.session_state['df_plenus']['Item_Completo'].isin(lista_agrupados_p)
-            mask_cesta_p = ~st.session_state['df_plenus']['Item_Completo'].isin(st.session_state['cesta_ple'])
-            df_pend_p = st.session_state['df_plenus'][mask_pend_p & mask_cesta_p].copy()
-            if cat_sel_p: df_pend_p = df_pend_p[df_pend_p['categoria'] == cat_sel_p]
-            if txt_sel_p: df_pend_p = df_pend_p[df_pend_p['Item_Completo'].str.contains(txt_sel_p, case=False, na=False)]
-            lista_filtrada_p = sorted(df_pend_p['Item_Completo'].unique(), key=sort_key_nomes)
+            lista_filtrada_p = radar_pendentes(idx_ple, cat_sel_p, txt_sel_p)
             c_esq, c_dir = st.columns([1, 1])
             with c_esq:
                 st.markdown(f"#### 📡 Radar ({len(lista_filtrada_p)})")
@@ -1389,40 +3542,12 @@ elif menu_sel == "5. Gestão: Vínculos (Admin)":
             f_cat_ia = st.selectbox("Filtrar por Categoria:", ["TODAS", "TORAS", "SERRADAS", "BENEFICIADAS"], key="sel_cat_ia")
             if st.button("🔎 Buscar Sugestões"):
                 with st.spinner(f"Analisando..."):
-                    mapa_cat_sis = get_categorias_dos_grupos("SISFLORA")
                     mapa_cat_ple = get_categorias_dos_grupos("PLENUS")
-                    sugestoes = []
-                    for gp in grps_ple:
-                        is_vinculado = gp in vinculos_atuais
-                        status_vinc = f"✅ Já vinculado a: {vinculos_atuais[gp]}" if is_vinculado else ""
-                        cat_p = mapa_cat_ple.get(gp, "OUTROS")
-                        if f_cat_ia != "TODAS":
-                            cat_normal = cat_p
-                            if cat_p in ["TORAS", "TOROS", "TORA"]: cat_normal = "TORAS"
-                            elif "SERRADA" in cat_p: cat_normal = "SERRADAS"
-                            elif "BENEF" in cat_p: cat_normal = "BENEFICIADAS"
-                            if cat_normal != f_cat_ia: continue
-                        
-                        melhor_match = None
-                        maior_score = 0.0
-                        for gs in grps_sis:
-                            score = calcular_similaridade_avancada(gp, gs)
-                            if score > 0.65 and score > maior_score:
-                                maior_score = score
-                                melhor_match = gs
-                        if melhor_match:
-                            sugestoes.append({
-                                "Plenus": gp,
-                                "Sisflora (Sugerido)": melhor_match,
-                                "Categoria": cat_p,
-                                "Status": status_vinc,
-                                "Confiança": f"{maior_score:.0%}",
-                                "Aceitar": False,
-                                "is_locked": is_vinculado
-                            })
-                    st.session_state['sugestoes_ia'] = sugestoes
-            if 'sugestoes_ia' in st.session_state and st.session_state['sugestoes_ia']:
-                df_sug = pd.DataFrame(st.session_state['sugestoes_ia'])
+                    sugestoes = sugerir_vinculos_fuzzy(grps_ple, grps_sis, vinculos_atuais, mapa_cat_ple, f_cat_ia)
+                    guardar_df_sessao('sugestoes_ia', sugestoes)
+            sugestoes_ia = obter_df_sessao('sugestoes_ia')
+            if sugestoes_ia:
+                df_sug = pd.DataFrame(sugestoes_ia)
                 if not df_sug.empty:
                     edited_df = st.data_editor(
                         df_sug,
@@ -1490,43 +3615,104 @@ elif menu_sel == "5. Gestão: Vínculos (Admin)":
         else:
             df_rel = carregar_todos_agrupamentos_db()
             if not df_rel.empty:
-                excel_bytes = to_excel_autoajustado(df_rel)
-                st.download_button("📥 Baixar Relatório", excel_bytes, "relatorio_grupos.xlsx")
+                botao_exportar(df_rel, "relatorio_grupos", "rel_grupos", "📥 Baixar Relatório")
                 st.dataframe(df_rel, use_container_width=True)
 
+    elif admin_mode == "Regras de Classificação":
+        classificador = obter_regras()
+        fonte_txt = f"banco ({COLECAO_CONFIG}/{DOC_REGRAS})" if classificador.fonte == 'banco' else f"arquivo {ARQUIVO_REGRAS}"
+        st.caption(f"Fonte: {fonte_txt} · versão {classificador.versao} · assinatura {classificador.assinatura} · conferidas a cada {TTL_REGRAS_S:g}s.")
+        erro_regras = _estado_regras()['erro']
+        if erro_regras: st.error(f"A última recarga falhou e as regras anteriores continuam valendo: {erro_regras}")
+        st.dataframe(classificador.resumo(), use_container_width=True, hide_index=True)
+        st.caption(f"Códigos aceitos no PDF Sisflora: {', '.join(classificador.codigos_aceitos)}. Sem regra que case: {classificador.categoria_padrao}.")
+        with st.expander("✏️ Editar regras (JSON)"):
+            dados_regras = {k: v for k, v in classificador.dados.items() if k not in regras.CAMPOS_CONTROLE}
+            txt_regras = st.text_area("Regras:", json.dumps(dados_regras, indent=2, ensure_ascii=False), height=400, key="txt_regras")
+            c_r1, c_r2, c_r3 = st.columns(3)
+            if c_r1.button("💾 Validar e Salvar no Banco", key="btn_salvar_regras"):
+                try:
+                    salvar_regras_db(json.loads(txt_regras))
+                    st.success("Regras salvas: valem para todos a partir de agora.")
+                    time.sleep(1)
+                    st.rerun()
+                except ValueError as e:  # inclui JSON malformado
+                    st.error(f"Regras inválidas: {e}")
+            if c_r2.button("🔄 Recarregar Agora", key="btn_recarregar_regras"):
+                obter_regras(forcar=True)
+                st.rerun()
+            if classificador.fonte == 'banco' and c_r3.button("↩️ Voltar ao Arquivo", key="btn_regras_arquivo"):
+                remover_regras_db()
+                st.rerun()
+
+    elif admin_mode == "Unidades (Filiais)":
+        st.caption("Unidades vêm da configuração 'unidades' (ESTOQUE_UNIDADES ou [app] nos secrets), ex.: "
+                   "MATRIZ=Serraria Sede, FILIAL2=Serraria Norte. Agrupamentos, vínculos e regras valem para todas.")
+        st.dataframe(pd.DataFrame([
+            {'Código': u, 'Rótulo': rotulo, 'Ativa': u == unidade_ativa(), 'Caminho do histórico': caminho_colecao('plenus_historico', u).replace('plenus_historico', '') or '(raiz)'}
+            for u, rotulo in UNIDADES.items()]), use_container_width=True, hide_index=True)
+        if UNIDADE_PADRAO_NA_RAIZ:
+            st.info(f"A unidade {UNIDADE_PADRAO} usa as coleções da raiz (histórico de antes das unidades). Para movê-la "
+                    f"para unidades/{UNIDADE_PADRAO}/, copie o histórico e depois configure unidade_padrao_na_raiz = 0.")
+            if st.button(f"📦 Copiar histórico da raiz para unidades/{UNIDADE_PADRAO}", disabled=tarefa_em_andamento('migrar_unidade')):
+                iniciar_tarefa('migrar_unidade', f"Cópia do histórico para a unidade {UNIDADE_PADRAO}",
+                               lambda tarefa, filial: migrar_raiz_para_unidade(filial, _tarefa=tarefa), UNIDADE_PADRAO)
+        tarefa_mig = recolher_tarefa('migrar_unidade')
+        if tarefa_mig and mostrar_fim_tarefa(tarefa_mig, "Cópia cancelada: os documentos já copiados ficam no destino (copiar de novo sobrescreve)."):
+            st.success("✅ Cópia concluída: " + ", ".join(f"{nome} {n}" for nome, n in tarefa_mig['resultado'].items()))
+        if tarefa_em_andamento('migrar_unidade'):
+            painel_tarefa('migrar_unidade')
+
+    elif admin_mode == "Importações":
+        st.caption("Cada gravação de histórico é uma importação: as linhas ficam num diário e são publicadas em lotes. "
+                   "Uma importação interrompida (erro ou cancelamento) bloqueia novas gravações no mesmo período até ser retomada ou desfeita.")
+        tarefa_imp = recolher_tarefa('importacao_admin')
+        if tarefa_imp and mostrar_fim_tarefa(tarefa_imp, "Operação cancelada: o registro da importação indica até onde foi (retome ou desfaça de novo)."):
+            st.success(f"✅ {tarefa_imp['descricao']}: {tarefa_imp['resultado']} documentos.")
+        importacoes = listar_importacoes()
+        if not importacoes:
+            st.info("Nenhuma importação registrada nesta unidade.")
+        else:
+            df_imp = pd.DataFrame(importacoes)
+            st.dataframe(df_imp[['id', 'colecao', 'status', 'publicadas', 'linhas', 'dt_min', 'dt_max', 'existentes', 'origem', 'criada_em', 'erro']],
+                         use_container_width=True, hide_index=True)
+            publicaveis = [m['id'] for m in importacoes if m['status'] in STATUS_PUBLICAVEL]
+            reversiveis = [m['id'] for m in importacoes if m['status'] != 'desfeita']
+            ocupado = tarefa_em_andamento('importacao_admin')
+            c_i1, c_i2 = st.columns(2)
+            with c_i1:
+                sel_ret = st.selectbox("Retomar publicação:", publicaveis or ["—"], key="imp_retomar")
+                if st.button("▶️ Retomar", key="btn_imp_retomar", disabled=ocupado or sel_ret == "—"):
+                    iniciar_tarefa('importacao_admin', f"Publicação da importação {sel_ret}",
+                                   lambda tarefa, iid: publicar_importacao(iid, _tarefa=tarefa), sel_ret)
+                    st.rerun()
+            with c_i2:
+                sel_des = st.selectbox("Desfazer importação:", reversiveis or ["—"], key="imp_desfazer")
+                if st.button("↩️ Desfazer", key="btn_imp_desfazer", disabled=ocupado or sel_des == "—"):
+                    iniciar_tarefa('importacao_admin', f"Desfazer importação {sel_des}",
+                                   lambda tarefa, iid: desfazer_importacao(iid, _tarefa=tarefa), sel_des)
+                    st.rerun()
+        if tarefa_em_andamento('importacao_admin'):
+            painel_tarefa('importacao_admin')
+
 # --- 6. CONFERÊNCIA ---
 elif menu_sel == "6. Conferência & Auditoria":
     st.header("⚖️ Resultado Final")
-    tab_conf_saldo, tab_conf_auditoria = st.tabs(["SALDO ESTÁTICO", "AUDITORIA DE FLUXO"])
+    tab_conf_saldo, tab_conf_auditoria, tab_conf_tendencias = st.tabs(["SALDO ESTÁTICO", "AUDITORIA DE FLUXO", "📈 TENDÊNCIAS"])
 
     with tab_conf_saldo:
-        if 'df_sisflora' in st.session_state and 'df_plenus' in st.session_state:
-            df_s = st.session_state['df_sisflora'].copy()
-            df_s['Grupo'] = df_s['Item_Completo'].map(st.session_state['agrup_sis'])
-            res_s = df_s.dropna(subset=['Grupo']).groupby('Grupo')['Volume Disponivel'].sum().reset_index()
-            
-            df_p = st.session_state['df_plenus'].copy()
-            if 'Item_Completo' not in df_p.columns:
-                 df_p['Item_Completo'] = df_p["produto"] + " (" + df_p["categoria"].fillna("") + ")"
-            
-            df_p_last = df_p.sort_values(by=['data_movimento'] if 'data_movimento' in df_p.columns else ['sku']).drop_duplicates(subset=['sku'], keep='last').copy()
-            df_p_last['Grupo_Inter'] = df_p_last['Item_Completo'].map(st.session_state['agrup_ple'])
-            df_p_last['Grupo_Calc'] = df_p_last['Grupo_Inter'].map(st.session_state['vinculos']).fillna(df_p_last['Grupo_Inter'])
-            
-            col_saldo = 'saldo_apos' if 'saldo_apos' in df_p_last.columns else 'saldo'
-            if col_saldo in df_p_last.columns: df_p_last[col_saldo] = pd.to_numeric(df_p_last[col_saldo], errors='coerce').fillna(0)
-            res_p = df_p_last.dropna(subset=['Grupo_Calc']).groupby('Grupo_Calc')[col_saldo].sum().reset_index()
-            
-            res_s.columns = ['Grupo', 'Vol_Sis']
-            res_p.columns = ['Grupo', 'Vol_Ple']
-            df_final = pd.merge(res_s, res_p, on='Grupo', how='outer').fillna(0)
-            df_final['Diferenca'] = df_final['Vol_Sis'] - df_final['Vol_Ple']
-            
-            def highlight_diff(val):
-                color = 'green' if abs(val) < 0.01 else ('red' if val < 0 else 'blue')
-                return f'color: {color}; font-weight: bold'
-            
-            st.dataframe(df_final.style.map(highlight_diff, subset=['Diferenca']).format("{:,.4f}"), use_container_width=True, height=600)
+        df_s = obter_df_sessao('df_sisflora')
+        df_p = obter_df_sessao('df_plenus')
+        if df_s is not None and df_p is not None:
+            df_final = calcular_conferencia_saldo(df_s, df_p, st.session_state['agrup_sis'], st.session_state['agrup_ple'], st.session_state['vinculos'])
+
+            # Cor da diferença vira uma coluna de status (verde = bate, vermelho = negativa, azul = positiva)
+            dif = df_final['Diferenca']
+            status = pd.Series("🔵", index=df_final.index).mask(dif < 0, "🔴").mask(dif.abs() < 0.01, "🟢")
+            df_exib, col_config = preparar_exibicao(df_final)
+            st.dataframe(df_exib.assign(Status=status), use_container_width=True, height=600,
+                         column_config={**col_config, 'Status': st.column_config.TextColumn(width="small")})
+            botao_exportar(df_final, "conferencia_saldo", "conf_saldo")
         else:
             st.info("Carregue os saldos Sisflora e Plenus primeiro.")
 
@@ -1537,76 +3723,109 @@ elif menu_sel == "6. Conferência & Auditoria":
         st.session_state['aud_dt_ini'] = dt_ini_aud
         st.session_state['aud_dt_fim'] = dt_fim_aud
         
-        if st.button("🚀 Processar Auditoria"):
-            with st.spinner("Analisando DB..."):
-                df_transf = carregar_transf_filtrado_db(dt_ini_aud, dt_fim_aud)
-                df_consumo = carregar_consumo_filtrado_db(dt_ini_aud, dt_fim_aud)
-                df_plenus_mov = carregar_plenus_movimento_db(dt_ini_aud, dt_fim_aud)
-                
-                saldo_aud_sis = {}
-                agrup_sis = st.session_state['agrup_sis']
-                vinculos = st.session_state['vinculos']
-                
-                # ... (LÓGICA DE AUDITORIA MANTIDA IDÊNTICA AO ORIGINAL) ...
-                if not df_transf.empty:
-                    gerados = df_transf[df_transf['tipo_produto'] == 'PRODUTO GERADO'].copy()
-                    if not gerados.empty:
-                        gerados['Item_Check'] = gerados.apply(lambda x: f"{x['produto']} - {x['essencia']}" if x['essencia'] else x['produto'], axis=1)
-                        gerados['Grupo'] = gerados['Item_Check'].map(agrup_sis).fillna(gerados['Item_Check'])
-                        for _, r in gerados.iterrows():
-                             if pd.notnull(r['Grupo']):
-                                 if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
-                                 saldo_aud_sis[r['Grupo']]['Entrada'] += r['volume']
-
-                    origens = df_transf[df_transf['tipo_produto'] == 'PRODUTO DE ORIGEM'].copy()
-                    if not origens.empty:
-                        origens['Item_Check'] = origens.apply(lambda x: f"{x['produto']} - {x['essencia']}" if x['essencia'] else x['produto'], axis=1)
-                        origens['Grupo'] = origens['Item_Check'].map(agrup_sis).fillna(origens['Item_Check'])
-                        for _, r in origens.iterrows():
-                             if pd.notnull(r['Grupo']):
-                                 if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
-                                 saldo_aud_sis[r['Grupo']]['Saida'] += r['volume']
-
-                if not df_consumo.empty:
-                    df_consumo['Item_Check'] = df_consumo.apply(lambda x: f"{x.get('produto','')}" if not x.get('essencia') else f"{x.get('produto','')} - {x.get('essencia','')}", axis=1)
-                    df_consumo['Grupo'] = df_consumo['Item_Check'].map(agrup_sis).fillna(df_consumo['Item_Check'])
-                    for _, r in df_consumo.iterrows():
-                        if pd.notnull(r['Grupo']):
-                             if r['Grupo'] not in saldo_aud_sis: saldo_aud_sis[r['Grupo']] = {'Entrada': 0, 'Saida': 0}
-                             saldo_aud_sis[r['Grupo']]['Saida'] += float(r.get('volume', 0))
-
-                saldo_aud_ple = {}
-                agrup_ple = st.session_state['agrup_ple']
-                if not df_plenus_mov.empty:
-                    df_plenus_mov['Item_Completo'] = df_plenus_mov["produto"] + " (" + df_plenus_mov["categoria"].fillna("") + ")"
-                    df_plenus_mov['Grupo_Inter'] = df_plenus_mov['Item_Completo'].map(agrup_ple)
-                    df_plenus_mov['Grupo_Calc'] = df_plenus_mov['Grupo_Inter'].map(vinculos).fillna(df_plenus_mov['Grupo_Inter'])
-                    for _, r in df_plenus_mov.iterrows():
-                        if pd.notnull(r['Grupo_Calc']):
-                            grp = r['Grupo_Calc']
-                            if grp not in saldo_aud_ple: saldo_aud_ple[grp] = {'Entrada': 0, 'Saida': 0}
-                            saldo_aud_ple[grp]['Entrada'] += r['entrada']
-                            saldo_aud_ple[grp]['Saida'] += r['saida']
-
-                todos_grupos = set(saldo_aud_sis.keys()) | set(saldo_aud_ple.keys())
-                relatorio = []
-                for g in todos_grupos:
-                    s = saldo_aud_sis.get(g, {'Entrada': 0, 'Saida': 0})
-                    p = saldo_aud_ple.get(g, {'Entrada': 0, 'Saida': 0})
-                    s_liq = s['Entrada'] - s['Saida']
-                    p_liq = p['Entrada'] - p['Saida']
-                    diff = s_liq - p_liq
-                    
-                    if any(abs(x) > 0.0001 for x in [s['Entrada'], s['Saida'], s_liq, p['Entrada'], p['Saida'], p_liq]):
-                        relatorio.append({
-                            "Grupo": g,
-                            "Sis_Ent": s['Entrada'], "Sis_Sai": s['Saida'], "Sis_Liq": s_liq,
-                            "Ple_Ent": p['Entrada'], "Ple_Sai": p['Saida'], "Ple_Liq": p_liq,
-                            "Diferenca": diff
-                        })
-
-                if relatorio:
-                    df_rel = pd.DataFrame(relatorio)
-                    st.dataframe(df_rel.style.format("{:,.4f}"), use_container_width=True)
-                else:
-                    st.info("Nenhuma movimentação no período.")
+        forcar_sync = False
+        if obter_espelho() is not None:
+            forcar_sync = st.checkbox("🔄 Reler o período do banco (ignorar espelho local)", key="aud_forcar_sync")
+
+        unidades_aud = [unidade_ativa()]
+        if len(UNIDADES) > 1 and st.checkbox("🏭 Todas as unidades (em paralelo)", key="aud_todas_unidades"):
+            unidades_aud = list(UNIDADES)
+
+        if st.button("🚀 Processar Auditoria", disabled=tarefa_em_andamento('auditoria')):
+            rotulo_unid = "todas as unidades" if len(unidades_aud) > 1 else UNIDADES[unidades_aud[0]]
+            iniciar_tarefa('auditoria', f"Auditoria {dt_ini_aud.strftime('%d/%m/%Y')} a {dt_fim_aud.strftime('%d/%m/%Y')} ({rotulo_unid})",
+                           tarefa_auditoria_fluxo, dt_ini_aud, dt_fim_aud, st.session_state['agrup_sis'],
+                           st.session_state['agrup_ple'], st.session_state['vinculos'], forcar_sync, unidades_aud)
+
+        tarefa_aud = recolher_tarefa('auditoria')
+        if tarefa_aud and mostrar_fim_tarefa(tarefa_aud, "Auditoria cancelada."):
+            # Resultado fica na sessão: continua visível nas próximas interações
+            guardar_df_sessao('df_auditoria', tarefa_aud['resultado'])
+            st.session_state['auditoria_periodo'] = tarefa_aud['descricao']
+        if tarefa_em_andamento('auditoria'):
+            painel_tarefa('auditoria')
+
+        df_rel = obter_df_sessao('df_auditoria')
+        if df_rel is not None:
+            st.caption(st.session_state.get('auditoria_periodo', ''))
+            if not df_rel.empty:
+                df_exib, col_config = preparar_exibicao(df_rel)
+                st.dataframe(df_exib, use_container_width=True, column_config=col_config)
+                botao_exportar(df_rel, "auditoria_fluxo", "auditoria")
+            else:
+                st.info("Nenhuma movimentação no período.")
+
+    with tab_conf_tendencias:
+        c_dt1, c_dt2 = st.columns(2)
+        dt_ini_tend = c_dt1.date_input("Início:", value=st.session_state['tend_dt_ini'], key="tend_i", format="DD/MM/YYYY")
+        dt_fim_tend = c_dt2.date_input("Fim:", value=st.session_state['tend_dt_fim'], key="tend_f", format="DD/MM/YYYY")
+        st.session_state['tend_dt_ini'] = dt_ini_tend
+        st.session_state['tend_dt_fim'] = dt_fim_tend
+
+        if st.button("📈 Montar Séries", disabled=tarefa_em_andamento('tendencias'), key="btn_tendencias"):
+            iniciar_tarefa('tendencias', f"Tendências {dt_ini_tend.strftime('%d/%m/%Y')} a {dt_fim_tend.strftime('%d/%m/%Y')}",
+                           lambda tarefa, *args: carregar_serie_fluxo(*args, _tarefa=tarefa), dt_ini_tend, dt_fim_tend,
+                           st.session_state['agrup_sis'], st.session_state['agrup_ple'], st.session_state['vinculos'])
+
+        tarefa_tend = recolher_tarefa('tendencias')
+        if tarefa_tend and mostrar_fim_tarefa(tarefa_tend, "Montagem das séries cancelada."):
+            guardar_df_sessao('df_tendencia', tarefa_tend['resultado'])
+            st.session_state['tendencia_periodo'] = (dt_ini_tend, dt_fim_tend)
+            st.session_state.pop('tend_grupos', None)
+        if tarefa_em_andamento('tendencias'):
+            painel_tarefa('tendencias')
+
+        df_serie = obter_df_sessao('df_tendencia')
+        if df_serie is not None and df_serie.empty:
+            st.info("Nenhuma movimentação no período.")
+        elif df_serie is not None:
+            # Grupos mais movimentados primeiro (e os 6 maiores marcados de início)
+            volume = df_serie.groupby('Grupo')[COLS_SERIE_FLUXO[2:]].sum().abs().sum(axis=1).sort_values(ascending=False)
+            c_g1, c_g2 = st.columns([4, 1])
+            grupos_tend = c_g1.multiselect("Grupos:", list(volume.index), default=list(volume.index[:6]), key="tend_grupos")
+            ini_serie, fim_serie = st.session_state.get('tendencia_periodo', (dt_ini_tend, dt_fim_tend))
+            grao_auto = escolher_grao(ini_serie, fim_serie, max(2 * len(grupos_tend), 4))  # 2 linhas por grupo; 4 séries de barras
+            opcoes_grao = ['auto'] + list(GRAOS_TENDENCIA)
+            grao_sel = c_g2.selectbox("Agrupar por:", opcoes_grao, key="tend_grao",
+                                      format_func=lambda g: f"Automático ({GRAOS_TENDENCIA[grao_auto]})" if g == 'auto' else GRAOS_TENDENCIA[g])
+            grao = grao_auto if grao_sel == 'auto' else grao_sel
+            st.caption(f"Período da série: {ini_serie.strftime('%d/%m/%Y')} a {fim_serie.strftime('%d/%m/%Y')} · "
+                       f"{len(df_serie)} linhas diárias (dia x grupo) na sessão.")
+            if grupos_tend:
+                fig_saldo, fig_dif, fig_fluxo = graficos_tendencia(df_serie, grupos_tend, grao)
+                st.markdown("##### Saldo acumulado no período (Sisflora x Plenus)")
+                st.plotly_chart(fig_saldo, use_container_width=True)
+                st.markdown("##### Diferença acumulada (Sisflora - Plenus)")
+                st.plotly_chart(fig_dif, use_container_width=True)
+                st.markdown("##### Fluxo por período (soma dos grupos escolhidos)")
+                st.plotly_chart(fig_fluxo, use_container_width=True)
+                botao_exportar(reamostrar_serie(df_serie[df_serie['Grupo'].isin(grupos_tend)], grao), "tendencias", "tendencias")
+
+# --- DIAGNÓSTICO (SIDEBAR) ---
+# Fica no fim do script para já mostrar as etapas medidas nesta execução.
+if st.sidebar.toggle("🩺 Diagnóstico de desempenho", key="diag_ativo"):
+    st.sidebar.checkbox("Medir pico de memória (tracemalloc)", key="diag_mem",
+                        on_change=lambda: ativar_perfil_memoria(st.session_state['diag_mem']))
+    with st.sidebar.expander("🩺 Etapas medidas", expanded=True):
+        df_diag = resumo_diagnostico(_id_sessao())
+        if df_diag.empty: st.caption("Nenhuma etapa medida ainda.")
+        else: st.dataframe(df_diag.head(50), use_container_width=True, hide_index=True)
+        if ARQUIVO_LOG_DIAGNOSTICO: st.caption(f"Log JSON: {ARQUIVO_LOG_DIAGNOSTICO}")
+    if obter_espelho() is None and _falha_espelho()['erro']:
+        with st.sidebar.expander("🦆 Espelho local (DuckDB)", expanded=False):
+            st.warning(f"Espelho indisponível ({datetime.fromtimestamp(_falha_espelho()['quando']).strftime('%H:%M')}): "
+                       f"{_falha_espelho()['erro']}. As leituras vão direto ao banco.")
+    elif obter_espelho() is not None:
+        with st.sidebar.expander("🦆 Espelho local (DuckDB)", expanded=False):
+            st.dataframe(obter_espelho().resumo(), use_container_width=True, hide_index=True)
+            st.caption(f"Dias sincronizados valem {TTL_ESPELHO_MIN:g} min.")
+            if st.button("Esvaziar marcas de sincronização", key="btn_invalidar_espelho"):
+                obter_espelho().invalidar()
+
+# --- PREFERÊNCIAS DO USUÁRIO ---
+# No fim, para gravar o estado final desta execução (períodos, filtros e dados carregados)
+retomados = st.session_state.pop('dados_retomados', [])
+if retomados:
+    lista = ", ".join(f"{c} ({datetime.fromtimestamp(t).strftime('%d/%m %H:%M')})" for c, t in retomados)
+    st.toast(f"Retomado do cache local: {lista}. Consulte de novo para atualizar.", icon="♻️")
+save_app_state()
@@ -0,0 +1,141 @@
+"""Regras de classificação de produtos (códigos, categorias e termos) como dados.
+
+As regras vêm de um documento do banco ou de um arquivo JSON (regras_classificacao.json)
+e são compiladas num ClassificadorRegras:
+
+- categorias por origem, em ordem de prioridade (vale a primeira regra que casar).
+  Modo 'prefixo' compara o início do texto (Sisflora: código do produto); modo
+  'contem' procura os termos em qualquer posição, sem diferenciar maiúsculas (Plenus).
+  Todas as regras de uma origem viram UMA expressão regular, com um grupo nomeado
+  por regra na ordem de prioridade: um único match diz a categoria do texto.
+- códigos aceitos do PDF do Sisflora e o nome padronizado de cada código;
+- termos genéricos, palavras ignoradas na comparação de nomes e termos removidos
+  da sugestão de nome de grupo.
+
+Em lote, cada texto distinto é classificado uma vez e o resultado volta para a
+coluna inteira pelos códigos do factorize.
+"""
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+ARQUIVO_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regras_classificacao.json')
+MODOS = ('prefixo', 'contem')
+LISTAS = ('codigos_aceitos', 'termos_genericos', 'termos_limpeza_nome', 'palavras_lixo')
+# Campos de controle do documento que não fazem parte das regras
+CAMPOS_CONTROLE = ('atualizado_em', 'atualizado_por')
+
+
+def validar_regras(dados):
+    """Confere a estrutura das regras; ValueError com o primeiro problema encontrado."""
+    if not isinstance(dados, dict): raise ValueError("As regras devem ser um objeto JSON.")
+    for campo in LISTAS:
+        valor = dados.get(campo, [])
+        if not isinstance(valor, list) or not all(isinstance(v, str) for v in valor):
+            raise ValueError(f"'{campo}' deve ser uma lista de textos.")
+    correcao = dados.get('correcao_produtos', {})
+    if not isinstance(correcao, dict) or not all(isinstance(v, str) for v in correcao.values()):
+        raise ValueError("'correcao_produtos' deve mapear código -> nome.")
+    categorias = dados.get('categorias')
+    if not isinstance(categorias, dict) or not categorias:
+        raise ValueError("'categorias' deve ter ao menos uma origem (ex.: SISFLORA, PLENUS).")
+    for origem, bloco in categorias.items():
+        if not isinstance(bloco, dict) or bloco.get('modo') not in MODOS:
+            raise ValueError(f"Origem {origem}: 'modo' deve ser um de {MODOS}.")
+        if not isinstance(bloco.get('regras'), list):
+            raise ValueError(f"Origem {origem}: 'regras' deve ser uma lista.")
+        for i, regra in enumerate(bloco['regras'], start=1):
+            if not isinstance(regra, dict) or not str(regra.get('categoria') or '').strip():
+                raise ValueError(f"Origem {origem}, regra {i}: falta 'categoria'.")
+            termos = regra.get('termos')
+            if not isinstance(termos, list) or not termos or not all(isinstance(t, str) and t for t in termos):
+                raise ValueError(f"Origem {origem}, regra {i} ({regra['categoria']}): 'termos' deve ser uma lista de textos não vazios.")
+    return dados
+
+
+def assinatura_regras(dados):
+    """Hash do conteúdo (sem campos de controle): muda só quando as regras mudam."""
+    conteudo = {k: v for k, v in dados.items() if k not in CAMPOS_CONTROLE}
+    return hashlib.sha1(json.dumps(conteudo, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+
+
+def ler_arquivo_regras(caminho=ARQUIVO_PADRAO):
+    with open(caminho, encoding='utf-8') as arq:
+        return json.load(arq)
+
+
+def _compilar_categorias(bloco):
+    """Uma regex por origem: alternativas na ordem das regras, cada uma com seu grupo nomeado.
+    Como as alternativas são tentadas em ordem na mesma posição (início do texto), a primeira
+    regra que casa é a que aparece em m.lastgroup."""
+    contem = bloco['modo'] == 'contem'
+    alternativas, nomes = [], {}
+    for i, regra in enumerate(bloco['regras']):
+        termos = [t.upper() if contem else t for t in regra['termos']]
+        # Termos mais longos primeiro: mesmo resultado, menos retrocesso
+        opcoes = "|".join(re.escape(t) for t in sorted(set(termos), key=len, reverse=True))
+        grupo = f"r{i}"
+        nomes[grupo] = str(regra['categoria']).strip()
+        if contem: alternativas.append(f"(?=.*?(?:{opcoes}))(?P<{grupo}>)")
+        else: alternativas.append(f"(?P<{grupo}>{opcoes})")
+    if not alternativas: return None, nomes, contem
+    return re.compile("(?:" + "|".join(alternativas) + ")", re.DOTALL), nomes, contem
+
+
+class ClassificadorRegras:
+    """Regras compiladas. Imutável: uma recarga cria outra instância."""
+
+    def __init__(self, dados, fonte="arquivo"):
+        validar_regras(dados)
+        self.dados = dados
+        self.fonte = fonte
+        self.assinatura = assinatura_regras(dados)
+        self.versao = dados.get('versao')
+        self.categoria_padrao = dados.get('categoria_padrao', 'OUTROS')
+        self.codigos_aceitos = [str(c) for c in dados.get('codigos_aceitos', [])]
+        self.correcao_produtos = {str(k): v for k, v in dados.get('correcao_produtos', {}).items()}
+        self.termos_genericos = frozenset(t.upper() for t in dados.get('termos_genericos', []))
+        self.termos_limpeza_nome = frozenset(t.upper() for t in dados.get('termos_limpeza_nome', []))
+        self.palavras_lixo = frozenset(t.upper() for t in dados.get('palavras_lixo', []))
+        self._blocos = {str(origem).upper(): bloco for origem, bloco in dados['categorias'].items()}
+        self._categorias = {origem: _compilar_categorias(bloco) for origem, bloco in self._blocos.items()}
+
+    def categorias_possiveis(self, origem):
+        _, nomes, _ = self._categorias.get(str(origem).upper(), (None, {}, False))
+        return list(dict.fromkeys(list(nomes.values()) + [self.categoria_padrao]))
+
+    def _classificar_texto(self, txt, regex, nomes, contem):
+        if regex is None: return self.categoria_padrao
+        m = regex.match(txt.upper() if contem else txt)
+        return nomes[m.lastgroup] if m else self.categoria_padrao
+
+    def categoria(self, item, origem):
+        regex, nomes, contem = self._categorias.get(str(origem).upper(), (None, {}, False))
+        return self._classificar_texto(str(item), regex, nomes, contem)
+
+    def categorias(self, itens, origem):
+        """categoria() para a coluna inteira: um match por valor distinto."""
+        regex, nomes, contem = self._categorias.get(str(origem).upper(), (None, {}, False))
+        codigos, unicos = pd.factorize(pd.Series(itens), use_na_sentinel=False)
+        cats = pd.Series([self._classificar_texto(str(t), regex, nomes, contem) for t in unicos], dtype=object)
+        return pd.Series(cats.to_numpy()[codigos], index=getattr(itens, 'index', None))
+
+    def codigos_produto(self, produtos):
+        """Código numérico do início do produto ('10 - Toras...' -> '10'); NaN quando não há."""
+        return pd.Series(produtos).astype(str).str.strip().str.extract(r'^(\d+)', expand=False)
+
+    def corrigir_produtos(self, produtos):
+        """Nome padronizado pelo código (correcao_produtos); sem correção, o texto sem espaços nas pontas."""
+        txt = pd.Series(produtos).astype(str).str.strip()
+        corrigidos = self.codigos_produto(txt).map(self.correcao_produtos)
+        return corrigidos.where(corrigidos.notna(), txt).astype(object)
+
+    def resumo(self):
+        """Tabela das regras de categoria (origem, prioridade, termos) para a tela de administração."""
+        return pd.DataFrame([
+            {'Origem': origem, 'Prioridade': i, 'Categoria': regra['categoria'],
+             'Modo': 'contém' if bloco['modo'] == 'contem' else 'prefixo', 'Termos': ", ".join(regra['termos'])}
+            for origem, bloco in self._blocos.items() for i, regra in enumerate(bloco['regras'], start=1)])